@@ -0,0 +1,53 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from src.Benchmark import Benchmark, SyntheticWeb
+
+DEFAULT_OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'benchmarks')
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl, index, rank and search throughput against a local synthetic web")
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory', help="in-memory Redis and Mongo stand-ins, or the local servers")
+    parser.add_argument('--redis-db', type=int, default=15, help="Redis db used by the local backend, must be empty")
+    parser.add_argument('--flush', action='store_true', help="clear the Redis db of the local backend first")
+    parser.add_argument('--sections', default=",".join(Benchmark.sections))
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--pages-per-site', type=int, default=200)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--words', type=int, default=300)
+    parser.add_argument('--crawl-delay', type=float, default=0)
+    parser.add_argument('--port', type=int, default=18000, help="port of the first site, each site takes the next one")
+    parser.add_argument('--crawlers', type=int, default=64, help="concurrent fetches of the crawler")
+    parser.add_argument('--max-pages', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=60, help="max seconds of the crawl and index sections")
+    parser.add_argument('--index-batch', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--graph-sizes', default="10000,100000,1000000")
+    parser.add_argument('--graph-fanout', type=int, default=10)
+    parser.add_argument('--enqueue-urls', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file to write, data/benchmarks/<time>.json by default")
+    args = parser.parse_args()
+
+    web = SyntheticWeb(sites=args.sites, pages_per_site=args.pages_per_site, fanout=args.fanout, words=args.words, crawl_delay=args.crawl_delay, port=args.port, seed=args.seed)
+    benchmark = Benchmark(
+        web, backend=args.backend, redis_db=args.redis_db, flush=args.flush, crawlers=args.crawlers, max_pages=args.max_pages,
+        duration=args.duration, index_batch=args.index_batch, queries=args.queries, graph_sizes=tuple(int(size) for size in args.graph_sizes.split(',') if size),
+        graph_fanout=args.graph_fanout, enqueue_urls=args.enqueue_urls, seed=args.seed
+    )
+
+    results = asyncio.run(benchmark.run([section for section in args.sections.split(',') if section]))
+
+    output = args.output or os.path.join(DEFAULT_OUTPUT_PATH, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+
+    print(json.dumps(results["results"], indent=2))
+    print(f"Saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,27 @@
 import asyncio
 import atexit
 import time
-import nltk
+import os
 from pymongo import AsyncMongoClient
 
+from src.QueryCache import Generation
 from src.Ranker import Ranker
+from src.Resources import download_nltk_data
 from src.helpers.ClearCmd import clear_screen
 from src.Workers import Workers
-from nltk.corpus import wordnet
 
 workers = Workers()
-ranker = Ranker(db=AsyncMongoClient("mongodb://localhost:27017/"), iterations=100)
+# Prometheus metrics of the bot on http://127.0.0.1:<port>/metrics, off unless a port is given
+metrics_port = int(os.environ.get('SEARCHENGINE_BOT_METRICS_PORT', 0)) or None
+
+# One crawler thread per crawler and tokenization in the indexer threads unless asked otherwise,
+# e.g. SEARCHENGINE_CRAWLER_MODE=async SEARCHENGINE_TOKENIZER_PROCESSES=4 SEARCHENGINE_RANK_INTERVAL=600
+crawler_mode = os.environ.get('SEARCHENGINE_CRAWLER_MODE', 'threads')
+crawler_processes = int(os.environ.get('SEARCHENGINE_CRAWLER_PROCESSES', 1))
+tokenizer_processes = int(os.environ.get('SEARCHENGINE_TOKENIZER_PROCESSES', 0))
+# Seconds between incremental PageRank runs while crawling, 0 leaves ranking to option 2
+rank_interval = float(os.environ.get('SEARCHENGINE_RANK_INTERVAL', 0)) or None
+ranker = Ranker(db=AsyncMongoClient("mongodb://localhost:27017/"), iterations=100, generation=Generation())
 
 def main():
     print("Starting...")
@@ -18,16 +29,13 @@ def main():
     while True:
         clear_screen()
         selection = input("Enter one: \n1. Crawl and index \n2. Page Rank \n3. Load nltk\n4. Exit \n")
-        if selection == '1': return workers.start(low_priority_crawlers=100, high_priority_crawlers=10, max_indexers=4, max_concurrent_indexer=100, max_concurrent_crawler=100)
+        if selection == '1': return workers.start(low_priority_crawlers=100, high_priority_crawlers=10, max_indexers=4, max_concurrent_indexer=100, max_concurrent_crawler=100, tokenizer_processes=tokenizer_processes, crawler_mode=crawler_mode, crawler_processes=crawler_processes, rank_interval=rank_interval, metrics_port=metrics_port)
         elif selection == '2': return asyncio.run(ranker.PageRank())
         elif selection == '3':
             print("Loading...")
-            nltk.download('stopwords', quiet=True)  # for stopwords+
-            nltk.download('punkt_tab', quiet=True)
-            nltk.download('averaged_perceptron_tagger_eng', quiet=True)  # for pos_tag
-            nltk.download('wordnet', quiet=True)  # for lemmatizer
-            _ = wordnet.synsets('test') # Accessing it once to force loading
-            print("Done!")
+            # Only the packages missing locally are downloaded
+            downloaded = download_nltk_data()
+            print(f"Done! Downloaded: {downloaded or 'nothing, already available'}")
             time.sleep(1)
             continue
         elif selection == '4': return print('Exiting...')
@@ -0,0 +1,408 @@
+import asyncio
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+import numpy as np
+import redis
+from aiohttp import web
+from pymongo import AsyncMongoClient, DeleteOne, UpdateOne
+
+from src.Crawler import Crawler
+from src.Dedup import RedisBloomDedup
+from src.Frontier import PriorityPolicy
+from src.Indexer import Indexer
+from src.InvertedIndex import SegmentIndexBackend
+from src.LinkGraph import LinkGraph
+from src.QueryEngine import QueryEngine
+from src.Queue import INDEXER_GROUP, INDEXING_STREAM, AsyncQueueManager, QueueManager
+from src.Ranker import Ranker, RankState
+from src.Resources import resources
+from src.helpers.PageRank import build_matrix, pagerank
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tas', 'vo', 'ne', 'shi', 'dar', 'pel', 'qu', 'bri', 'sol', 'min', 'tor', 'ga']
+
+
+class SyntheticWeb:
+    """
+    Local web of `sites` sites of `pages_per_site` linked pages, one port per site so the crawler
+    sees them as different domains. Pages are generated from their number, every run serves the
+    same web. Each page has `words` words drawn from a Zipf distribution and `fanout` links, half
+    of them to the same site.
+    """
+
+    def __init__(self, sites: int = 20, pages_per_site: int = 200, fanout: int = 10, words: int = 300, vocabulary: int = 5000, crawl_delay: float = 0, port: int = 18000, seed: int = 0):
+        self.sites = sites
+        self.pages_per_site = pages_per_site
+        self.fanout = fanout
+        self.words = words
+        self.crawl_delay = crawl_delay
+        self.port = port
+        self.seed = seed
+        self.requests = 0
+
+        rng = random.Random(seed)
+        self.vocabulary = sorted({"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(vocabulary * 2)})[:vocabulary]
+        rng.shuffle(self.vocabulary)
+        weights = 1 / np.arange(1, len(self.vocabulary) + 1)
+        self.weights = list(np.cumsum(weights / weights.sum()))
+
+        self.__runner: web.AppRunner | None = None
+
+    def url(self, site: int, page: int) -> str:
+        return f"http://127.0.0.1:{self.port + site}/page/{page}"
+
+    def seed_urls(self) -> tuple[str, ...]:
+        return tuple(self.url(site, 0) for site in range(self.sites))
+
+    def page(self, site: int, page: int) -> str:
+        rng = random.Random(f"{self.seed}:{site}:{page}")
+        text = " ".join(rng.choices(self.vocabulary, cum_weights=self.weights, k=self.words))
+        title = " ".join(rng.choices(self.vocabulary, cum_weights=self.weights, k=4))
+
+        links = []
+        for i in range(self.fanout):
+            target_site = site if i % 2 == 0 else rng.randrange(self.sites)
+            anchor = " ".join(rng.choices(self.vocabulary, cum_weights=self.weights, k=2))
+            links.append(f'<a href="{self.url(target_site, rng.randrange(self.pages_per_site))}">{anchor}</a>')
+
+        return f"""<html><head><title>{title}</title><meta name="description" content="{title}"></head>
+<body><p>{text}</p>{"".join(links)}</body></html>"""
+
+    async def __handle_page(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        site = request.url.port - self.port
+        page = int(request.match_info['page'])
+        if not 0 <= page < self.pages_per_site: raise web.HTTPNotFound()
+        return web.Response(text=self.page(site, page), content_type='text/html')
+
+    async def __handle_robots(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        delay = f"Crawl-delay: {self.crawl_delay}\n" if self.crawl_delay else ""
+        return web.Response(text=f"User-agent: *\nDisallow: /private\n{delay}", content_type='text/plain')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/page/{page}', self.__handle_page)
+        app.router.add_get('/robots.txt', self.__handle_robots)
+
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        for site in range(self.sites):
+            await web.TCPSite(self.__runner, '127.0.0.1', self.port + site).start()
+
+    async def stop(self):
+        if self.__runner is not None: await self.__runner.cleanup()
+
+
+class MemoryCollection:
+    """
+    Stand-in for the `pages` and `duplicates` collections. Nothing reads them back during a run,
+    the bulk writes of the indexer and the ranker are only counted by kind of operation.
+    """
+
+    def __init__(self):
+        self.writes: Counter[str] = Counter()
+
+    async def bulk_write(self, operations: list[UpdateOne | DeleteOne], ordered: bool = True):
+        self.writes.update(type(operation).__name__ for operation in operations)
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    if not samples: return {}
+    values = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max())
+    }
+
+
+class Benchmark:
+    """
+    Throughput of the crawl, index, rank and search paths against a SyntheticWeb. Runs on the
+    local Redis and Mongo (a dedicated Redis db and the `searchengine_benchmark` database) or on
+    in-memory stand-ins. Files go to a temporary directory, results are returned as a dict
+    ready to be dumped as JSON.
+    """
+
+    sections = ['crawl', 'index', 'query', 'rank', 'rank_scaling', 'enqueue']
+
+    def __init__(self, web: SyntheticWeb, backend: str = 'memory', redis_db: int = 15, flush: bool = False, crawlers: int = 64, max_pages: int = 2000, duration: float = 60, idle: float = 3, index_batch: int = 100, queries: int = 500, graph_sizes: tuple[int, ...] = (10_000, 100_000, 1_000_000), graph_fanout: int = 10, enqueue_urls: int = 20_000, seed: int = 0):
+        self.web = web
+        self.backend = backend
+        self.redis_db = redis_db
+        self.flush = flush
+        self.crawlers = crawlers
+        self.max_pages = max_pages
+        self.duration = duration
+        self.idle = idle
+        self.index_batch = index_batch
+        self.queries = queries
+        self.graph_sizes = graph_sizes
+        self.graph_fanout = graph_fanout
+        self.enqueue_urls = enqueue_urls
+        self.seed = seed
+
+        self.path = tempfile.mkdtemp(prefix='searchengine-benchmark-')
+        self.index = SegmentIndexBackend(os.path.join(self.path, 'index'))
+        self.link_graph = LinkGraph(os.path.join(self.path, 'graph'))
+        self.rank_path = os.path.join(self.path, 'ranks')
+
+        self.__server = None
+        self.__mongo = None
+
+    def __connect(self):
+        if self.backend == 'memory':
+            # Only needed for this backend, Lua scripts also need `lupa`
+            import fakeredis
+            import fakeredis.aioredis
+
+            self.__server = fakeredis.FakeServer()
+            r = fakeredis.FakeRedis(server=self.__server, decode_responses=True)
+            raw = fakeredis.FakeRedis(server=self.__server)
+            self.db = {"searchengine": {"pages": MemoryCollection(), "duplicates": MemoryCollection()}}
+        else:
+            r = redis.Redis(host='localhost', port=6379, db=self.redis_db, decode_responses=True)
+            raw = redis.Redis(host='localhost', port=6379, db=self.redis_db)
+            if raw.dbsize():
+                if not self.flush: raise RuntimeError(f"Redis db {self.redis_db} is not empty, pass flush to clear it")
+                raw.flushdb()
+
+            # The indexer and the ranker write to db["searchengine"], point it at a database of its own
+            self.__mongo = AsyncMongoClient("mongodb://localhost:27017/")
+            self.db = {"searchengine": self.__mongo["searchengine_benchmark"]}
+
+        # The default Redis bloom filter, checked by the enqueue script. A small first filter so the runs also go
+        # through its growth, and no snapshot of a real crawl to take over
+        dedup = RedisBloomDedup(r, initial_capacity=max(self.enqueue_urls // 4, 1000), snapshot_path=os.path.join(self.path, 'seen_urls.bloom'))
+        self.manager = QueueManager(dedup=dedup, r=r, raw=raw, seed_urls=self.web.seed_urls())
+        # The synthetic sites can take every request, only their own crawl delay applies
+        self.manager.default_cooldown = 0
+
+    def __queue(self) -> AsyncQueueManager:
+        if self.__server is not None:
+            import fakeredis.aioredis
+            return AsyncQueueManager(self.manager, r=fakeredis.aioredis.FakeRedis(server=self.__server))
+        return AsyncQueueManager(self.manager, max_connections=max(self.crawlers, 8), db=self.redis_db)
+
+    async def crawl(self) -> dict:
+        crawler = Crawler(high_priority=False, max_concurrent=self.crawlers, policy=PriorityPolicy(0.5))
+        requests = self.web.requests
+
+        async with self.__queue() as queue:
+            start = time.perf_counter()
+            last_progress = start
+            queued = 0
+            task = asyncio.create_task(crawler.crawl(queue))
+
+            while not task.done():
+                await asyncio.sleep(0.2)
+                now = time.perf_counter()
+                count = await queue.r.xlen(INDEXING_STREAM)
+                if count != queued: queued, last_progress = count, now
+                if queued >= self.max_pages or now - start >= self.duration or now - last_progress >= self.idle: break
+
+            # The time spent waiting for pages that never came doesn't count
+            elapsed = last_progress - start
+            self.manager.interrupted = True
+            await task
+            self.manager.interrupted = False
+
+        return {
+            "pages": queued,
+            "seconds": elapsed,
+            "pages_per_second": queued / elapsed if elapsed else 0.0,
+            "http_requests": self.web.requests - requests,
+            "robots": crawler.robots.stats()
+        }
+
+    async def index_pages(self) -> dict:
+        # Loaded before the clock starts, it takes a few seconds
+        await asyncio.to_thread(resources.get, 'tokenizer')
+        indexer = Indexer(db=self.db, index_backend=self.index, link_graph=self.link_graph, max_concurrent=self.index_batch)
+
+        async with self.__queue() as queue:
+            pages = await queue.r.xlen(INDEXING_STREAM)
+            start = time.perf_counter()
+            task = asyncio.create_task(indexer.index(queue))
+
+            # Done once every page was handed out, the indexer finishes the last ones before returning
+            while not task.done() and time.perf_counter() - start < self.duration:
+                await asyncio.sleep(0.1)
+                pending = await queue.r.xpending(INDEXING_STREAM, INDEXER_GROUP)
+                if await queue.r.xlen(INDEXING_STREAM) <= pending['pending']: break
+
+            self.manager.interrupted = True
+            await task
+            elapsed = time.perf_counter() - start
+            self.manager.interrupted = False
+            left = await queue.r.xlen(INDEXING_STREAM)
+
+        indexed = indexer.batcher.flushed_pages
+        return {
+            "queued_pages": pages,
+            "pages": indexed,
+            "unacknowledged": left,
+            "seconds": elapsed,
+            "pages_per_second": indexed / elapsed if elapsed else 0.0,
+            "segments": len(self.index.segments),
+            "batcher": indexer.batcher.stats()
+        }
+
+    async def query(self) -> dict:
+        tokenizer = await asyncio.to_thread(resources.get, 'tokenizer')
+        engine = QueryEngine(self.index, rank_path=self.rank_path, graph_path=self.link_graph.path)
+        rng = random.Random(self.seed)
+
+        results = {}
+        for name, conjunctive in [('conjunctive', True), ('disjunctive', False)]:
+            samples = []
+            for _ in range(self.queries):
+                words = rng.choices(self.web.vocabulary, cum_weights=self.web.weights, k=rng.randint(1, 3))
+                start = time.perf_counter()
+                terms = tokenizer.clean_and_tokenize(" ".join(words))
+                engine.search(terms, 0, 10, conjunctive=conjunctive)
+                samples.append(time.perf_counter() - start)
+            results[name] = percentiles(samples)
+            results[name]["queries_per_second"] = len(samples) / sum(samples) if samples else 0.0
+        return results
+
+    async def rank(self) -> dict:
+        ranker = Ranker(db=self.db, iterations=100, link_graph=self.link_graph, path=self.rank_path)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        await ranker.PageRank()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        state = RankState.load(self.rank_path)
+        return {
+            "pages": len(state.ranks) if state is not None else 0,
+            "links": len(state.sources) if state is not None else 0,
+            "seconds": elapsed,
+            "peak_memory_bytes": peak
+        }
+
+    async def rank_scaling(self) -> list[dict]:
+        return await asyncio.to_thread(self.__rank_scaling)
+
+    def __rank_scaling(self) -> list[dict]:
+        rng = np.random.default_rng(self.seed)
+        results = []
+
+        for pages in self.graph_sizes:
+            # A few pages get most of the links, like on the web
+            sources = np.repeat(np.arange(pages, dtype=np.uint32), self.graph_fanout)
+            targets = (np.minimum(rng.pareto(1.2, len(sources)) * pages / 100, pages - 1)).astype(np.uint32)
+            rng.shuffle(targets)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            matrix, out_degree = build_matrix(sources, targets, pages)
+            built = time.perf_counter()
+            _, iterations = pagerank(matrix, out_degree)
+            ranked = time.perf_counter()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results.append({
+                "pages": pages,
+                "links": int(matrix.nnz),
+                "build_seconds": built - start,
+                "rank_seconds": ranked - built,
+                "iterations": iterations,
+                "matrix_bytes": int(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes),
+                "peak_memory_bytes": peak
+            })
+        return results
+
+    async def enqueue(self) -> dict:
+        batch = 50
+        urls = [f"http://enqueue-{i % 1000}.example/{i}" for i in range(self.enqueue_urls)]
+        high = low = 0
+
+        async with self.__queue() as queue:
+            start = time.perf_counter()
+            for i in range(0, len(urls), batch):
+                queued_high, queued_low = await queue.queue(urls[i:i + batch])
+                high += queued_high
+                low += queued_low
+            elapsed = time.perf_counter() - start
+
+        return {
+            "urls": len(urls),
+            "batch_size": batch,
+            "seconds": elapsed,
+            "urls_per_second": len(urls) / elapsed if elapsed else 0.0,
+            "calls_per_second": len(urls) / batch / elapsed if elapsed else 0.0,
+            "high_priority": high,
+            "low_priority": low,
+            "dedup": self.manager.dedup.stats()
+        }
+
+    def environment(self) -> dict:
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except Exception:
+            commit = None
+
+        return {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "commit": commit or None,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": self.backend
+        }
+
+    async def run(self, sections: list[str] | None = None) -> dict:
+        """Runs the `sections` in order, a section that fails records its error and the others still run."""
+        sections = sections or self.sections
+        results = {
+            "environment": self.environment(),
+            "config": {
+                "sites": self.web.sites, "pages_per_site": self.web.pages_per_site, "fanout": self.web.fanout,
+                "words": self.web.words, "crawl_delay": self.web.crawl_delay, "crawlers": self.crawlers,
+                "max_pages": self.max_pages, "index_batch": self.index_batch, "queries": self.queries,
+                "graph_sizes": list(self.graph_sizes), "graph_fanout": self.graph_fanout, "enqueue_urls": self.enqueue_urls
+            },
+            "results": {}
+        }
+
+        self.__connect()
+        if self.__mongo is not None:
+            await self.db["searchengine"]["pages"].drop()
+            await self.db["searchengine"]["duplicates"].drop()
+        await self.web.start()
+        runs = {'crawl': self.crawl, 'index': self.index_pages, 'query': self.query, 'rank': self.rank, 'rank_scaling': self.rank_scaling, 'enqueue': self.enqueue}
+
+        try:
+            for section in sections:
+                print(f"Benchmarking {section}...")
+                try:
+                    results["results"][section] = await runs[section]()
+                except Exception as e:
+                    print(f"{section} failed: {e}")
+                    results["results"][section] = {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            await self.web.stop()
+            if self.__mongo is not None: await self.__mongo.close()
+            await asyncio.to_thread(self.index.wait_for_merges)
+            await asyncio.to_thread(self.link_graph.wait_for_merges)
+            shutil.rmtree(self.path, ignore_errors=True)
+
+        return results
@@ -1,58 +1,85 @@
 import asyncio
 import threading
+import time
+import urllib.parse
 import aiohttp
-from lxml import html
-from src.Queue import QueueManager
-from src.helpers.DomainExtractor import extract_domain, find_robots_txt
+from src.Frontier import Frontier, PriorityPolicy
+from src.Metrics import metrics
+from src.Queue import AsyncQueueManager
+from src.RobotsCache import RobotsCache
+from src.helpers.DomainExtractor import CleanUrl
+from src.helpers.HtmlExtractor import PageExtractor, StreamingExtractor
+
+FETCH_SECONDS = metrics.histogram('crawler_fetch_seconds', "Time to download and parse a page")
+PARSE_SECONDS = metrics.histogram('crawler_parse_seconds', "Time spent parsing a page")
+FETCHES = {result: metrics.counter('crawler_fetches_total', "Fetched urls by result", result=result) for result in ('ok', 'status', 'not_html', 'timeout', 'error')}
 
 class Crawler:
     user_agent = '*'
     headers = {'User-Agent': 'NoAICrawler'}
 
-    def __init__(self, high_priority: bool, max_concurrent=8):
+    def __init__(self, high_priority: bool, max_concurrent=8, robots: RobotsCache | None = None, max_page_bytes: int = 2 * 1024 * 1024, limit_per_host: int = 8, policy: PriorityPolicy | None = None):
         self.max_concurrent = max_concurrent
+        self.max_page_bytes = max_page_bytes
+        self.limit_per_host = limit_per_host
         self.high_priority = high_priority
+        # A crawler taking from both queues (single event loop mode) passes its own policy
+        self.policy = policy if policy is not None else PriorityPolicy(high_share=1.0 if high_priority else 0.0)
+        self.robots = robots if robots is not None else RobotsCache(user_agent=self.user_agent, headers=self.headers)
 
-    async def fetch_url(self, session: aiohttp.ClientSession, url: str, queue: QueueManager) -> str | None:
+    async def fetch_url(self, session: aiohttp.ClientSession, url: str) -> PageExtractor | None:
+        # Robots rules and cooldowns were already checked by the frontier
         try:
-            robots_url = find_robots_txt(url)
-            domain = extract_domain(url)
-
-            if(queue.check_robots(domain)):
-                async with session.get(robots_url, timeout=aiohttp.ClientTimeout(total=5), headers=self.headers) as robots_response:
-                    queue.save_robots_txt(domain, await robots_response.text())
-            
-            rp = queue.get_robots(domain)
-            
-            if(rp.crawl_delay(self.user_agent)): print(f"delay for {url}: {rp.crawl_delay(self.user_agent)}")
-
-            cooldown = queue.get_next_cooldown(domain, rp.crawl_delay(self.user_agent))
-            if(rp.can_fetch(url, self.user_agent)):
-                if(cooldown > 0): 
-                    # print(f"Sleeping for: {cooldown} seconds")
-                    await asyncio.sleep(cooldown)
-                try:
-                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=5), headers=self.headers) as response:
-                        if response.status == 200:
-                            # print(f"{threading.current_thread().name} Crawled: {url}")
-                            return await response.text()
+            with FETCH_SECONDS.time():
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=5), headers=self.headers) as response:
+                    if response.status != 200:
+                        FETCHES['status'].inc()
+                        return None
+                    if 'html' not in response.content_type:
+                        FETCHES['not_html'].inc()
                         return None
-                except asyncio.TimeoutError as e:
-                    return None
-                except Exception as e:
-                    return None
-                
+
+                    # Parse while the body streams in, anything past max_page_bytes is never downloaded
+                    extractor = StreamingExtractor(max_bytes=self.max_page_bytes, encoding=response.charset)
+                    parsing = 0.0
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        start = time.perf_counter()
+                        extractor.feed(chunk)
+                        parsing += time.perf_counter() - start
+                        if extractor.full: break
+
+                    start = time.perf_counter()
+                    page = extractor.close()
+                    PARSE_SECONDS.observe(parsing + time.perf_counter() - start)
+                    FETCHES['ok'].inc()
+                    return page
+        except asyncio.TimeoutError as e:
+            FETCHES['timeout'].inc()
+            return None
         except Exception as e:
-            print(e)
+            FETCHES['error'].inc()
             return None
 
-    async def crawl(self, manager: QueueManager):
+    async def worker(self, session: aiohttp.ClientSession, frontier: Frontier, manager: AsyncQueueManager):
+        while not manager.interrupted:
+            url = await frontier.get()
+            if url is None: continue
+
+            try:
+                await self.process_url(session, url, manager)
+            except Exception as e:
+                print(e)
+            finally:
+                frontier.done(url)
+
+    async def crawl(self, manager: AsyncQueueManager):
         resolver = aiohttp.AsyncResolver()
 
+        # One connection per crawl slot, the slots are shared by every host
         connector = aiohttp.TCPConnector(
             resolver=resolver,
-            limit=10000,
-            limit_per_host=100,
+            limit=self.max_concurrent,
+            limit_per_host=self.limit_per_host,
             ttl_dns_cache=300,
             use_dns_cache=True,
             keepalive_timeout=30,
@@ -63,69 +90,42 @@ class Crawler:
         timeout = aiohttp.ClientTimeout(total=2, connect=1)
 
         async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            while not manager.interrupted:
-                if(manager.interrupted): break
-                urls_batch = []
-                if self.high_priority: urls_batch = manager.get_high_priority_url(self.max_concurrent)
-                else: urls_batch = manager.get_low_priority_url(self.max_concurrent)
-                
-                if not urls_batch:
-                    await asyncio.sleep(0.001)
-                    continue
-                
-                tasks = [self.process_url(session, url, manager) for url in urls_batch]
-                await asyncio.gather(*tasks, return_exceptions=True)
+            frontier = Frontier(manager, self.robots, session, self.policy, max_buffered=10 * self.max_concurrent, user_agent=self.user_agent)
+
+            # Every slot takes the next url that can be fetched right away, none of them sleeps on a cooldown
+            await asyncio.gather(*[self.worker(session, frontier, manager) for _ in range(self.max_concurrent)])
+
+            await frontier.close()
             
             print(f"{threading.current_thread().name} interrupted...")
         pass
         
 
-    def index(self, url: str, all_text: str, title: str, description: str, outgoing_links: list[str]):
+    def index(self, url: str, all_text: str, title: str, description: str, outgoing_links: list[tuple[str, str]]):
         try:
             self.indexer.index_html(url=url, text=all_text, title=title, description=description, outgoing_links=outgoing_links)
         except Exception as e:
             print(e)
 
-    async def process_url(self, session: aiohttp.ClientSession, url: str, manager: QueueManager):
+    async def process_url(self, session: aiohttp.ClientSession, url: str, manager: AsyncQueueManager):
     
-        response = await self.fetch_url(session, url, manager)
+        page = await self.fetch_url(session, url)
 
-        if response is None: 
+        if page is None: 
             return
 
-        tree = html.fromstring(response)
-
-        links = tree.xpath('//a/@href')
-
-        elements = tree.xpath('//p | //h1 | //h2 | //h3 | //h4 | //h5 | //h6 | //a')
-
-        title = tree.xpath("//title/text()")[0]
-
-        description = ''
-        description_element = tree.xpath("//meta[@name='description']")
-
-        if description_element:
-            description = description_element[0].get('content')
-
-        all_text = ''
-
-        for element in  elements:
-            all_text = all_text + element.text_content()
-        
-        hrefs = []
-        outgoing_links: list[str] = []
-        outgoing_domains: list[str] = []
-
-        for link in links:
-            if str(link).startswith('http'):
-                link_domain = extract_domain(link)
+        hrefs: list[str] = []
+        # Every distinct page linked to, same domain links included, with its anchor text
+        outgoing_links: dict[str, str] = {}
 
-                if(not link_domain in outgoing_domains):
-                    outgoing_domains.append(link_domain)
-                    if(not link_domain == extract_domain(url)): outgoing_links.append(link)
+        for href, anchor in page.links.items():
+            # Relative links are resolved against the page, fragments point to the same page
+            link = CleanUrl(urllib.parse.urldefrag(urllib.parse.urljoin(url, href.strip()))[0])
+            if not link.startswith('http'): continue
 
-                hrefs.append(link)
+            if link not in outgoing_links: hrefs.append(link)
+            if link not in outgoing_links or not outgoing_links[link]: outgoing_links[link] = anchor
 
-        manager.queue_index(url=url, title=title, description=description, outgoing=outgoing_links, text=all_text)
+        await manager.queue_index(url=url, title=page.title, description=page.description, outgoing=list(outgoing_links.items()), text=page.text)
 
-        manager.queue(hrefs)
\ No newline at end of file
+        await manager.queue(hrefs)
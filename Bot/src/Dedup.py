@@ -0,0 +1,320 @@
+import math
+import os
+import threading
+import time
+import redis
+
+from src.helpers.BloomFilter import ScalableBloomFilter, filter_size, hash_pair, positions
+
+DEFAULT_BLOOM_PATH = os.environ.get(
+    'SEARCHENGINE_BLOOM_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'seen_urls.bloom')
+)
+
+# Redis numbers the bits of a byte from the most significant one, the in-process filter from the least
+REVERSED_BITS = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+# Scalable bloom filter in Redis bitmaps, for scripts that check and mark items atomically.
+# KEYS[meta] is a hash with the number of filters and the item count of each, the bitmap of each
+# filter follows it. ARGV[header] is how many filters the caller gave bit positions for, then
+# the capacity and hash count of each. Every item is followed by its positions in those filters.
+BLOOM_FUNCTIONS = """
+local function bloom_open(meta, header)
+    local bloom = {meta = KEYS[meta], first = meta + 1, given = tonumber(ARGV[header]), capacities = {}, hashes = {}, offsets = {}, width = 0}
+    for f = 0, bloom.given - 1 do
+        bloom.capacities[f] = tonumber(ARGV[header + 1 + 2 * f])
+        bloom.hashes[f] = tonumber(ARGV[header + 2 + 2 * f])
+        bloom.offsets[f] = bloom.width
+        bloom.width = bloom.width + bloom.hashes[f]
+    end
+    bloom.args = header + 1 + 2 * bloom.given
+    bloom.filters = tonumber(redis.call('HGET', bloom.meta, 'filters') or '0')
+    bloom.count = 0
+    if bloom.filters > 0 then bloom.count = tonumber(redis.call('HGET', bloom.meta, 'count:' .. (bloom.filters - 1)) or '0') end
+    return bloom
+end
+
+-- Adds the item at ARGV[arg] unless a filter may already have it, returns whether it was new
+local function bloom_add(bloom, arg)
+    for f = 0, bloom.filters - 1 do
+        local found = true
+        for h = 1, bloom.hashes[f] do
+            if redis.call('GETBIT', KEYS[bloom.first + f], ARGV[arg + bloom.offsets[f] + h]) == 0 then
+                found = false
+                break
+            end
+        end
+        if found then return false end
+    end
+
+    -- A full filter gets a bigger one after it
+    local current = bloom.filters - 1
+    if current < 0 or (bloom.count >= bloom.capacities[current] and bloom.filters < bloom.given) then
+        current = bloom.filters
+        bloom.filters = bloom.filters + 1
+        bloom.count = 0
+        redis.call('HSET', bloom.meta, 'filters', bloom.filters)
+    end
+
+    for h = 1, bloom.hashes[current] do
+        redis.call('SETBIT', KEYS[bloom.first + current], ARGV[arg + bloom.offsets[current] + h], 1)
+    end
+    bloom.count = bloom.count + 1
+    redis.call('HINCRBY', bloom.meta, 'count:' .. current, 1)
+    return true
+end
+"""
+
+# Returns the number of filters, then 1 for each new item. -1 if the filter grew past the positions given
+SEEN_SCRIPT = BLOOM_FUNCTIONS + """
+local bloom = bloom_open(1, 1)
+if bloom.filters > bloom.given then return {-1, bloom.filters} end
+local added = {}
+for i = bloom.args, #ARGV, bloom.width + 1 do
+    table.insert(added, bloom_add(bloom, i) and 1 or 0)
+end
+table.insert(added, 1, bloom.filters)
+return added
+"""
+
+
+class Dedup:
+    """
+    Keeps track of the urls seen so far, `add_many` checks and adds a whole batch at once.
+    `contains_many` only checks, for urls that are marked as seen once they were queued.
+    """
+
+    def add_many(self, urls: list[str]) -> list[bool]:
+        raise NotImplementedError
+
+    def contains_many(self, urls: list[str]) -> list[bool]:
+        raise NotImplementedError
+
+    def enqueue_arguments(self, urls: list[str]) -> tuple[str, list[str], list] | None:
+        """Mode, keys and arguments for the enqueue script to check and mark the urls itself, None to check them here."""
+        return None
+
+    def stats(self) -> dict[str, float]:
+        return {}
+
+    def close(self):
+        pass
+
+
+class RedisSetDedup(Dedup):
+    """Exact, every url is kept in the `seen_urls` Redis set."""
+
+    def __init__(self, r: redis.Redis, key: str = 'seen_urls'):
+        self.r = r
+        self.key = key
+
+    def add_many(self, urls: list[str]) -> list[bool]:
+        # SADD returns 1 only for new members, so checking and adding is a single atomic command per url
+        pipe = self.r.pipeline(transaction=False)
+        for url in urls:
+            pipe.sadd(self.key, url)
+        return [added == 1 for added in pipe.execute()]
+
+    def contains_many(self, urls: list[str]) -> list[bool]:
+        if not urls: return []
+        return [bool(member) for member in self.r.smismember(self.key, urls)]
+
+    def enqueue_arguments(self, urls: list[str]) -> tuple[str, list[str], list] | None:
+        return 'set', [self.key], urls
+
+    def stats(self) -> dict[str, float]:
+        return {"urls": self.r.scard(self.key)}
+
+
+class RedisBloomDedup(Dedup):
+    """
+    Scalable bloom filter in Redis bitmaps, `seen_bloom:<n>` with the counts in the `seen_bloom`
+    hash, shared by every crawler thread and process. Bit positions are computed here and the
+    enqueue script checks and marks the urls as it queues them. When the filter is created it
+    takes over the urls of the in-process filter snapshot and of the `seen_urls` set, if any.
+    """
+
+    def __init__(self, r: redis.Redis, key: str = 'seen_bloom', initial_capacity: int = 10_000_000, error_rate: float = 0.001, snapshot_path: str = DEFAULT_BLOOM_PATH):
+        # `r` decodes responses
+        self.r = r
+        self.key = key
+        self.__add = r.register_script(SEEN_SCRIPT)
+        # Capacity, size and hash count of each filter
+        self.__sizes: list[tuple[int, int, int]] = []
+
+        settings = r.hgetall(key)
+        if settings:
+            self.filter = ScalableBloomFilter(int(settings['initial_capacity']), float(settings['error_rate']), int(settings['growth']), float(settings['tightening']))
+            self.filters = int(settings.get('filters', 0))
+        else:
+            self.filter = ScalableBloomFilter(initial_capacity=initial_capacity, error_rate=error_rate)
+            self.filters = 0
+            self.__migrate(os.path.abspath(snapshot_path))
+
+    def __save_settings(self, mapping: dict):
+        self.r.hset(self.key, mapping={
+            'initial_capacity': self.filter.initial_capacity,
+            'error_rate': self.filter.error_rate,
+            'growth': self.filter.growth,
+            'tightening': self.filter.tightening,
+            **mapping
+        })
+
+    def __migrate(self, snapshot_path: str):
+        if os.path.exists(snapshot_path):
+            self.filter = ScalableBloomFilter.load(snapshot_path)
+            pipe = self.r.pipeline(transaction=True)
+            for i, bloom in enumerate(self.filter.filters):
+                pipe.set(f"{self.key}:{i}", bytes(bloom.bits).translate(REVERSED_BITS))
+            pipe.execute()
+
+            self.filters = len(self.filter.filters)
+            self.__save_settings({'filters': self.filters, **{f"count:{i}": bloom.count for i, bloom in enumerate(self.filter.filters)}})
+            print(f"Moved the {len(self.filter)} seen urls of {snapshot_path} to Redis")
+        else:
+            self.__save_settings({'filters': 0})
+
+        # Urls of the set used by the crawler processes before
+        batch, moved = [], 0
+        for url in self.r.sscan_iter('seen_urls', count=10_000):
+            batch.append(url)
+            if len(batch) >= 10_000:
+                moved += sum(self.add_many(batch))
+                batch = []
+        moved += sum(self.add_many(batch))
+        if moved: print(f"Moved {moved} seen urls of the seen_urls set to the bloom filter, the set can be deleted")
+
+    def __filter_sizes(self, count: int) -> list[tuple[int, int, int]]:
+        while len(self.__sizes) < count:
+            capacity, error_rate = self.filter.filter_parameters(len(self.__sizes))
+            self.__sizes.append((capacity, *filter_size(capacity, error_rate)))
+        return self.__sizes[:count]
+
+    def __arguments(self, items: list[str]) -> tuple[list[str], list]:
+        # Positions in the new filters the script may have to start too, as many as the items can fill
+        count = self.filters + 1
+        while len(items) > sum(capacity for capacity, _, _ in self.__filter_sizes(count)[self.filters:]): count += 1
+        sizes = self.__filter_sizes(count)
+        keys = [self.key] + [f"{self.key}:{i}" for i in range(len(sizes))]
+        args = [len(sizes)]
+        for capacity, _, hashes in sizes: args += [capacity, hashes]
+        for item in items:
+            hashes = hash_pair(item)
+            args.append(item)
+            for _, size, count in sizes: args += positions(hashes, size, count)
+        return keys, args
+
+    def enqueue_arguments(self, urls: list[str]) -> tuple[str, list[str], list] | None:
+        return 'bloom', *self.__arguments(urls)
+
+    def add_many(self, urls: list[str]) -> list[bool]:
+        if not urls: return []
+        while True:
+            keys, args = self.__arguments(urls)
+            result = self.__add(keys=keys, args=args)
+            # Another process started a filter since, the positions are computed for it as well
+            if result[0] < 0: self.filters = result[1]
+            else:
+                self.filters = result[0]
+                return [added == 1 for added in result[1:]]
+
+    def contains_many(self, urls: list[str]) -> list[bool]:
+        if not urls: return []
+        self.filters = int(self.r.hget(self.key, 'filters') or 0)
+        sizes = self.__filter_sizes(self.filters)
+
+        pipe = self.r.pipeline(transaction=False)
+        for url in urls:
+            hashes = hash_pair(url)
+            for i, (_, size, count) in enumerate(sizes):
+                for position in positions(hashes, size, count): pipe.getbit(f"{self.key}:{i}", position)
+        bits = iter(pipe.execute())
+
+        # A url may be in any filter of the chain, in one if all of its bits there are set
+        found = []
+        for _ in urls:
+            found.append(any([all([next(bits) for _ in range(count)]) for _, _, count in sizes]))
+        return found
+
+    def stats(self) -> dict[str, float]:
+        settings = self.r.hgetall(self.key)
+        self.filters = int(settings.get('filters', 0))
+        sizes = self.__filter_sizes(self.filters)
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(self.filters): pipe.bitcount(f"{self.key}:{i}")
+        fill_ratios = [bits / size for bits, (_, size, _) in zip(pipe.execute(), sizes)]
+
+        # An item is a false positive if any filter has all of its bits set
+        missed = math.prod(1 - fill ** hashes for fill, (_, _, hashes) in zip(fill_ratios, sizes))
+        return {
+            "urls": sum(int(settings.get(f"count:{i}", 0)) for i in range(self.filters)),
+            "filters": self.filters,
+            "fill_ratio": fill_ratios[-1] if fill_ratios else 0.0,
+            "false_positive_rate": 1 - missed
+        }
+
+
+class BloomDedup(Dedup):
+    """
+    In-process scalable bloom filter, snapshotted to disk every `snapshot_interval` seconds.
+    A false positive drops a url that was never crawled, at a rate of at most `error_rate`.
+    """
+
+    def __init__(self, path: str = DEFAULT_BLOOM_PATH, initial_capacity: int = 10_000_000, error_rate: float = 0.001, snapshot_interval: float = 60, seed: redis.Redis | None = None):
+        self.path = os.path.abspath(path)
+        self.snapshot_interval = snapshot_interval
+        self.__lock = threading.Lock()
+        # One snapshot written at a time
+        self.__save_lock = threading.Lock()
+        self.__last_snapshot = time.time()
+
+        if os.path.exists(self.path):
+            self.filter = ScalableBloomFilter.load(self.path)
+        else:
+            self.filter = ScalableBloomFilter(initial_capacity=initial_capacity, error_rate=error_rate)
+            # Carry over the urls of the Redis set used before the filter
+            if seed is not None: self.__seed(seed)
+
+    def __seed(self, r: redis.Redis):
+        batch = []
+        for url in r.sscan_iter('seen_urls', count=10_000):
+            batch.append(url)
+            if len(batch) >= 10_000:
+                self.filter.add_many(batch)
+                batch = []
+        self.filter.add_many(batch)
+
+    def add_many(self, urls: list[str]) -> list[bool]:
+        with self.__lock:
+            added = self.filter.add_many(urls)
+            snapshot = time.time() - self.__last_snapshot >= self.snapshot_interval
+            if snapshot: self.__last_snapshot = time.time()
+
+        # Writing the filter takes a while, the crawler's event loop doesn't wait for it
+        if snapshot: threading.Thread(target=self.snapshot, name="bloom-snapshot", daemon=True).start()
+        return added
+
+    def contains_many(self, urls: list[str]) -> list[bool]:
+        with self.__lock:
+            return [self.filter.contains(url) for url in urls]
+
+    def snapshot(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.__save_lock:
+            # Copying the bits is quick, adds only wait for that
+            with self.__lock:
+                copy = self.filter.copy()
+            copy.save(self.path)
+
+    def stats(self) -> dict[str, float]:
+        with self.__lock:
+            return {
+                "urls": len(self.filter),
+                "filters": len(self.filter.filters),
+                "fill_ratio": self.filter.fill_ratio(),
+                "false_positive_rate": self.filter.false_positive_rate()
+            }
+
+    def close(self):
+        self.snapshot()
+        print(f"Saved seen urls: {self.stats()}")
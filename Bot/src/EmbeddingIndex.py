@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import numpy as np
+
+from src.InvertedIndex import DocTable
+from src.Resources import resources
+
+DEFAULT_EMBEDDING_PATH = os.environ.get(
+    'SEARCHENGINE_EMBEDDING_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'embeddings')
+)
+
+
+def page_text(title: str, description: str, text: str, max_chars: int = 1000) -> str:
+    # The model only reads the first few hundred tokens, the start of the page is what matters
+    return " ".join(" ".join([title, description, text[:max_chars]]).split())
+
+
+class EmbeddingIndex:
+    """
+    Normalized page embeddings in a memory mapped matrix, one row per id of a doc table. Rows are
+    stored as float16, or as int8 scaled by 127 at a quarter of the float32 size. Rows are written
+    before the doc table is synced, so a reader never sees an id without its vector.
+    """
+
+    def __init__(self, path: str = DEFAULT_EMBEDDING_PATH, dim: int = 384, dtype: str = 'int8'):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            # The matrix keeps the format it was created with
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            dim, dtype = meta['dim'], meta['dtype']
+        else:
+            with open(meta_path, 'w', encoding='utf-8') as file:
+                json.dump({"dim": dim, "dtype": dtype}, file)
+
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self.docs = DocTable(os.path.join(self.path, 'docs.tsv'))
+        self.__vectors_path = os.path.join(self.path, 'vectors.bin')
+        self.__matrix: np.ndarray | None = None
+        self.__lock = threading.Lock()
+        self.__encode_lock = threading.Lock()
+
+        self.docs.load()
+
+    def __encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8: return np.clip(np.rint(vectors * 127), -127, 127).astype(np.int8)
+        return vectors.astype(self.dtype)
+
+    def add(self, urls: list[str], vectors: np.ndarray):
+        """Stores the normalized `vectors` of `urls`, replacing the rows of pages embedded before."""
+        rows = self.__encode(vectors)
+
+        with self.__lock:
+            ids = [self.docs.assign(url, 0) for url in urls]
+
+            mode = 'r+b' if os.path.exists(self.__vectors_path) else 'w+b'
+            with open(self.__vectors_path, mode) as file:
+                for doc_id, row in zip(ids, rows):
+                    file.seek(doc_id * self.row_bytes)
+                    file.write(row.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.docs.sync()
+
+    def embed(self, urls: list[str], texts: list[str], batch_size: int = 32):
+        """Encodes the pages on the CPU in batches and stores their vectors."""
+        model = resources.get('embedding_model')
+
+        # The model already uses every core, the indexer threads take turns
+        with self.__encode_lock:
+            vectors = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True, device='cpu')
+
+        self.add(urls, vectors)
+
+    def matrix(self) -> np.ndarray:
+        # Mapped again once the file grew, the pages keep being shared with the OS cache
+        self.docs.load()
+        try:
+            rows = min(os.path.getsize(self.__vectors_path) // self.row_bytes, len(self.docs))
+        except FileNotFoundError:
+            rows = 0
+
+        matrix = self.__matrix
+        if matrix is None or len(matrix) != rows:
+            matrix = np.memmap(self.__vectors_path, dtype=self.dtype, mode='r', shape=(rows, self.dim)) if rows else np.zeros((0, self.dim), dtype=self.dtype)
+            self.__matrix = matrix
+        return matrix
+
+    def similarities(self, query: np.ndarray, urls: list[str]) -> np.ndarray:
+        """Cosine similarity of the normalized `query` with each url, 0 for pages without a vector."""
+        matrix = self.matrix()
+        rows = np.array([self.docs.ids.get(url, -1) for url in urls], dtype=np.int64)
+        known = (rows >= 0) & (rows < len(matrix))
+
+        similarities = np.zeros(len(urls), dtype=np.float32)
+        if known.any():
+            vectors = matrix[rows[known]].astype(np.float32)
+            if self.dtype == np.int8: vectors /= 127
+            similarities[known] = vectors @ query.astype(np.float32)
+        return similarities
+
+    def rerank(self, query: np.ndarray, results: list[tuple[str, float]], weight: float = 0.5) -> list[tuple[str, float]]:
+        """Rescores lexical (url, score) results, mixing the normalized lexical score and the cosine similarity by `weight`."""
+        if not results: return results
+
+        urls = [url for url, _ in results]
+        scores = np.array([score for _, score in results], dtype=np.float32)
+        lexical = scores / scores.max() if scores.max() > 0 else scores
+
+        combined = (1 - weight) * lexical + weight * self.similarities(query, urls)
+        order = np.argsort(-combined, kind='stable')
+        return [(urls[i], float(combined[i])) for i in order]
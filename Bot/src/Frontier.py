@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import time
+from collections import deque
+import aiohttp
+
+from src.Queue import AsyncQueueManager
+from src.RobotsCache import RobotsCache
+from src.helpers.DomainExtractor import extract_domain
+
+class PriorityPolicy:
+    """Share of the urls taken from the high priority queue, the rest come from the low priority one."""
+
+    def __init__(self, high_share: float):
+        self.high_share = high_share
+
+    async def take(self, manager: AsyncQueueManager, count: int, block: bool = False) -> list[tuple[str, str, str]]:
+        high_count = round(count * self.high_share)
+        low_count = count - high_count
+
+        entries = await manager.get_high_priority_url(high_count) if high_count else []
+        entries += await manager.get_low_priority_url(low_count) if low_count else []
+
+        # Fall back to the other queue rather than leaving slots idle
+        if not entries and low_count == 0: entries = await manager.get_low_priority_url(count)
+        if not entries and high_count == 0: entries = await manager.get_high_priority_url(count)
+
+        # Both queues are empty, wait in Redis for the next urls instead of polling
+        if not entries and block: entries = await manager.wait_for_urls(count)
+        return entries
+
+
+class Frontier:
+    """
+    Per-domain url queues plus a heap of domains ordered by the time they can be fetched again.
+    `get` only hands out urls that can be fetched right away, a domain is out of the heap while
+    one of its urls is being fetched. The next allowed time of a domain is still reserved in
+    Redis, so politeness holds across crawler threads and processes. A url is acknowledged once
+    it was crawled or skipped, the ones still buffered on close go back to the queue.
+    """
+
+    def __init__(self, manager: AsyncQueueManager, robots: RobotsCache, session: aiohttp.ClientSession, policy: PriorityPolicy, max_buffered: int = 1000, max_per_domain: int = 50, user_agent: str = '*'):
+        self.manager = manager
+        self.robots = robots
+        self.session = session
+        self.policy = policy
+        self.max_buffered = max_buffered
+        self.max_per_domain = max_per_domain
+        self.user_agent = user_agent
+
+        self.__queues: dict[str, deque[str]] = {}
+        self.__heap: list[tuple[float, int, str]] = []
+        # Domains whose slot was already reserved in Redis, they are fetched as soon as they leave the heap
+        self.__reserved: set[str] = set()
+        # Next allowed time of domains without buffered urls
+        self.__eligible: dict[str, float] = {}
+        self.__delays: dict[str, float] = {}
+        self.__buffered = 0
+        self.__sequence = 0
+        self.__idle_until = 0.0
+        # Stream entry of each buffered or in flight url, and the entries waiting to be acknowledged
+        self.__entries: dict[str, tuple[str, str]] = {}
+        self.__acks: list[tuple[str, str]] = []
+        self.__last_ack = time.time()
+        self.__refill_lock = asyncio.Lock()
+
+    def __len__(self):
+        return self.__buffered
+
+    def __schedule(self, domain: str, at: float):
+        self.__sequence += 1
+        heapq.heappush(self.__heap, (at, self.__sequence, domain))
+
+    async def push(self, entries: list[tuple[str, str, str]]):
+        overflow = []
+        duplicates = []
+        for entry in entries:
+            key, entry_id, url = entry
+            if url in self.__entries:
+                duplicates.append((key, entry_id))
+                continue
+
+            domain = extract_domain(url)
+            queue = self.__queues.get(domain)
+
+            if queue is None:
+                queue = self.__queues[domain] = deque()
+                self.__schedule(domain, self.__eligible.pop(domain, 0))
+            elif len(queue) >= self.max_per_domain:
+                # Don't let a single domain fill the buffer, the url waits in Redis instead
+                overflow.append(entry)
+                continue
+
+            queue.append(url)
+            self.__entries[url] = (key, entry_id)
+            self.__buffered += 1
+
+        if overflow: await self.manager.requeue(overflow)
+        if duplicates: await self.manager.ack(duplicates)
+
+    async def __refill(self, block: bool) -> bool:
+        # A single read at a time, the other coroutines wait for its urls. Returns whether it waited on Redis
+        if self.__refill_lock.locked():
+            async with self.__refill_lock:
+                return True
+
+        async with self.__refill_lock:
+            count = self.max_buffered - self.__buffered
+            if count <= 0 or (not block and time.time() < self.__idle_until): return False
+
+            entries = await self.policy.take(self.manager, count, block)
+            # Both queues are empty, don't ask Redis again for a while
+            if not entries: self.__idle_until = time.time() + self.manager.block
+            await self.push(entries)
+            return block
+
+    async def __flush_acks(self, force: bool = False):
+        # Acknowledged in batches, a url crawled again after a crash is the worst that can happen
+        if not self.__acks: return
+        if not force and len(self.__acks) < 100 and time.time() - self.__last_ack < 1: return
+
+        acks = self.__acks
+        self.__acks = []
+        self.__last_ack = time.time()
+        await self.manager.ack(acks)
+
+    async def get(self) -> str | None:
+        while not self.manager.interrupted:
+            await self.__flush_acks()
+            now = time.time()
+            waited = False
+
+            if not self.__heap or self.__heap[0][0] > now:
+                waited = await self.__refill(block=not self.__heap)
+                now = time.time()
+
+            if not self.__heap or self.__heap[0][0] > now:
+                # Nothing to crawl and the queues were already waited on
+                if not self.__heap and waited: continue
+                wait = self.__heap[0][0] - now if self.__heap else 0.1
+                await asyncio.sleep(min(wait, 0.1))
+                continue
+
+            _, _, domain = heapq.heappop(self.__heap)
+            queue = self.__queues[domain]
+
+            if domain in self.__reserved:
+                self.__reserved.discard(domain)
+                self.__buffered -= 1
+                return queue.popleft()
+
+            url = queue[0]
+            robots = await self.robots.get(self.session, url, self.manager)
+
+            if not robots.parser.can_fetch(url, self.user_agent):
+                queue.popleft()
+                self.__buffered -= 1
+                self.done(url)
+                continue
+
+            self.__delays[domain] = robots.crawl_delay or self.manager.default_cooldown
+            wait = await self.manager.get_next_cooldown(domain, robots.crawl_delay)
+
+            if wait > 0:
+                # Somebody else fetched the domain recently, come back when our slot is due
+                self.__reserved.add(domain)
+                self.__schedule(domain, time.time() + wait)
+                continue
+
+            self.__buffered -= 1
+            return queue.popleft()
+
+        return None
+
+    def done(self, url: str):
+        entry = self.__entries.pop(url, None)
+        if entry is not None: self.__acks.append(entry)
+
+        # Put the domain back in the heap once its crawl delay has passed
+        domain = extract_domain(url)
+        queue = self.__queues.get(domain)
+        next_time = time.time() + self.__delays.pop(domain, 0)
+
+        if queue:
+            self.__schedule(domain, next_time)
+        elif queue is not None:
+            del self.__queues[domain]
+            if next_time > time.time(): self.__eligible[domain] = next_time
+
+        # Forget cooldowns that already passed
+        if len(self.__eligible) > 10 * self.max_buffered:
+            now = time.time()
+            self.__eligible = {domain: at for domain, at in self.__eligible.items() if at > now}
+
+    async def close(self):
+        await self.__flush_acks(force=True)
+
+        # Give the buffered urls back so nothing is lost when the crawler stops
+        entries = [(*self.__entries.pop(url), url) for queue in self.__queues.values() for url in queue if url in self.__entries]
+        if entries: await self.manager.requeue(entries)
+        self.__queues.clear()
+        self.__heap.clear()
+        self.__buffered = 0
@@ -1,113 +1,134 @@
 import asyncio
-import string
 import threading
-import time
-from nltk import pos_tag
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from pymongo import AsyncMongoClient, InsertOne
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import ASCENDING, AsyncMongoClient
 from collections import Counter
 
-from src.Queue import QueueManager
-
-class Indexer: 
-    
-    lemmatizer = WordNetLemmatizer()
-    stop_words = set(stopwords.words())
-
-    def __init__(self, db: AsyncMongoClient, max_concurrent: 8):
+from src.EmbeddingIndex import EmbeddingIndex, page_text
+from src.InvertedIndex import IndexBackend
+from src.LinkGraph import LinkGraph
+from src.Metrics import metrics
+from src.NearDuplicates import NearDuplicateIndex
+from src.QueryCache import Generation
+from src.Queue import AsyncQueueManager
+from src.Tokenizer import count_tokens_chunk, get_tokenizer
+from src.WriteBatcher import WriteBatcher
+
+TOKENIZE_SECONDS = metrics.histogram('indexer_tokenize_seconds', "Time to tokenize (and embed) a batch of pages", sample=1)
+PAGES = metrics.counter('indexer_pages_total', "Pages tokenized and handed to the write batcher")
+ERRORS = metrics.counter('indexer_errors_total', "Batches of pages that failed to index")
+LEMMA_CACHE_SAVED = metrics.counter('indexer_lemma_cache_saved_seconds_total', "Lemmatizer time saved by the lemma cache")
+NEAR_DUPLICATES = metrics.counter('indexer_near_duplicates_total', "Pages skipped as near duplicates of an indexed page")
+
+class Indexer:
+
+    def __init__(self, db: AsyncMongoClient, index_backend: IndexBackend, link_graph: LinkGraph, max_concurrent: 8, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 2000, executor: ProcessPoolExecutor | None = None, chunk_size: int = 8, generation: Generation | None = None, embeddings: EmbeddingIndex | None = None, near_duplicate_distance: int | None = 3):
         self.db = db["searchengine"]
-        self.indexes = self.db['indexes']
-        self.outgoing = self.db['outgoing_links']
+        self.index_backend = index_backend
+        self.link_graph = link_graph
         self.pages = self.db['pages']
         self.max_concurrent = max_concurrent
+        self.batcher = WriteBatcher(self.pages, link_graph, index_backend, max_batch=batch_size, flush_interval=flush_interval, max_pending=max_pending, generation=generation, duplicates=self.db['duplicates'])
+        # Without an executor the tokenization runs in this thread
+        self.executor = executor
+        self.chunk_size = chunk_size
+        # Without an embedding index the pages are only indexed lexically
+        self.embeddings = embeddings
+        # Pages within this many bits of the SimHash of an indexed page are skipped, None indexes them all
+        self.near_duplicate_distance = near_duplicate_distance
+        self.near_duplicates: NearDuplicateIndex | None = None
         pass
 
-    async def index(self, manager: QueueManager):
-        while not manager.interrupted:
-            if(manager.interrupted): break
-            indexing_batch: list[dict[str, list[str]]] = manager.get_next_to_index(self.max_concurrent)
-            
-            if not indexing_batch:
-                await asyncio.sleep(1)
-                continue
-            
-            tasks = []
-
-            for to_index in indexing_batch:
-                tasks.append(self.index_html(to_index.get('url')[0], to_index.get('text')[0], to_index.get('title')[0], to_index.get('description')[0], to_index.get('outgoing')))
-            
+    async def index(self, manager: AsyncQueueManager):
+        flusher = asyncio.create_task(self.batcher.run(manager))
+        if self.near_duplicate_distance is not None:
+            self.near_duplicates = NearDuplicateIndex(manager.r, self.near_duplicate_distance)
             try:
-                await asyncio.gather(*tasks, return_exceptions=False)
+                # Duplicates are upserted by url
+                await self.db['duplicates'].create_index([("url", ASCENDING)])
             except Exception as e:
-                print(f"{threading.current_thread().name} error: {e}")
-        
-        print(f"{threading.current_thread().name} interrupted...")
-        
-
-    def __clean_and_tokenize(self, text: str):
-        text = " ".join(text.split())
-
-        text = text.translate(str.maketrans('', '', string.punctuation + '’')).lower()
-
-        tokens = word_tokenize(text)
-
-        filtered_tokens = [word for word in tokens if word not in self.stop_words]
+                print(e)
 
-        filtered_tokens = [word for word in filtered_tokens if not len(word) > 30]
-
-        tagged = pos_tag(filtered_tokens)
-
-        lemmatized_words = [self.lemmatizer.lemmatize(
-            word, pos='v' if tag.startswith('V') else 'n') for word, tag in tagged]
-        
-        return lemmatized_words
-
-    async def index_html(self, url: str, text: str, title: str, description: str, outgoing_links: list[str]):
-        start = time.perf_counter()
-
-        tokens = self.__clean_and_tokenize(text)
-
-        end_tokenization = time.perf_counter() - start
+        while not manager.interrupted:
+            if(manager.interrupted): break
+            await self.batcher.wait_for_capacity()
 
-        start_mongo = time.perf_counter()
+            # Blocks in Redis for a moment when there is nothing to index
+            indexing_batch: list[dict] = await manager.get_next_to_index(min(self.max_concurrent, self.batcher.capacity()))
 
-        await self.pages.update_one(
-                {"url": url, "title": title, "description": description, "rank": 0},
-                {
-                    "$set": {"url": url, "title": title, "description": description, "rank": 0},
-                },
-                upsert=True
-            )
-        
-        await self.outgoing.update_one(
-                {"url": url, "outgoing": outgoing_links},
-                {
-                    "$set":  {"url": url, "outgoing": outgoing_links},
-                },
-                upsert=True
-            )
-        
-        token_count = Counter(tokens)
-        
-        operations = []
-        
-        for word, count in token_count.items():
-            operations.append(
-                InsertOne(
-                    {"word": word, "url": url},
-                    {
-                        "$setOnInsert": {"word": word, "url": url},
-                        "$inc": {"count": count}
-                    },
-                )
-            )
+            if indexing_batch:
+                try:
+                    await self.index_batch(indexing_batch)
+                except Exception as e:
+                    ERRORS.inc()
+                    print(f"{threading.current_thread().name} error: {e}")
 
-        if operations:
-            await self.indexes.bulk_write(operations, ordered=False)
+            await manager.ack(self.batcher.durable())
 
-        end = time.perf_counter()
+        await flusher
+        await self.batcher.flush()
+        await self.index_backend.flush()
+        await asyncio.to_thread(self.link_graph.flush)
+        await manager.ack(self.batcher.durable())
 
-        print(f"{threading.current_thread().name} Indexed: {url} in {end - start}s | DB operations: {end - start_mongo}s | Tokenization: {end_tokenization}s")
+        print(f"{threading.current_thread().name} interrupted...")
 
+    async def tokenize(self, texts: list[str]) -> tuple[list[dict[str, int]], float]:
+        if self.executor is None: return get_tokenizer().count_tokens_batch(texts)
+
+        # Send the documents in chunks to amortize the pickling, only the token counts come back
+        loop = asyncio.get_running_loop()
+        chunks = [texts[i:i + self.chunk_size] for i in range(0, len(texts), self.chunk_size)]
+        results = await asyncio.gather(*[loop.run_in_executor(self.executor, count_tokens_chunk, chunk) for chunk in chunks])
+
+        return [token_count for token_counts, _ in results for token_count in token_counts], sum(saved for _, saved in results)
+
+    async def skip_near_duplicates(self, indexing_batch: list[dict]) -> list[dict]:
+        try:
+            canonicals = await self.near_duplicates.canonical(indexing_batch)
+        except Exception as e:
+            print(f"{threading.current_thread().name} near duplicate error: {e}")
+            return indexing_batch
+
+        unique = []
+        for to_index, canonical in zip(indexing_batch, canonicals):
+            if canonical is None: unique.append(to_index)
+            else: await self.batcher.add_duplicate(to_index['url'], canonical, to_index.get('entry'))
+
+        NEAR_DUPLICATES.inc(len(indexing_batch) - len(unique))
+        return unique
+
+    async def index_batch(self, indexing_batch: list[dict]):
+        # Checked before the tokenizer, a near duplicate is never tokenized
+        if self.near_duplicates is not None:
+            indexing_batch = await self.skip_near_duplicates(indexing_batch)
+            if not indexing_batch: return
+
+        texts = [to_index['text'] for to_index in indexing_batch]
+
+        with TOKENIZE_SECONDS.time():
+            if self.embeddings is None:
+                token_counts, saved = await self.tokenize(texts)
+            else:
+                # Pages are embedded in a thread while the tokenizer processes work
+                (token_counts, saved), _ = await asyncio.gather(self.tokenize(texts), self.embed(indexing_batch))
+
+        for to_index, token_count in zip(indexing_batch, token_counts):
+            # Pages queued before anchor texts were recorded only have the urls
+            outgoing = [(link, '') if isinstance(link, str) else tuple(link) for link in to_index['outgoing']]
+            await self.batcher.add(to_index['url'], to_index['title'], to_index['description'], outgoing, Counter(token_count), to_index.get('entry'))
+
+        PAGES.inc(len(indexing_batch))
+        LEMMA_CACHE_SAVED.inc(saved)
+
+    async def embed(self, indexing_batch: list[dict]):
+        urls = [to_index['url'] for to_index in indexing_batch]
+        texts = [page_text(to_index['title'], to_index['description'], to_index['text']) for to_index in indexing_batch]
+
+        try:
+            await asyncio.to_thread(self.embeddings.embed, urls, texts)
+        except Exception as e:
+            print(f"{threading.current_thread().name} embedding error: {e}")
+
+    async def index_html(self, url: str, text: str, title: str, description: str, outgoing_links: list[tuple[str, str]]):
+        await self.index_batch([{"url": url, "text": text, "title": title, "description": description, "outgoing": outgoing_links}])
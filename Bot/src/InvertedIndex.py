@@ -0,0 +1,696 @@
+import asyncio
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import Counter
+from typing import Iterable
+from pymongo import InsertOne
+
+from src.helpers.Varint import decode_ids, decode_postings, decode_varint, encode_ids, encode_postings, encode_varint
+
+DEFAULT_INDEX_PATH = os.environ.get(
+    'SEARCHENGINE_INDEX_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'index')
+)
+
+SEGMENT_MAGIC = b'SEG2'
+# Segments written before the posting lists were split in blocks
+LEGACY_SEGMENT_MAGIC = b'SEG1'
+# docs offset, dictionary offset, term count
+SEGMENT_FOOTER = struct.Struct('<QQQ4s')
+# Postings per block, every block records its last doc id, max term frequency and min document length
+BLOCK_SIZE = 128
+# Max term frequency of the terms of legacy segments, which have no per term metadata
+UNBOUNDED = 0xFFFFFFFF
+
+
+class IndexBackend:
+    """Common interface for the indexer (writes) and the search path (reads)."""
+
+    # Changes whenever written documents become searchable, None for backends where every write does
+    generation: int | None = None
+    # Buffers of documents written to disk so far, None for backends where every write is durable right away
+    written_buffers: int | None = None
+
+    def current_buffer(self) -> int | None:
+        """Number of the buffer being filled, documents added before this call are in it or in an earlier one."""
+        return None
+
+    async def add_document(self, url: str, token_count: Counter):
+        raise NotImplementedError
+
+    async def add_documents(self, documents: list[tuple[str, Counter]]):
+        for url, token_count in documents:
+            await self.add_document(url, token_count)
+
+    async def remove_documents(self, urls: list[str]):
+        """Drops the postings of the urls, e.g. pages that turned out to be duplicates."""
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+    def match(self, terms: list[str]) -> list[tuple[str, int]]:
+        """Urls containing every term, along with the summed term frequency."""
+        raise NotImplementedError
+
+    async def match_async(self, terms: list[str]) -> list[tuple[str, int]]:
+        # Off the event loop by default, backends with an async driver override it
+        return await asyncio.to_thread(self.match, terms)
+
+
+class MongoIndexBackend(IndexBackend):
+    """One document per (word, url) pair in the `indexes` collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def add_document(self, url: str, token_count: Counter):
+        await self.add_documents([(url, token_count)])
+
+    async def add_documents(self, documents: list[tuple[str, Counter]]):
+        operations = [
+            InsertOne({"word": word, "url": url, "count": count})
+            for url, token_count in documents
+            for word, count in token_count.items()
+        ]
+
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def remove_documents(self, urls: list[str]):
+        await self.collection.delete_many({"url": {"$in": urls}})
+
+    def __pipeline(self, terms: list[str]) -> list[dict]:
+        return [
+            {"$match": {"word": {"$in": terms}}},
+            {
+                "$group": {
+                    "_id": "$url",
+                    "matched_words": {"$addToSet": "$word"},
+                    "total_word_count": {"$sum": "$count"}
+                }
+            },
+            {"$project": {"match_count": {"$size": "$matched_words"}, "total_word_count": 1}},
+            {"$match": {"match_count": len(set(terms))}}
+        ]
+
+    def match(self, terms: list[str]) -> list[tuple[str, int]]:
+        return [(doc["_id"], doc["total_word_count"]) for doc in self.collection.aggregate(self.__pipeline(terms))]
+
+    async def match_async(self, terms: list[str]) -> list[tuple[str, int]]:
+        # Needs a collection of an AsyncMongoClient
+        cursor = await self.collection.aggregate(self.__pipeline(terms))
+        return [(doc["_id"], doc["total_word_count"]) async for doc in cursor]
+
+    async def match_page_async(self, terms: list[str], page: int, page_size: int, pages: str = 'pages'):
+        """
+        Cursor over one page of the matches joined with their `pages` documents, by page rank and
+        term frequency, plus one more to know if there is a next page. Sorted by MongoDB, the matches never leave it.
+        """
+        pipeline = self.__pipeline(terms) + [
+            {"$lookup": {"from": pages, "localField": "_id", "foreignField": "url", "as": "page"}},
+            {"$unwind": "$page"},
+            {"$sort": {"page.rank": -1, "total_word_count": -1}},
+            {"$skip": page * page_size},
+            {"$limit": page_size + 1},
+            {"$project": {"_id": 0, "url": "$_id", "title": "$page.title", "description": "$page.description"}}
+        ]
+        return await self.collection.aggregate(pipeline, allowDiskUse=True)
+
+
+class DocTable:
+    """
+    Dense doc ids, stored as an append only `id\tlength\turl` log where the last line for an id wins.
+    A line is only appended for a new url or a new length, `compact` rewrites the log with one line per id.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.urls: list[str] = []
+        self.lengths = array('I')
+        self.ids: dict[str, int] = {}
+        self.__offset = 0
+        self.__lines = 0
+        # A compacted log is a new file, readers start over from its beginning
+        self.__inode = None
+        self.__pending: list[str] = []
+
+    def __len__(self):
+        return len(self.urls)
+
+    def load(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+
+        if inode != self.__inode:
+            self.__inode = inode
+            self.__offset = 0
+            self.__lines = 0
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.__offset)
+            data = file.read()
+
+        # Only consume complete lines, the writer may be halfway through an append
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            doc_id, length, url = line.split('\t', 2)
+            self.__set(int(doc_id), int(length), url)
+            self.__lines += 1
+        self.__offset += end
+
+    def __set(self, doc_id: int, length: int, url: str):
+        while len(self.urls) <= doc_id:
+            self.urls.append('')
+            self.lengths.append(0)
+        self.urls[doc_id] = url
+        self.lengths[doc_id] = length
+        self.ids[url] = doc_id
+
+    def assign(self, url: str, length: int) -> int:
+        url = url.replace('\t', ' ').replace('\n', ' ')
+        doc_id = self.ids.get(url)
+        if doc_id is not None and self.lengths[doc_id] == length: return doc_id
+
+        if doc_id is None: doc_id = len(self.urls)
+        self.__set(doc_id, length, url)
+        self.__pending.append(f"{doc_id}\t{length}\t{url}\n")
+        return doc_id
+
+    def sync(self):
+        if not self.__pending: return
+
+        data = "".join(self.__pending).encode('utf-8')
+        lines = len(self.__pending)
+        self.__pending.clear()
+        with open(self.path, 'ab') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        self.__offset += len(data)
+        self.__lines += lines
+        if self.__inode is None: self.__inode = os.stat(self.path).st_ino
+
+    def compact(self, min_ratio: float = 2.0) -> bool:
+        """Rewrites the log with the last line of each id, once it has `min_ratio` lines per id."""
+        if self.__lines + len(self.__pending) <= min_ratio * max(len(self.urls), 1): return False
+
+        data = "".join(f"{doc_id}\t{length}\t{url}\n" for doc_id, (url, length) in enumerate(zip(self.urls, self.lengths)) if url).encode('utf-8')
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+        self.__pending.clear()
+        self.__offset = len(data)
+        self.__lines = len(self.urls)
+        self.__inode = os.stat(self.path).st_ino
+        return True
+
+
+class Segment:
+    """
+    Immutable, memory mapped segment: the ids of its documents, the posting blobs and a term dictionary.
+    A posting list is a table of blocks followed by the blocks themselves, so a reader can skip
+    whole blocks by doc id and bound the score of a block without decoding it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.__buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        docs_offset, dict_offset, term_count, magic = SEGMENT_FOOTER.unpack_from(self.__buf, len(self.__buf) - SEGMENT_FOOTER.size)
+        if magic not in (SEGMENT_MAGIC, LEGACY_SEGMENT_MAGIC): raise ValueError(f"{path} is not an index segment")
+        self.blocked = magic == SEGMENT_MAGIC
+
+        doc_count, pos = decode_varint(self.__buf, docs_offset)
+        self.doc_ids = decode_ids(self.__buf[pos:dict_offset], doc_count)
+
+        # term -> (document frequency, offset, size, max term frequency, min document length)
+        self.terms: dict[str, tuple[int, int, int, int, int]] = {}
+        pos = dict_offset
+        for _ in range(term_count):
+            length, pos = decode_varint(self.__buf, pos)
+            term = self.__buf[pos:pos + length].decode('utf-8')
+            pos += length
+            doc_freq, pos = decode_varint(self.__buf, pos)
+            offset, pos = decode_varint(self.__buf, pos)
+            size, pos = decode_varint(self.__buf, pos)
+            if self.blocked:
+                max_tf, pos = decode_varint(self.__buf, pos)
+                min_length, pos = decode_varint(self.__buf, pos)
+            else:
+                max_tf, min_length = UNBOUNDED, 0
+            self.terms[term] = (doc_freq, offset, size, max_tf, min_length)
+
+    def blocks(self, term: str) -> list[tuple[int, int, int, int, int, int, int]] | None:
+        """(last doc id, offset, size, postings, base doc id, max term frequency, min document length) of each block."""
+        entry = self.terms.get(term)
+        if entry is None: return None
+        doc_freq, offset, size, max_tf, min_length = entry
+
+        # A legacy posting list is a single block that can't be skipped
+        if not self.blocked: return [(UNBOUNDED, offset, size, doc_freq, 0, max_tf, min_length)]
+
+        count, pos = decode_varint(self.__buf, offset)
+        table = []
+        last = 0
+        for _ in range(count):
+            gap, pos = decode_varint(self.__buf, pos)
+            block_size, pos = decode_varint(self.__buf, pos)
+            block_tf, pos = decode_varint(self.__buf, pos)
+            block_length, pos = decode_varint(self.__buf, pos)
+            last += gap
+            table.append((last, block_size, block_tf, block_length))
+
+        blocks = []
+        base = 0
+        for i, (last, block_size, block_tf, block_length) in enumerate(table):
+            blocks.append((last, pos, block_size, min(BLOCK_SIZE, doc_freq - i * BLOCK_SIZE), base, block_tf, block_length))
+            pos += block_size
+            base = last
+        return blocks
+
+    def decode_block(self, block: tuple[int, int, int, int, int, int, int]) -> tuple[array, array]:
+        _, offset, size, count, base, _, _ = block
+        return decode_postings(self.__buf[offset:offset + size], count, base)
+
+    def postings(self, term: str) -> tuple[array, array] | None:
+        blocks = self.blocks(term)
+        if blocks is None: return None
+
+        ids, freqs = array('I'), array('I')
+        for block in blocks:
+            block_ids, block_freqs = self.decode_block(block)
+            ids += block_ids
+            freqs += block_freqs
+        return ids, freqs
+
+    def iter_postings(self, term: str):
+        """(doc id, term frequency) pairs of a term, decoded a block at a time."""
+        for block in self.blocks(term) or []:
+            yield from zip(*self.decode_block(block))
+
+    def close(self):
+        self.__buf.close()
+
+    @staticmethod
+    def write(path: str, postings: Iterable[tuple[str, array, array]], doc_ids, lengths):
+        """Writes (term, doc ids, term frequencies) posting lists, given in term order, as a segment."""
+        tmp_path = path + '.tmp'
+        try:
+            Segment.__write(tmp_path, postings, doc_ids, lengths)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def __write(tmp_path: str, postings: Iterable[tuple[str, array, array]], doc_ids, lengths):
+        with open(tmp_path, 'wb') as file:
+            file.write(SEGMENT_MAGIC)
+            offset = len(SEGMENT_MAGIC)
+
+            dictionary = bytearray()
+            term_count = 0
+            for term, ids, freqs in postings:
+                term_count += 1
+
+                table = bytearray()
+                data = bytearray()
+                encode_varint((len(ids) + BLOCK_SIZE - 1) // BLOCK_SIZE, table)
+                previous = 0
+                max_tf = 0
+                min_length = UNBOUNDED
+                for start in range(0, len(ids), BLOCK_SIZE):
+                    block_ids = ids[start:start + BLOCK_SIZE]
+                    block_freqs = freqs[start:start + BLOCK_SIZE]
+                    block = encode_postings(block_ids, block_freqs, previous)
+                    block_tf = max(block_freqs)
+                    block_length = min(lengths[doc_id] for doc_id in block_ids)
+
+                    encode_varint(block_ids[-1] - previous, table)
+                    encode_varint(len(block), table)
+                    encode_varint(block_tf, table)
+                    encode_varint(block_length, table)
+                    data += block
+
+                    previous = block_ids[-1]
+                    max_tf = max(max_tf, block_tf)
+                    min_length = min(min_length, block_length)
+
+                blob = table + data
+                file.write(blob)
+
+                encoded = term.encode('utf-8')
+                encode_varint(len(encoded), dictionary)
+                dictionary += encoded
+                encode_varint(len(ids), dictionary)
+                encode_varint(offset, dictionary)
+                encode_varint(len(blob), dictionary)
+                encode_varint(max_tf, dictionary)
+                encode_varint(min_length, dictionary)
+                offset += len(blob)
+
+            docs = bytearray()
+            encode_varint(len(doc_ids), docs)
+            docs += encode_ids(doc_ids)
+            file.write(docs)
+            file.write(dictionary)
+            file.write(SEGMENT_FOOTER.pack(offset, offset + len(docs), term_count, SEGMENT_MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class SegmentIndexBackend(IndexBackend):
+    """
+    In-process inverted index. Documents are buffered in memory and flushed as immutable
+    segment files, a manifest lists the live segments. A single process writes to the
+    index (the indexer threads share one instance), any number of processes can read it.
+
+    Segments are merged in a background thread, `merge_factor` neighbouring segments of the
+    same size tier at a time, so each document is rewritten about once per tier it goes through.
+    A removed document is written as an empty one of length 0, which hides its older postings.
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH, flush_documents: int = 1000, merge_factor: int = 10):
+        self.path = os.path.abspath(path)
+        self.flush_documents = flush_documents
+        self.merge_factor = merge_factor
+        os.makedirs(self.path, exist_ok=True)
+
+        self.docs = DocTable(os.path.join(self.path, 'docs.tsv'))
+        self.segments: list[Segment] = []
+        self.generation = 0
+        # Live documents and their total length, for the BM25 statistics. Removed ones have length 0
+        self.doc_count = 0
+        self.total_length = 0
+        # Ordinal of the newest segment holding each document, older postings of a document are stale
+        self.__doc_segment = array('i')
+        # Length each live document was counted with in `total_length`
+        self.__live_lengths = array('I')
+        self.__next_segment = 0
+        self.__manifest_mtime = None
+        self.__buffer: dict[int, Counter] = {}
+        self.__buffer_number = 0
+        self.written_buffers = 0
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__merger: threading.Thread | None = None
+
+        self.docs.load()
+        self.refresh()
+
+    def __manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.__manifest_path()).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        with self.__lock:
+            if mtime == self.__manifest_mtime: return
+
+            with open(self.__manifest_path(), 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+
+            loaded = {segment.path: segment for segment in self.segments}
+            segments = []
+            for name in manifest['segments']:
+                segment_path = os.path.join(self.path, name)
+                segments.append(loaded.pop(segment_path, None) or Segment(segment_path))
+
+            for segment in loaded.values():
+                segment.close()
+
+            # Segments are only appended or merged in place, the ones before the first change keep their ordinals
+            keep = 0
+            while keep < min(len(segments), len(self.segments)) and segments[keep] is self.segments[keep]:
+                keep += 1
+
+            self.docs.load()
+            self.generation = manifest['generation']
+            self.__next_segment = manifest['next_segment']
+            self.__manifest_mtime = mtime
+            self.__publish(segments, keep)
+
+    def __publish(self, segments: list[Segment], keep: int):
+        """
+        Makes `segments` the live ones, the first `keep` of which were live already with the same
+        ordinals. Only the documents of the others are visited. Called with the lock held.
+        """
+        # Copied, searches still walking the previous segments hold on to the previous ordinals
+        doc_segment = array('i', self.__doc_segment)
+        live_lengths = self.__live_lengths
+        missing = len(self.docs) - len(doc_segment)
+        if missing > 0:
+            doc_segment.extend(array('i', [-1]) * missing)
+            live_lengths.extend(array('I', [0]) * missing)
+
+        lengths = self.docs.lengths
+        for ordinal in range(keep, len(segments)):
+            for doc_id in segments[ordinal].doc_ids:
+                length = lengths[doc_id]
+                self.doc_count += (length > 0) - (live_lengths[doc_id] > 0)
+                self.total_length += length - live_lengths[doc_id]
+                live_lengths[doc_id] = length
+                doc_segment[doc_id] = ordinal
+
+        self.segments = segments
+        self.__doc_segment = doc_segment
+
+    def snapshot(self) -> tuple[list[Segment], array]:
+        """The live segments and the ordinal of the segment holding each document, as of now."""
+        with self.__lock:
+            return list(self.segments), self.__doc_segment
+
+    def __write_manifest(self):
+        manifest = {
+            "generation": self.generation,
+            "next_segment": self.__next_segment,
+            "segments": [os.path.basename(segment.path) for segment in self.segments]
+        }
+        tmp_path = self.__manifest_path() + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, self.__manifest_path())
+        self.__manifest_mtime = os.stat(self.__manifest_path()).st_mtime_ns
+
+    def current_buffer(self) -> int:
+        with self.__lock:
+            return self.__buffer_number
+
+    async def add_document(self, url: str, token_count: Counter):
+        with self.__lock:
+            doc_id = self.docs.assign(url, sum(token_count.values()))
+            self.__buffer[doc_id] = token_count
+            full = len(self.__buffer) >= self.flush_documents
+
+        if full: await self.flush()
+
+    async def remove_documents(self, urls: list[str]):
+        with self.__lock:
+            for url in urls:
+                if self.docs.ids.get(url) is None: continue
+                self.__buffer[self.docs.assign(url, 0)] = Counter()
+            full = len(self.__buffer) >= self.flush_documents
+
+        if full: await self.flush()
+
+    async def flush(self):
+        with self.__lock:
+            if not self.__buffer: return
+
+        await asyncio.to_thread(self.__flush)
+
+    def __flush(self):
+        # Buffers are taken under the flush lock so segments are always published in the order they were filled
+        with self.__flush_lock:
+            with self.__lock:
+                if not self.__buffer: return
+                # The doc table must be on disk before a segment referencing it is published
+                self.docs.sync()
+                buffer = self.__buffer
+                self.__buffer = {}
+                buffer_number = self.__buffer_number
+                self.__buffer_number += 1
+                name = f"segment_{self.__next_segment:08d}.seg"
+                self.__next_segment += 1
+
+            postings: dict[str, tuple[array, array]] = {}
+            doc_ids = sorted(buffer)
+            for doc_id in doc_ids:
+                for term, count in buffer[doc_id].items():
+                    entry = postings.get(term)
+                    if entry is None:
+                        entry = postings[term] = (array('I'), array('I'))
+                    entry[0].append(doc_id)
+                    entry[1].append(count)
+
+            try:
+                Segment.write(os.path.join(self.path, name), ((term, *postings[term]) for term in sorted(postings)), doc_ids, self.docs.lengths)
+                segment = Segment(os.path.join(self.path, name))
+            except Exception:
+                # Back into the buffer being filled, written_buffers only moves past them once they are on disk.
+                # Documents added again since keep their newer version
+                with self.__lock:
+                    for doc_id, token_count in buffer.items():
+                        self.__buffer.setdefault(doc_id, token_count)
+                raise
+
+            with self.__lock:
+                self.generation += 1
+                self.__publish(self.segments + [segment], len(self.segments))
+                self.__write_manifest()
+                self.written_buffers = buffer_number + 1
+
+        self.__start_merge()
+
+    def __tier(self, doc_count: int) -> int:
+        # Segments up to a flush in size are all in the first tier
+        tier = 0
+        size = self.flush_documents * self.merge_factor
+        while doc_count >= size:
+            tier += 1
+            size *= self.merge_factor
+        return tier
+
+    def __next_merge(self) -> tuple[int, int] | None:
+        """Bounds of the `merge_factor` neighbouring segments of the lowest tier that has that many in a row."""
+        tiers = [self.__tier(len(segment.doc_ids)) for segment in self.segments]
+        best = None
+        start = 0
+        while start < len(tiers):
+            end = start
+            while end < len(tiers) and tiers[end] == tiers[start]:
+                end += 1
+            if end - start >= self.merge_factor and (best is None or tiers[start] < tiers[best]): best = start
+            start = end
+        return (best, best + self.merge_factor) if best is not None else None
+
+    def __start_merge(self):
+        with self.__lock:
+            if self.__merger is not None and self.__merger.is_alive(): return
+            if self.__next_merge() is None: return
+            # Not a daemon, an interrupted merge would only waste its work but exiting waits for it anyway
+            self.__merger = threading.Thread(target=self.__merge_all, name="segment-merge")
+            self.__merger.start()
+
+    def wait_for_merges(self):
+        merger = self.__merger
+        if merger is not None: merger.join()
+
+    def __merge_all(self):
+        while True:
+            with self.__lock:
+                bounds = self.__next_merge()
+            if bounds is None: return
+
+            try:
+                self.__merge(*bounds)
+            except Exception as e:
+                print(f"Segment merge error: {e}")
+                return
+
+    def __merge(self, start: int, end: int):
+        # Flushes only append segments, the ones being merged keep their place while this runs
+        with self.__lock:
+            run = self.segments[start:end]
+            doc_segment = self.__doc_segment
+            name = f"segment_{self.__next_segment:08d}.seg"
+            self.__next_segment += 1
+
+        doc_ids = array('I', heapq.merge(*[
+            [doc_id for doc_id in segment.doc_ids if doc_segment[doc_id] == start + i]
+            for i, segment in enumerate(run)
+        ]))
+
+        Segment.write(os.path.join(self.path, name), self.__merged_postings(run, start, doc_segment), doc_ids, self.docs.lengths)
+        segment = Segment(os.path.join(self.path, name))
+
+        with self.__lock:
+            position = self.segments.index(run[0])
+            self.generation += 1
+            self.__publish(self.segments[:position] + [segment] + self.segments[position + len(run):], position)
+            # Lines of re-indexed documents pile up in the doc table, rewrite it once they outnumber the documents
+            self.docs.compact()
+            self.__write_manifest()
+
+        for old in run:
+            old.close()
+            try:
+                os.remove(old.path)
+            except OSError as e:
+                print(e)
+
+    @staticmethod
+    def __live_postings(segment: Segment, term: str, ordinal: int, doc_segment: array):
+        for doc_id, freq in segment.iter_postings(term):
+            if doc_segment[doc_id] == ordinal: yield doc_id, freq
+
+    @staticmethod
+    def __merged_postings(run: list[Segment], start: int, doc_segment: array):
+        """
+        Live postings of the segments in term order, one term in memory at a time. A document is live
+        in a single segment, so the sorted lists of a term are merged without comparing frequencies.
+        """
+        previous = None
+        for term in heapq.merge(*[sorted(segment.terms) for segment in run]):
+            if term == previous: continue
+            previous = term
+
+            lists = [SegmentIndexBackend.__live_postings(segment, term, start + i, doc_segment) for i, segment in enumerate(run) if term in segment.terms]
+            ids, freqs = array('I'), array('I')
+            for doc_id, freq in heapq.merge(*lists):
+                ids.append(doc_id)
+                freqs.append(freq)
+            if ids: yield term, ids, freqs
+
+    def postings(self, term: str) -> tuple[array, array]:
+        segments, doc_segment = self.snapshot()
+
+        if len(segments) == 1:
+            return segments[0].postings(term) or (array('I'), array('I'))
+
+        merged: dict[int, int] = {}
+        for ordinal, segment in enumerate(segments):
+            found = segment.postings(term)
+            if found is None: continue
+            for doc_id, freq in zip(*found):
+                if doc_segment[doc_id] == ordinal: merged[doc_id] = freq
+
+        ids = sorted(merged)
+        return array('I', ids), array('I', [merged[doc_id] for doc_id in ids])
+
+    def match(self, terms: list[str]) -> list[tuple[str, int]]:
+        self.refresh()
+
+        lists = [self.postings(term) for term in set(terms)]
+        if not lists: return []
+
+        # Intersect starting from the rarest term
+        lists.sort(key=lambda entry: len(entry[0]))
+        ids, freqs = lists[0]
+        totals = dict(zip(ids, freqs))
+
+        for ids, freqs in lists[1:]:
+            if not totals: break
+            next_totals = {}
+            for doc_id, freq in zip(ids, freqs):
+                total = totals.get(doc_id)
+                if total is not None: next_totals[doc_id] = total + freq
+            totals = next_totals
+
+        return [(self.docs.urls[doc_id], total) for doc_id, total in totals.items()]
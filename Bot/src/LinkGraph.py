@@ -0,0 +1,304 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from typing import Iterable, Iterator
+
+from src.InvertedIndex import DocTable
+from src.helpers.Varint import decode_varint, encode_ids, encode_varint
+
+DEFAULT_GRAPH_PATH = os.environ.get(
+    'SEARCHENGINE_GRAPH_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'graph')
+)
+
+# LNK2 records carry the sequence of the flush that wrote them, LNK1 ones have the sequence of their segment
+GRAPH_MAGIC = b'LNK2'
+LEGACY_GRAPH_MAGIC = b'LNK1'
+# record count, magic
+GRAPH_FOOTER = struct.Struct('<Q4s')
+
+
+def write_records(path: str, records: Iterable[tuple[int, int, array, list[str]]]) -> int:
+    """
+    One record per source page, in ascending source order: its id, the sequence of the flush that
+    wrote it, the ascending ids of the pages it links to and their anchor texts. Returns the record count.
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    try:
+        with open(tmp_path, 'wb') as file:
+            out = bytearray(GRAPH_MAGIC)
+            for source, sequence, targets, anchors in records:
+                encode_varint(source, out)
+                encode_varint(sequence, out)
+                encode_varint(len(targets), out)
+                out += encode_ids(targets)
+                for anchor in anchors:
+                    encoded = anchor.encode('utf-8')
+                    encode_varint(len(encoded), out)
+                    out += encoded
+                count += 1
+                # Merged segments are streamed to disk, never held in memory whole
+                if len(out) >= 1 << 20:
+                    file.write(out)
+                    out = bytearray()
+            out += GRAPH_FOOTER.pack(count, GRAPH_MAGIC)
+            file.write(out)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return count
+
+def record_count(path: str) -> int:
+    with open(path, 'rb') as file:
+        file.seek(-GRAPH_FOOTER.size, os.SEEK_END)
+        return GRAPH_FOOTER.unpack(file.read(GRAPH_FOOTER.size))[0]
+
+def iter_records(path: str, segment_sequence: int, anchors: bool = True) -> Iterator[tuple[int, int, array, list[str]]]:
+    """The (source, sequence, targets, anchor texts) records of a segment in source order, read from a memory map."""
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        count, magic = GRAPH_FOOTER.unpack_from(buf, len(buf) - GRAPH_FOOTER.size)
+        header = buf[:len(GRAPH_MAGIC)]
+        if magic != header or header not in (GRAPH_MAGIC, LEGACY_GRAPH_MAGIC): raise ValueError(f"{path} is not a link graph segment")
+        legacy = header == LEGACY_GRAPH_MAGIC
+
+        pos = len(GRAPH_MAGIC)
+        for _ in range(count):
+            source, pos = decode_varint(buf, pos)
+            if legacy: sequence = segment_sequence
+            else: sequence, pos = decode_varint(buf, pos)
+            length, pos = decode_varint(buf, pos)
+
+            targets = array('I')
+            target = 0
+            for _ in range(length):
+                gap, pos = decode_varint(buf, pos)
+                target += gap
+                targets.append(target)
+
+            texts = []
+            for _ in range(length):
+                size, pos = decode_varint(buf, pos)
+                if anchors: texts.append(buf[pos:pos + size].decode('utf-8'))
+                pos += size
+
+            yield source, sequence, targets, texts
+
+def read_records(path: str, segment_sequence: int, anchors: bool = True, since: int = 0) -> dict[int, tuple[array, list[str]]]:
+    """Records of a segment written by flushes after `since`, by source."""
+    return {source: (targets, texts) for source, sequence, targets, texts in iter_records(path, segment_sequence, anchors) if sequence > since}
+
+def merged_records(segments: list[tuple[str, int]]) -> Iterator[tuple[int, int, array, list[str]]]:
+    """
+    Records of neighbouring segments, oldest first, in source order with one record per source:
+    the newest. One record of each segment is in memory at a time.
+    """
+    streams = [iter_records(path, sequence) for path, sequence in segments]
+    pending = None
+    # Equal sources come out in the order of the segments, the newest last
+    for record in heapq.merge(*streams, key=lambda record: record[0]):
+        if pending is not None and pending[0] != record[0]: yield pending
+        pending = record
+    if pending is not None: yield pending
+
+
+class LinkGraph:
+    """
+    Page to page links with their anchor text, keyed by the dense ids of a DocTable. Crawled pages
+    are buffered and flushed as immutable segments listed in a manifest, the newest record of a
+    page replaces its links. Each record carries the sequence number of the flush that wrote it,
+    so readers can ask for the pages whose links changed since a sequence they already processed.
+
+    Segments are merged in a background thread like the ones of the inverted index, `merge_factor`
+    neighbouring segments of the same size tier at a time. Records keep their sequence when merged.
+    """
+
+    def __init__(self, path: str = DEFAULT_GRAPH_PATH, flush_pages: int = 5000, flush_interval: float = 60.0, merge_factor: int = 10, max_anchor: int = 100):
+        self.path = os.path.abspath(path)
+        self.flush_pages = flush_pages
+        self.flush_interval = flush_interval
+        self.merge_factor = merge_factor
+        self.max_anchor = max_anchor
+        os.makedirs(self.path, exist_ok=True)
+
+        self.docs = DocTable(os.path.join(self.path, 'docs.tsv'))
+        # (segment name, sequence of the newest flush it holds, record count)
+        self.segments: list[tuple[str, int, int]] = []
+        self.sequence = 0
+        self.__manifest_mtime = None
+        self.__buffer: dict[int, tuple[array, list[str]]] = {}
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__last_flush = time.time()
+        self.__merger: threading.Thread | None = None
+
+        self.docs.load()
+        self.refresh()
+
+    def __manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.__manifest_path()).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        with self.__lock:
+            if mtime == self.__manifest_mtime: return
+
+            with open(self.__manifest_path(), 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+
+            self.docs.load()
+            # Manifests written before the record counts were kept
+            self.segments = [(name, sequence, *counts) if counts else (name, sequence, record_count(os.path.join(self.path, name))) for name, sequence, *counts in manifest['segments']]
+            self.sequence = manifest['sequence']
+            self.__manifest_mtime = mtime
+
+    def __write_manifest(self):
+        tmp_path = self.__manifest_path() + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({"sequence": self.sequence, "segments": self.segments}, file)
+        os.replace(tmp_path, self.__manifest_path())
+        self.__manifest_mtime = os.stat(self.__manifest_path()).st_mtime_ns
+
+    def add(self, url: str, links: list[tuple[str, str]]):
+        """Replaces the outgoing links of `url`, given as (target url, anchor text) pairs."""
+        with self.__lock:
+            source = self.docs.assign(url, 0)
+
+            anchors: dict[int, str] = {}
+            for target_url, anchor in links:
+                target = self.docs.ids.get(target_url)
+                if target is None: target = self.docs.assign(target_url, 0)
+                # Self links don't count, the first anchor text of a target is kept
+                if target != source and target not in anchors: anchors[target] = anchor[:self.max_anchor]
+
+            targets = sorted(anchors)
+            self.__buffer[source] = (array('I', targets), [anchors[target] for target in targets])
+
+    def should_flush(self) -> bool:
+        # Segments are written in bulk, a flush per indexed batch would leave many tiny files
+        with self.__lock:
+            if not self.__buffer: return False
+            return len(self.__buffer) >= self.flush_pages or time.time() - self.__last_flush >= self.flush_interval
+
+    def flush(self):
+        # Buffers are taken under the flush lock so segments are always published in the order they were filled
+        with self.__flush_lock:
+            with self.__lock:
+                buffer = self.__buffer
+                self.__buffer = {}
+                self.__last_flush = time.time()
+                if not buffer: return
+                sequence = self.sequence + 1
+                # The doc table must be on disk before a segment referencing it is published
+                self.docs.sync()
+
+            name = f"links_{sequence:08d}.seg"
+            count = write_records(os.path.join(self.path, name), ((source, sequence, *buffer[source]) for source in sorted(buffer)))
+
+            with self.__lock:
+                self.segments.append((name, sequence, count))
+                self.sequence = sequence
+                self.__write_manifest()
+
+        self.__start_merge()
+
+    def __tier(self, count: int) -> int:
+        # Segments up to a flush in size are all in the first tier
+        tier = 0
+        size = self.flush_pages * self.merge_factor
+        while count >= size:
+            tier += 1
+            size *= self.merge_factor
+        return tier
+
+    def __next_merge(self) -> tuple[int, int] | None:
+        """Bounds of the `merge_factor` neighbouring segments of the lowest tier that has that many in a row."""
+        tiers = [self.__tier(count) for _, _, count in self.segments]
+        best = None
+        start = 0
+        while start < len(tiers):
+            end = start
+            while end < len(tiers) and tiers[end] == tiers[start]:
+                end += 1
+            if end - start >= self.merge_factor and (best is None or tiers[start] < tiers[best]): best = start
+            start = end
+        return (best, best + self.merge_factor) if best is not None else None
+
+    def __start_merge(self):
+        with self.__lock:
+            if self.__merger is not None and self.__merger.is_alive(): return
+            if self.__next_merge() is None: return
+            # Off the flush path, the indexers keep flushing while segments are merged
+            self.__merger = threading.Thread(target=self.__merge_all, name="graph-merge")
+            self.__merger.start()
+
+    def wait_for_merges(self):
+        merger = self.__merger
+        if merger is not None: merger.join()
+
+    def __merge_all(self):
+        while True:
+            with self.__lock:
+                bounds = self.__next_merge()
+            if bounds is None: return
+
+            try:
+                self.__merge(*bounds)
+            except Exception as e:
+                print(f"Link graph merge error: {e}")
+                return
+
+    def __merge(self, start: int, end: int):
+        # Flushes only append segments, the ones being merged keep their place while this runs
+        with self.__lock:
+            run = self.segments[start:end]
+            first = self.segments[start - 1][1] + 1 if start > 0 else 1
+
+        sequence = run[-1][1]
+        name = f"links_{first:08d}-{sequence:08d}.seg"
+        count = write_records(os.path.join(self.path, name), merged_records([(os.path.join(self.path, old), old_sequence) for old, old_sequence, _ in run]))
+
+        with self.__lock:
+            position = self.segments.index(run[0])
+            self.segments[position:position + len(run)] = [(name, sequence, count)]
+            self.__write_manifest()
+
+        for old, _, _ in run:
+            try:
+                os.remove(os.path.join(self.path, old))
+            except OSError as e:
+                print(e)
+
+    def changed_since(self, sequence: int = 0, anchors: bool = True) -> tuple[dict[int, tuple[array, list[str]]], int]:
+        """
+        The newest record of every page flushed after `sequence`, and the sequence they go up to.
+        Merged segments only give back their records written after `sequence`. Without `anchors`
+        the anchor texts are skipped and come back empty.
+        """
+        while True:
+            self.refresh()
+            with self.__lock:
+                segments = list(self.segments)
+                current = self.sequence
+
+            records = {}
+            try:
+                for name, segment_sequence, _ in segments:
+                    if segment_sequence > sequence: records.update(read_records(os.path.join(self.path, name), segment_sequence, anchors, since=sequence))
+            except FileNotFoundError:
+                # Merged away while reading, the manifest already lists the replacement
+                continue
+
+            return records, current
@@ -0,0 +1,207 @@
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+# Upper bounds in seconds, from a millisecond to a minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: dict[str, str], **extra: str) -> str:
+    labels = {**labels, **extra}
+    if not labels: return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class Counter:
+    """A total that only goes up, incremented by its owner or read from `callback`, e.g. a count kept by another object."""
+
+    def __init__(self, labels: dict[str, str], callback: Callable[[], float] | None = None):
+        self.labels = labels
+        self.callback = callback
+        self.value = 0.0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.__lock:
+            self.value += amount
+
+    def render(self, name: str) -> list[str]:
+        value = self.value
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                value = math.nan
+        return [f"{name}{format_labels(self.labels)} {value}"]
+
+
+class Gauge:
+    """A value set by its owner, or read from `callback` whenever the metrics are scraped."""
+
+    def __init__(self, labels: dict[str, str], callback: Callable[[], float] | None = None):
+        self.labels = labels
+        self.callback = callback
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str) -> list[str]:
+        value = self.value
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                # Not known right now, Prometheus drops NaN samples
+                value = math.nan
+        return [f"{name}{format_labels(self.labels)} {value}"]
+
+
+class Timer:
+    def __init__(self, histogram: 'Histogram'):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+NO_TIMER = NoTimer()
+
+
+class Histogram:
+    """
+    Latency distribution in fixed buckets. `time` only measures one call in `sample`, the others
+    cost a counter increment, so hot paths can be timed. The count is of the observed calls.
+    """
+
+    def __init__(self, labels: dict[str, str], buckets: tuple[float, ...] = LATENCY_BUCKETS, sample: int = 1):
+        self.labels = labels
+        self.buckets = buckets
+        self.sample = max(sample, 1)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.__calls = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> Timer | NoTimer:
+        # Not locked, a lost increment only shifts which call gets sampled
+        self.__calls += 1
+        if self.__calls % self.sample: return NO_TIMER
+        return Timer(self)
+
+    def render(self, name: str) -> list[str]:
+        with self.__lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(self.labels, le=str(bound))} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(self.labels, le='+Inf')} {count}")
+        lines.append(f"{name}_sum{format_labels(self.labels)} {total}")
+        lines.append(f"{name}_count{format_labels(self.labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of the process by name and labels, rendered in the Prometheus
+    text format. Asking for a metric that already exists returns it, so modules define theirs at
+    import time. Histograms sample one timing in `sample` unless they ask for another rate.
+    """
+
+    def __init__(self, sample: int = 1):
+        self.sample = sample
+        # name -> (type, help, {labels: metric})
+        self.__families: dict[str, tuple[str, str, dict]] = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, kind: str, name: str, help: str, labels: dict[str, str], create: Callable):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None: family = self.__families[name] = (kind, help, {})
+            if family[0] != kind: raise ValueError(f"{name} is already a {family[0]}")
+
+            metric = family[2].get(key)
+            if metric is None: metric = family[2][key] = create()
+            return metric
+
+    def counter(self, name: str, help: str, callback: Callable[[], float] | None = None, **labels: str) -> Counter:
+        counter = self.__get('counter', name, help, labels, lambda: Counter(labels, callback))
+        if callback is not None: counter.callback = callback
+        return counter
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float] | None = None, **labels: str) -> Gauge:
+        gauge = self.__get('gauge', name, help, labels, lambda: Gauge(labels, callback))
+        if callback is not None: gauge.callback = callback
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS, sample: int | None = None, **labels: str) -> Histogram:
+        return self.__get('histogram', name, help, labels, lambda: Histogram(labels, buckets, self.sample if sample is None else sample))
+
+    def render(self) -> str:
+        with self.__lock:
+            families = [(name, kind, help, list(metrics.values())) for name, (kind, help, metrics) in self.__families.items()]
+
+        lines = []
+        for name, kind, help, metrics in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in metrics:
+                lines += metric.render(name)
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1', registry: MetricsRegistry | None = None) -> ThreadingHTTPServer:
+    """Serves the registry on http://host:port/metrics from a daemon thread, `shutdown` stops it."""
+    registry = registry if registry is not None else metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+metrics = MetricsRegistry(sample=int(os.environ.get('SEARCHENGINE_METRICS_SAMPLE', 10)))
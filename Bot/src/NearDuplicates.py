@@ -0,0 +1,91 @@
+import asyncio
+import redis.asyncio as aioredis
+
+from src.helpers.SimHash import bands, hamming_distance, simhash
+
+# Deletes the field ARGV[1] of each band hash in KEYS that still points to the url ARGV[2]
+RELEASE_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call('HGET', KEYS[i], ARGV[1]) == ARGV[2] then redis.call('HDEL', KEYS[i], ARGV[1]) end
+end
+return 0
+"""
+
+
+class NearDuplicateIndex:
+    """
+    SimHash fingerprints of the indexed pages in an LSH table in Redis, shared by every indexer.
+    The fingerprint is cut in `max_distance + 1` bands and each band value is a hash of
+    fingerprint -> url, so a page within `max_distance` bits of another one shares a bucket with it.
+    Only canonical pages are added, the first page of a cluster to be indexed is its canonical url.
+    The current fingerprint of each canonical url is kept in the `<prefix>:urls` hash, the bands of
+    an older one are released when the page changes or becomes a duplicate itself.
+    """
+
+    def __init__(self, r: aioredis.Redis, max_distance: int = 3, prefix: str = 'simhash'):
+        self.r = r
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.prefix = prefix
+        self.urls_key = f"{prefix}:urls"
+        self.__release = r.register_script(RELEASE_SCRIPT)
+
+    def __keys(self, fingerprint: int) -> list[str]:
+        return [f"{self.prefix}:{i}:{band:x}" for i, band in enumerate(bands(fingerprint, self.bands))]
+
+    async def __release_bands(self, pipe, field: bytes, url: bytes):
+        # Queued in the pipeline, awaiting the script only adds it
+        await self.__release(keys=self.__keys(int(field, 16)), args=[field, url], client=pipe)
+
+    async def canonical(self, pages: list[dict]) -> list[str | None]:
+        """The canonical url of each page that is a near duplicate of another one, None for the others."""
+        if not pages: return []
+        fingerprints = await asyncio.to_thread(lambda: [simhash(page['text']) for page in pages])
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hmget(self.urls_key, [page['url'] for page in pages])
+        for fingerprint in fingerprints:
+            if fingerprint is None: continue
+            for key in self.__keys(fingerprint):
+                pipe.hgetall(key)
+        results = await pipe.execute()
+        previous = results[0]
+        buckets = iter(results[1:])
+
+        canonicals = []
+        # Canonical pages of this batch, not in Redis yet
+        added: dict[str, dict[bytes, bytes]] = {}
+        pipe = self.r.pipeline(transaction=False)
+
+        for page, fingerprint, old_field in zip(pages, fingerprints, previous):
+            if fingerprint is None:
+                canonicals.append(None)
+                continue
+
+            url = page['url'].encode('utf-8')
+            keys = self.__keys(fingerprint)
+            nearest, nearest_distance = None, self.max_distance + 1
+            for key in keys:
+                for field, candidate in {**next(buckets), **added.get(key, {})}.items():
+                    distance = hamming_distance(fingerprint, int(field, 16))
+                    if distance < nearest_distance: nearest, nearest_distance = candidate, distance
+
+            # A page crawled again matches its own fingerprint
+            if nearest is not None and nearest != url:
+                canonicals.append(nearest.decode('utf-8'))
+                # Indexed as a canonical page before, other pages no longer cluster around it
+                if old_field is not None:
+                    await self.__release_bands(pipe, old_field, url)
+                    pipe.hdel(self.urls_key, url)
+                continue
+
+            canonicals.append(None)
+            field = f"{fingerprint:016x}".encode('utf-8')
+            if old_field is not None and old_field != field: await self.__release_bands(pipe, old_field, url)
+            pipe.hset(self.urls_key, url, field)
+            for key in keys:
+                added.setdefault(key, {}).setdefault(field, url)
+                pipe.hsetnx(key, field, url)
+
+        await pipe.execute()
+        return canonicals
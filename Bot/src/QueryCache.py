@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+import redis
+
+
+class Generation:
+    """
+    Counter bumped whenever search results may change: indexer flushes and PageRank runs.
+    Kept in Redis so every process agrees on it, cached results of older generations are never served.
+    """
+
+    def __init__(self, r: redis.Redis | None = None, key: str = 'search_generation'):
+        self.r = r if r is not None else redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+        self.key = key
+
+    def bump(self):
+        try:
+            self.r.incr(self.key)
+        except Exception as e:
+            print(e)
+
+    def current(self) -> int | None:
+        try:
+            return int(self.r.get(self.key) or 0)
+        except Exception as e:
+            print(e)
+            return None
+
+
+class QueryCache:
+    """
+    Results of recent queries keyed by their sorted term set and page. An in-process LRU bounded
+    by `max_size` and `ttl`, optionally backed by Redis so the frontend workers share their results.
+    Entries are tagged with the generation they were computed at and only served for that generation.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 300, r: redis.Redis | None = None, prefix: str = 'query_cache'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.r = r
+        self.prefix = prefix
+        # key -> (expires, generation, value)
+        self.__entries: OrderedDict[str, tuple[float, str, object]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(terms: list[str], page: int, **options) -> str:
+        # The order and repetitions of the terms don't change the results
+        key = " ".join(sorted(set(terms))) + f"|{page}"
+        for name in sorted(options):
+            key += f"|{name}={options[name]}"
+        return key
+
+    def get(self, key: str, generation: str):
+        now = time.time()
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                expires, entry_generation, value = entry
+                if expires > now and entry_generation == generation:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__entries[key]
+
+        if self.r is not None:
+            try:
+                data = self.r.get(f"{self.prefix}:{generation}:{key}")
+                if data is not None:
+                    value = json.loads(data)
+                    self.__store(key, generation, value)
+                    with self.__lock:
+                        self.shared_hits += 1
+                    return value
+            except Exception as e:
+                print(e)
+
+        # Called from worker threads, the counters are only updated under the lock
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, generation: str, value):
+        self.__store(key, generation, value)
+
+        if self.r is not None:
+            try:
+                # The generation is part of the key, entries of older generations expire on their own
+                self.r.set(f"{self.prefix}:{generation}:{key}", json.dumps(value), ex=max(int(self.ttl), 1))
+            except Exception as e:
+                print(e)
+
+    def __store(self, key: str, generation: str, value):
+        with self.__lock:
+            self.__entries[key] = (time.time() + self.ttl, generation, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "entries": len(self.__entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0
+        }
@@ -0,0 +1,360 @@
+import heapq
+import math
+import os
+import threading
+from array import array
+from bisect import bisect_left
+import numpy as np
+
+from src.InvertedIndex import UNBOUNDED, DocTable, Segment, SegmentIndexBackend
+from src.LinkGraph import DEFAULT_GRAPH_PATH
+from src.Metrics import metrics
+from src.Ranker import DEFAULT_RANK_PATH, RankState
+
+# Past every doc id
+END = 1 << 32
+
+QUERY_SECONDS = {mode: metrics.histogram('query_seconds', "Time to find the top results of a query", mode=mode) for mode in ('conjunctive', 'disjunctive')}
+
+
+class SegmentCursor:
+    """Walks the live postings of a term in one segment, decoding a block only once it is reached."""
+
+    def __init__(self, segment: Segment, blocks: list, ordinal: int, doc_segment: array):
+        self.blocks = blocks
+        self.doc = -1
+        self.tf = 0
+        self.__segment = segment
+        self.__ordinal = ordinal
+        self.__doc_segment = doc_segment
+        self.__block = 0
+        self.__pos = 0
+        self.__ids, self.__freqs = segment.decode_block(blocks[0])
+        self.__settle()
+
+    def __load(self, block: int):
+        self.__block = block
+        self.__pos = 0
+        if block < len(self.blocks): self.__ids, self.__freqs = self.__segment.decode_block(self.blocks[block])
+
+    def __settle(self):
+        # Moves to the first posting of a document whose newest version is in this segment
+        while self.__block < len(self.blocks):
+            if self.__pos >= len(self.__ids):
+                self.__load(self.__block + 1)
+                continue
+
+            doc_id = self.__ids[self.__pos]
+            if doc_id < len(self.__doc_segment) and self.__doc_segment[doc_id] == self.__ordinal:
+                self.doc = doc_id
+                self.tf = self.__freqs[self.__pos]
+                return
+            self.__pos += 1
+
+        self.doc = END
+
+    def next(self):
+        self.__pos += 1
+        self.__settle()
+
+    def next_geq(self, target: int):
+        if self.doc >= target: return
+
+        # Whole blocks are skipped on their last doc id without being decoded
+        block = self.__block
+        while block < len(self.blocks) and self.blocks[block][0] < target:
+            block += 1
+        if block != self.__block: self.__load(block)
+        if block >= len(self.blocks):
+            self.doc = END
+            return
+
+        self.__pos = bisect_left(self.__ids, target, self.__pos)
+        self.__settle()
+
+    def block_at(self, target: int) -> tuple[int, int, int] | None:
+        """Last doc id, max term frequency and min document length of the block that would hold `target`."""
+        block = self.__block
+        while block < len(self.blocks) and self.blocks[block][0] < target:
+            block += 1
+        if block >= len(self.blocks): return None
+        last, _, _, _, _, max_tf, min_length = self.blocks[block]
+        return last, max_tf, min_length
+
+
+class TermCursor:
+    """The postings of a term over every segment, a document is live in a single one of them."""
+
+    def __init__(self, cursors: list[SegmentCursor], doc_freq: int, doc_count: int, avg_length: float, k1: float, b: float):
+        self.cursors = cursors
+        self.k1 = k1
+        self.b = b
+        self.avg_length = avg_length or 1.0
+        # Stale postings of re-indexed documents are counted too, don't let the frequency pass the document count
+        doc_freq = min(doc_freq, doc_count)
+        self.idf = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        self.upper = max(self.bound(max(block[5] for block in cursor.blocks), min(block[6] for block in cursor.blocks)) for cursor in cursors)
+        self.doc = min(cursor.doc for cursor in cursors)
+
+    def score(self, tf: int, length: int) -> float:
+        return self.idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.avg_length))
+
+    def bound(self, max_tf: int, min_length: int) -> float:
+        # The score grows with the term frequency and shrinks with the document length
+        if max_tf == UNBOUNDED: return self.idf * (self.k1 + 1)
+        return self.score(max_tf, min_length)
+
+    @property
+    def tf(self) -> int:
+        for cursor in self.cursors:
+            if cursor.doc == self.doc: return cursor.tf
+        return 0
+
+    def next(self):
+        for cursor in self.cursors:
+            if cursor.doc == self.doc: cursor.next()
+        self.doc = min(cursor.doc for cursor in self.cursors)
+
+    def next_geq(self, target: int):
+        for cursor in self.cursors:
+            cursor.next_geq(target)
+        self.doc = min(cursor.doc for cursor in self.cursors)
+
+    def block_bound(self, target: int) -> tuple[float, int]:
+        """Bound of the score of the documents from `target` up to the returned doc id."""
+        bound = 0.0
+        last = END
+        for cursor in self.cursors:
+            block = cursor.block_at(target)
+            if block is None: continue
+            block_last, max_tf, min_length = block
+            bound = max(bound, self.bound(max_tf, min_length))
+            last = min(last, block_last)
+        return bound, last
+
+
+class QueryEngine:
+    """
+    Top-k retrieval over the segment index. Documents are scored with BM25 plus a weighted
+    PageRank prior, and evaluated with block-max WAND: per term and per block score bounds let it
+    skip every document that can't make it into the top k, so common terms don't mean scoring
+    and sorting every match.
+    """
+
+    def __init__(self, index: SegmentIndexBackend, rank_path: str = DEFAULT_RANK_PATH, graph_path: str = DEFAULT_GRAPH_PATH, k1: float = 1.2, b: float = 0.75, rank_weight: float = 1.0):
+        self.index = index
+        self.rank_path = os.path.abspath(rank_path)
+        self.k1 = k1
+        self.b = b
+        self.rank_weight = rank_weight
+
+        self.__graph_docs = DocTable(os.path.join(os.path.abspath(graph_path), 'docs.tsv'))
+        # Link graph id of each index doc id, -1 while the graph doesn't have its url
+        self.__graph_ids = np.zeros(0, dtype=np.int64)
+        # Weighted PageRank prior of each link graph id, None without ranks
+        self.__ranks: np.ndarray | None = None
+        self.__rank_mtime = None
+        # PageRank prior of each document, by index doc id
+        self.__prior = np.zeros(0, dtype=np.float32)
+        self.__prior_max = 0.0
+        self.__lock = threading.Lock()
+
+    def __load_prior(self):
+        """
+        Reloads the ranks when a rank run saved new ones, otherwise only the documents indexed
+        since the last query are looked up in the link graph.
+        """
+        try:
+            mtime = os.stat(os.path.join(self.rank_path, 'meta.json')).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        with self.__lock:
+            doc_count = len(self.index.docs)
+            reload = mtime != self.__rank_mtime
+            if not reload and doc_count == len(self.__prior): return
+
+            known = len(self.__graph_ids)
+            if doc_count > known: self.__graph_ids = np.concatenate([self.__graph_ids, np.full(doc_count - known, -1, dtype=np.int64)])
+
+            if reload:
+                state = RankState.load(self.rank_path) if mtime is not None else None
+                if state is not None and len(state.ranks):
+                    # An average page has rank 1 / pages, the prior grows with the log of how far above that a page is
+                    self.__ranks = (self.rank_weight * np.log1p(state.ranks * len(state.ranks))).astype(np.float32)
+                else:
+                    self.__ranks = None
+                self.__rank_mtime = mtime
+                # Pages the link graph didn't have on disk before may be there now
+                unmapped = np.flatnonzero(self.__graph_ids < 0)
+            else:
+                unmapped = np.arange(len(self.__prior), doc_count)
+
+            if self.__ranks is None:
+                self.__prior = np.zeros(doc_count, dtype=np.float32)
+                self.__prior_max = 0.0
+                return
+
+            if len(unmapped):
+                # The ranks are keyed by link graph ids, map them to index ids through the urls
+                self.__graph_docs.load()
+                graph_ids = self.__graph_docs.ids
+                urls = self.index.docs.urls
+                for doc_id in unmapped.tolist():
+                    self.__graph_ids[doc_id] = graph_ids.get(urls[doc_id], -1)
+
+            start = 0 if reload else len(self.__prior)
+            graph_ids = self.__graph_ids[start:doc_count]
+            ranked = (graph_ids >= 0) & (graph_ids < len(self.__ranks))
+            prior = np.zeros(len(graph_ids), dtype=np.float32)
+            prior[ranked] = self.__ranks[graph_ids[ranked]]
+
+            if reload:
+                self.__prior = prior
+                self.__prior_max = float(prior.max()) if len(prior) else 0.0
+            else:
+                self.__prior = np.concatenate([self.__prior, prior])
+                if len(prior): self.__prior_max = max(self.__prior_max, float(prior.max()))
+
+    def __cursors(self, terms: list[str]) -> list[TermCursor] | None:
+        segments, doc_segment = self.index.snapshot()
+        doc_count = max(self.index.doc_count, 1)
+        avg_length = self.index.total_length / doc_count
+
+        cursors = []
+        for term in terms:
+            segment_cursors = []
+            doc_freq = 0
+            for ordinal, segment in enumerate(segments):
+                blocks = segment.blocks(term)
+                if not blocks: continue
+                doc_freq += segment.terms[term][0]
+                segment_cursors.append(SegmentCursor(segment, blocks, ordinal, doc_segment))
+
+            if segment_cursors: cursors.append(TermCursor(segment_cursors, doc_freq, doc_count, avg_length, self.k1, self.b))
+            else: cursors.append(None)
+        return cursors
+
+    def search(self, terms: list[str], page: int = 0, page_size: int = 10, conjunctive: bool = True) -> tuple[list[tuple[str, float]], bool]:
+        """
+        One page of (url, score) results, best first, and whether there is a next page.
+        Conjunctive queries only match documents with every term, disjunctive ones any of them.
+        """
+        with QUERY_SECONDS['conjunctive' if conjunctive else 'disjunctive'].time():
+            return self.__search(terms, page, page_size, conjunctive)
+
+    def __search(self, terms: list[str], page: int, page_size: int, conjunctive: bool) -> tuple[list[tuple[str, float]], bool]:
+        self.index.refresh()
+        self.__load_prior()
+
+        terms = list(dict.fromkeys(terms))
+        if not terms: return [], False
+
+        cursors = self.__cursors(terms)
+        if conjunctive and None in cursors: return [], False
+        cursors = [cursor for cursor in cursors if cursor is not None]
+        if not cursors: return [], False
+
+        # One more than the page to know if there is a next one
+        k = (page + 1) * page_size + 1
+        if conjunctive: top = self.__conjunctive(cursors, k)
+        else: top = self.__disjunctive(cursors, k)
+
+        top.sort(reverse=True)
+        start = page * page_size
+        urls = self.index.docs.urls
+        results = [(urls[doc_id], score) for score, doc_id in top[start:start + page_size]]
+        return results, len(top) > start + page_size
+
+    def __score(self, cursors: list[TermCursor], doc_id: int) -> float:
+        length = self.index.docs.lengths[doc_id]
+        score = float(self.__prior[doc_id]) if doc_id < len(self.__prior) else 0.0
+        for cursor in cursors:
+            if cursor.doc == doc_id: score += cursor.score(cursor.tf, length)
+        return score
+
+    @staticmethod
+    def __push(top: list[tuple[float, int]], k: int, score: float, doc_id: int):
+        if len(top) < k: heapq.heappush(top, (score, doc_id))
+        elif score > top[0][0]: heapq.heapreplace(top, (score, doc_id))
+
+    def __disjunctive(self, cursors: list[TermCursor], k: int) -> list[tuple[float, int]]:
+        top: list[tuple[float, int]] = []
+
+        while True:
+            threshold = top[0][0] if len(top) >= k else -1.0
+            cursors.sort(key=lambda cursor: cursor.doc)
+
+            # Pivot: the first document whose terms could beat the k-th score
+            bound = self.__prior_max
+            pivot = -1
+            for i, cursor in enumerate(cursors):
+                if cursor.doc == END: break
+                bound += cursor.upper
+                if bound > threshold:
+                    pivot = i
+                    break
+            if pivot < 0: break
+
+            pivot_doc = cursors[pivot].doc
+            while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+                pivot += 1
+
+            # Same check with the bounds of the blocks holding the pivot
+            block_bound = self.__prior_max
+            boundary = END
+            for cursor in cursors[:pivot + 1]:
+                bound, last = cursor.block_bound(pivot_doc)
+                block_bound += bound
+                boundary = min(boundary, last)
+
+            if block_bound <= threshold:
+                # Nothing before the end of these blocks or the next term can make it
+                next_doc = min(boundary + 1, cursors[pivot + 1].doc if pivot + 1 < len(cursors) else END)
+                for cursor in cursors[:pivot + 1]:
+                    cursor.next_geq(next_doc)
+                continue
+
+            if cursors[0].doc == pivot_doc:
+                self.__push(top, k, self.__score(cursors, pivot_doc), pivot_doc)
+                for cursor in cursors:
+                    if cursor.doc == pivot_doc: cursor.next()
+            else:
+                for cursor in cursors[:pivot]:
+                    cursor.next_geq(pivot_doc)
+
+        return top
+
+    def __conjunctive(self, cursors: list[TermCursor], k: int) -> list[tuple[float, int]]:
+        top: list[tuple[float, int]] = []
+        upper = self.__prior_max + sum(cursor.upper for cursor in cursors)
+        # Rarest term first, it moves the others the furthest
+        cursors.sort(key=lambda cursor: cursor.idf, reverse=True)
+
+        while True:
+            candidate = max(cursor.doc for cursor in cursors)
+            if candidate == END: break
+            if len(top) >= k and upper <= top[0][0]: break
+
+            for cursor in cursors:
+                cursor.next_geq(candidate)
+            if any(cursor.doc != candidate for cursor in cursors): continue
+
+            if len(top) >= k:
+                block_bound = self.__prior_max
+                boundary = END
+                for cursor in cursors:
+                    bound, last = cursor.block_bound(candidate)
+                    block_bound += bound
+                    boundary = min(boundary, last)
+
+                if block_bound <= top[0][0]:
+                    for cursor in cursors:
+                        cursor.next_geq(boundary + 1)
+                    continue
+
+            self.__push(top, k, self.__score(cursors, candidate), candidate)
+            for cursor in cursors:
+                cursor.next()
+
+        return top
@@ -1,66 +1,156 @@
 from collections import deque
 import csv
 import json
+import os
+import socket
 import threading
 import time
+import uuid
+from src.Dedup import BLOOM_FUNCTIONS, Dedup, RedisBloomDedup
+from src.Metrics import metrics
 from src.helpers.DomainExtractor import CleanUrl, extract_domain
-from protego import Protego
+from src.helpers.QueuePayload import BlobStore, decode_page, encode_page
 import redis
+import redis.asyncio as aioredis
+
+# Work lives in Redis streams read through consumer groups. An entry stays pending until its
+# consumer acknowledges it, entries of a consumer that died are reclaimed by the others.
+HIGH_PRIORITY_STREAM = 'high_priority_stream'
+LOW_PRIORITY_STREAM = 'low_priority_stream'
+INDEXING_STREAM = 'indexing_stream'
+CRAWLER_GROUP = 'crawlers'
+INDEXER_GROUP = 'indexers'
+
+ENQUEUE_SECONDS = {queue: metrics.histogram('queue_enqueue_seconds', "Time to add work to a Redis queue", queue=queue) for queue in ('crawl', 'index')}
+ENQUEUED = {priority: metrics.counter('queue_enqueued_urls_total', "Urls added to the crawl queues", priority=priority) for priority in ('high', 'low')}
+
+# Lists used before the streams, their items are moved over on start
+LEGACY_QUEUES = {
+    'high_priority_queue': (HIGH_PRIORITY_STREAM, 'url'),
+    'low_priority_queue': (LOW_PRIORITY_STREAM, 'url'),
+    'indexing_queue': (INDEXING_STREAM, 'page'),
+}
+
+# Routes a batch of urls in one round trip: a url goes to the high priority queue if its domain
+# was never seen before, to the low priority queue otherwise. When the dedup lives in Redis the
+# urls are also deduplicated here. Scripts run atomically so no locking is needed on our side.
+# KEYS: the high and low priority streams, the keys of the dedup, then the `domain:` key of each
+# url. ARGV: the time, the dedup mode ('none', 'set' or 'bloom'), the bloom header in 'bloom' mode,
+# then the urls, each followed by its bit positions in 'bloom' mode. Returns the number of urls
+# queued in each stream and of bloom filters, -1 queued if the filter grew past the positions.
+# The keys have no hash tag, so the script needs a single Redis instance, not a Cluster.
+ENQUEUE_SCRIPT = BLOOM_FUNCTIONS + """
+local now = ARGV[1]
+local mode = ARGV[2]
+local domains, first, width = 2, 3, 0
+local bloom
+if mode == 'set' then
+    domains = 3
+elseif mode == 'bloom' then
+    bloom = bloom_open(3, 3)
+    if bloom.filters > bloom.given then return {-1, -1, bloom.filters} end
+    domains, first, width = 3 + bloom.given, bloom.args, bloom.width
+end
+
+local high, low, url_index = 0, 0, 0
+for i = first, #ARGV, width + 1 do
+    local url = ARGV[i]
+    local new = true
+    url_index = url_index + 1
+    if mode == 'set' then new = redis.call('SADD', KEYS[3], url) == 1
+    elseif mode == 'bloom' then new = bloom_add(bloom, i) end
+    if new then
+        if redis.call('SET', KEYS[domains + url_index], now, 'NX') then
+            redis.call('XADD', KEYS[1], '*', 'url', url)
+            high = high + 1
+        else
+            redis.call('XADD', KEYS[2], '*', 'url', url)
+            low = low + 1
+        end
+    end
+end
+return {high, low, bloom and bloom.filters or 0}
+"""
+
+def enqueue_arguments(urls: list[str], dedup: Dedup) -> tuple[list[str], list]:
+    mode, dedup_keys, args = dedup.enqueue_arguments(urls) or ('none', [], urls)
+    keys = [HIGH_PRIORITY_STREAM, LOW_PRIORITY_STREAM, *dedup_keys] + [f"domain:{extract_domain(url)}" for url in urls]
+    return keys, [json.dumps(time.time()), mode, *args]
+
+def enqueued(dedup: Dedup, result: list[int]) -> bool:
+    # The bloom filter grew since this process last looked, its positions are given for the new filter as well
+    if isinstance(dedup, RedisBloomDedup): dedup.filters = result[2]
+    return result[0] >= 0
+
+# Reserves the next slot of a domain in one round trip, returns how long to wait for it.
+# Returned as a string, Redis would truncate a Lua number to an integer
+COOLDOWN_SCRIPT = """
+local now = tonumber(ARGV[1])
+local next_cooldown = tonumber(redis.call('GET', KEYS[1]) or '0') or 0
+if next_cooldown < now then next_cooldown = now end
+redis.call('SET', KEYS[1], tostring(next_cooldown + tonumber(ARGV[2])))
+return tostring(next_cooldown - now)
+"""
 
 class QueueManager:
+    """
+    Sets up the queues and holds what the queue clients of a process share: dedup, blob store
+    and the stop flag. Work is taken off the queues through an AsyncQueueManager.
+    """
+
+    # Seconds between two requests to a domain without a crawl delay
+    default_cooldown = 2.0
+
+    def __init__(self, dedup: Dedup | None = None, spill_bytes: int = 0, r: redis.Redis | None = None, raw: redis.Redis | None = None, seed_urls: tuple[str, ...] = ("https://wikipedia.org",)):
+        self.r = r if r is not None else redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+        # The indexing queue holds binary payloads
+        self.raw = raw if raw is not None else redis.Redis(host='localhost', port=6379, db=0)
 
-    def __init__(self):
-        target_url = "https://wikipedia.org"
-        self.r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+        # Page texts over `spill_bytes` go to disk instead of Redis, 0 keeps everything in Redis
+        self.spill_bytes = spill_bytes
+        self.blobs = BlobStore() if spill_bytes else None
+
+        self.__create_groups()
+        self.__migrate()
 
         # create priority queues
-        self.r.lpush('high_priority_queue', target_url)
-        self.r.lpush('low_priority_queue', target_url)
+        for target_url in seed_urls:
+            self.r.xadd(HIGH_PRIORITY_STREAM, {'url': target_url})
+            self.r.xadd(LOW_PRIORITY_STREAM, {'url': target_url})
 
         # Keep track of all seens urls to avoid duplicates
-        self.__seen_lock = threading.Lock()
+        self.dedup = dedup if dedup is not None else RedisBloomDedup(self.r)
+
+        self.__enqueue = self.r.register_script(ENQUEUE_SCRIPT)
 
-        # Keep track of all visited domains to determine high and low priority urls
-        self.__visited_lock = threading.Lock()
-        
         self.__cooldowns_lock = threading.Lock()
 
         self.interrupted = False
 
-    def get_high_priority_url(self, count: int = 1) -> str | list[str] | None:
-        try:
-            return self.r.rpop('high_priority_queue', count=count)
-        except Exception as e:
-            print(e)
-            return None
-    
-    def get_low_priority_url(self, count: int = 1) -> str | list[str] | None:
-        try:
-            return self.r.rpop('low_priority_queue', count=count)
-        except Exception as e:
-            print(e)
-            return None
-        
-    def get_next_to_index(self, count: int = 1) -> list[dict[str, list[str]]] | dict[str, list[str]] | None:
-        try:
-            results = self.r.rpop('indexing_queue', count=count)
+    def __create_groups(self):
+        for key, group in [(HIGH_PRIORITY_STREAM, CRAWLER_GROUP), (LOW_PRIORITY_STREAM, CRAWLER_GROUP), (INDEXING_STREAM, INDEXER_GROUP)]:
+            try:
+                self.r.xgroup_create(key, group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e): raise
 
-            if(not results): return None
+    def __migrate(self, batch: int = 1000):
+        # Copied before being trimmed, a crash in between queues an item twice rather than losing it
+        for key, (stream, field) in LEGACY_QUEUES.items():
+            while True:
+                items = self.raw.lrange(key, -batch, -1)
+                if not items: break
+
+                pipe = self.raw.pipeline(transaction=False)
+                # Oldest item first, lists were pushed on the left and popped on the right
+                for item in reversed(items):
+                    pipe.xadd(stream, {field: item})
+                pipe.ltrim(key, 0, -len(items) - 1)
+                pipe.execute()
 
-            if(count > 1):
-                index_list: list[dict[str, list[str]]] = []
-                for item in results:
-                    index_list.append(json.loads(item))
-                return index_list
-            
-            return json.loads(results)
-        except Exception as e:
-            print(e)
-            return None
-    
     def get_next_cooldown(self, domain: str, cooldown_time: float = 0) -> float:
 
-        if(not cooldown_time): cooldown_time = 2.0
+        if(not cooldown_time): cooldown_time = self.default_cooldown
 
         with self.__cooldowns_lock:
             next_cooldown = self.r.get(f"domain:{domain}")
@@ -69,50 +159,44 @@ class QueueManager:
 
             self.r.set(f"domain:{domain}", json.dumps(next_cooldown + cooldown_time))
             return next_cooldown - time.time() if next_cooldown > time.time() else 0.0
-    
-    def check_robots(self, domain: str) -> bool:
+
+    def get_robots_txt(self, domain: str) -> str | None:
+        try:
+            return self.r.get(f"robots:{domain}")
+        except Exception as e:
+            print(e)
+            return None
+
+    def save_robots_txt(self, domain: str, text: str, ttl: float | None = None):
         try:
-            return not self.r.exists(f"robots:{domain}") == 0
+            self.r.set(f"robots:{domain}", text, ex=int(ttl) if ttl else None)
         except Exception as e:
             print(e)
 
-    def get_robots(self, domain: str):
-        text = self.r.get(f"robots:{domain}")
-        if(not text): text = ''
-        rp = Protego.parse(text)
-        return rp
-    
-    def save_robots_txt(self, domain: str, text: str):
+    def queue(self, urls: list[str]) -> tuple[int, int]:
+        # Unique urls of the page, in order
+        urls = list(dict.fromkeys(CleanUrl(url) for url in urls))
+
+        # A dedup in Redis is checked by the script itself, anything else is checked here first and
+        # only marked once the urls are queued, so a failed enqueue leaves them to be found again.
+        # Two crawlers of a process finding the same url at the same moment may both queue it
+        checked_here = self.dedup.enqueue_arguments([]) is None
+        if checked_here: urls = [url for url, seen in zip(urls, self.dedup.contains_many(urls)) if not seen]
+
+        if not urls: return 0, 0
+
         try:
-            self.r.set(f"robots:{domain}", text)
+            while not enqueued(self.dedup, result := self.__enqueue(*enqueue_arguments(urls, self.dedup))): pass
+            if checked_here: self.dedup.add_many(urls)
+            return result[0], result[1]
         except Exception as e:
             print(e)
-    
-    def queue(self, urls: list[str]):
-        for new_url in urls:
-            new_url = CleanUrl(new_url)
-
-            with self.__seen_lock:
-                if(self.r.sismember("seen_urls", new_url)): continue
-                self.r.sadd("seen_urls", new_url)
-            
-            domain = extract_domain(new_url)
-            with self.__visited_lock:
-                if(self.r.exists(f"domain:{domain}") == 0):
-                    self.r.set(f"domain:{domain}", json.dumps(time.time()))
-
-                    self.r.lpush('high_priority_queue', new_url)
-                else: self.r.lpush('low_priority_queue', new_url)
-
-    def queue_index(self, url: str, title: str, description: str, outgoing: list[str], text: str):
-        self.r.lpush('indexing_queue', json.dumps({
-            "url": [url],
-            "title": [title],
-            "description": [description],
-            "outgoing": outgoing,
-            "text": [text]
-        }))
-    
+            return 0, 0
+
+    def queue_index(self, url: str, title: str, description: str, outgoing: list[tuple[str, str]], text: str):
+        # Outgoing links are (url, anchor text) pairs
+        self.raw.xadd(INDEXING_STREAM, {'page': encode_page(url, title, description, outgoing, text, blobs=self.blobs, spill_bytes=self.spill_bytes)})
+
     def save(self):
         # ...
 
@@ -131,7 +215,7 @@ class QueueManager:
             writer.writeheader()
             while (
                 not self.__high_priority_queue.empty() or not self.__low_priority_queue.empty()
-            ):  
+            ):
                 # update the priority queue
                 if not self.__high_priority_queue.empty():
                     current_url = self.__high_priority_queue.get()
@@ -140,4 +224,211 @@ class QueueManager:
                 else:
                     break
                 writer.writerow({"Url": current_url})
-    
\ No newline at end of file
+
+
+class AsyncQueueManager:
+    """
+    Awaitable side of a QueueManager for the crawler and indexer event loops, so a Redis round
+    trip doesn't stall every fetch of the loop. Uses the same queues, dedup and blob store, and
+    stops with it. Connections come from a pool of `max_connections`, a coroutine waits for a
+    free connection instead of opening more. A pool belongs to the event loop that first used it.
+
+    Each instance is a consumer of its own. Reads block for up to `block` seconds when the queues
+    are empty. Taken entries are (key, entry id, item) and must be acknowledged with `ack` once
+    handled, every `reclaim_interval` seconds entries pending for more than `reclaim_idle` seconds
+    are taken over from consumers that stopped without acknowledging them.
+    """
+
+    def __init__(self, manager: QueueManager, max_connections: int = 32, host: str = 'localhost', port: int = 6379, db: int = 0, block: float = 1.0, reclaim_idle: float = 900, reclaim_interval: float = 60, r: aioredis.Redis | None = None):
+        self.manager = manager
+        self.default_cooldown = manager.default_cooldown
+        self.dedup = manager.dedup
+        self.spill_bytes = manager.spill_bytes
+        self.blobs = manager.blobs
+        self.block = block
+        self.reclaim_idle = reclaim_idle
+        self.reclaim_interval = reclaim_interval
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}:{uuid.uuid4().hex[:8]}"
+
+        # Replies are bytes, the indexing queue holds binary payloads
+        if r is None: r = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(host=host, port=port, db=db, max_connections=max_connections, timeout=None))
+        self.r = r
+        self.pool = r.connection_pool
+
+        self.__enqueue = self.r.register_script(ENQUEUE_SCRIPT)
+        self.__cooldown = self.r.register_script(COOLDOWN_SCRIPT)
+        self.__next_reclaim: dict[str, float] = {}
+
+    @property
+    def interrupted(self) -> bool:
+        return self.manager.interrupted
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        # A consumer without pending entries is forgotten, one with some is left for the others to reclaim
+        for key, group in [(HIGH_PRIORITY_STREAM, CRAWLER_GROUP), (LOW_PRIORITY_STREAM, CRAWLER_GROUP), (INDEXING_STREAM, INDEXER_GROUP)]:
+            try:
+                pending = await self.r.xpending_range(key, group, min='-', max='+', count=1, consumername=self.consumer)
+                if not pending: await self.r.xgroup_delconsumer(key, group, self.consumer)
+            except Exception as e:
+                print(e)
+
+        await self.r.aclose()
+        await self.pool.disconnect()
+
+    async def __reclaim(self, key: str, group: str, count: int) -> list[tuple[bytes, dict]]:
+        now = time.time()
+        if now < self.__next_reclaim.get(key, 0): return []
+        self.__next_reclaim[key] = now + self.reclaim_interval
+
+        # Entries deleted while pending are dropped from the group by Redis itself
+        _, entries, *_ = await self.r.xautoclaim(key, group, self.consumer, min_idle_time=int(self.reclaim_idle * 1000), start_id='0-0', count=count)
+
+        # Forget the consumers that stopped and have nothing left to reclaim
+        for consumer in await self.r.xinfo_consumers(key, group):
+            if consumer['pending'] == 0 and consumer['idle'] > self.reclaim_idle * 1000:
+                await self.r.xgroup_delconsumer(key, group, consumer['name'])
+        return entries
+
+    async def __read(self, keys: list[str], group: str, count: int, block: bool) -> list[tuple[str, str, dict]]:
+        try:
+            entries = []
+            for key in keys:
+                entries += [(key, entry_id, fields) for entry_id, fields in await self.__reclaim(key, group, count)]
+            if entries: return [(key, entry_id.decode('utf-8'), fields) for key, entry_id, fields in entries]
+
+            streams = await self.r.xreadgroup(group, self.consumer, {key: '>' for key in keys}, count=count, block=int(self.block * 1000) if block else None)
+            return [(key.decode('utf-8'), entry_id.decode('utf-8'), fields) for key, stream_entries in streams or [] for entry_id, fields in stream_entries]
+        except Exception as e:
+            print(e)
+            return []
+
+    async def __read_urls(self, keys: list[str], count: int, block: bool) -> list[tuple[str, str, str]]:
+        return [(key, entry_id, fields[b'url'].decode('utf-8')) for key, entry_id, fields in await self.__read(keys, CRAWLER_GROUP, count, block)]
+
+    async def get_high_priority_url(self, count: int = 1) -> list[tuple[str, str, str]]:
+        return await self.__read_urls([HIGH_PRIORITY_STREAM], count, False)
+
+    async def get_low_priority_url(self, count: int = 1) -> list[tuple[str, str, str]]:
+        return await self.__read_urls([LOW_PRIORITY_STREAM], count, False)
+
+    async def wait_for_urls(self, count: int = 1) -> list[tuple[str, str, str]]:
+        """Urls of either queue, blocking until some are queued or `block` seconds passed."""
+        return await self.__read_urls([HIGH_PRIORITY_STREAM, LOW_PRIORITY_STREAM], count, True)
+
+    async def ack(self, entries: list[tuple]):
+        """
+        Acknowledges (key, entry id) pairs and deletes them from their streams. Entries of pages
+        spilled to disk carry the name of the file as a third item, it is removed once acknowledged.
+        """
+        if not entries: return
+
+        ids: dict[str, list[str]] = {}
+        blobs = []
+        for key, entry_id, *blob in entries:
+            ids.setdefault(key, []).append(entry_id)
+            if blob and blob[0]: blobs.append(blob[0])
+
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for key, key_ids in ids.items():
+                pipe.xack(key, INDEXER_GROUP if key == INDEXING_STREAM else CRAWLER_GROUP, *key_ids)
+                pipe.xdel(key, *key_ids)
+            await pipe.execute()
+        except Exception as e:
+            print(e)
+            return
+
+        if blobs:
+            store = self.blobs or BlobStore()
+            for name in blobs:
+                store.remove(name)
+
+    async def requeue(self, entries: list[tuple[str, str, str]]):
+        # Urls taken off the queues but not crawled, they already passed the seen check
+        if not entries: return
+
+        try:
+            pipe = self.r.pipeline(transaction=False)
+            for _, _, url in entries:
+                pipe.xadd(LOW_PRIORITY_STREAM, {'url': url})
+            await pipe.execute()
+        except Exception as e:
+            print(e)
+            return
+
+        await self.ack([(key, entry_id) for key, entry_id, _ in entries])
+
+    async def get_next_to_index(self, count: int = 1) -> list[dict] | None:
+        """Pages to index, blocking until some are queued. Each has the `entry` to acknowledge once it's stored."""
+        entries = await self.__read([INDEXING_STREAM], INDEXER_GROUP, count, True)
+
+        if(not entries): return None
+
+        pages = []
+        broken = []
+        for key, entry_id, fields in entries:
+            try:
+                page = decode_page(fields[b'page'], self.blobs or BlobStore())
+                page['entry'] = (key, entry_id, page.pop('blob', None))
+                pages.append(page)
+            except Exception as e:
+                print(e)
+                # Would fail the same way for any other consumer
+                broken.append((key, entry_id))
+
+        await self.ack(broken)
+        return pages
+
+    async def get_next_cooldown(self, domain: str, cooldown_time: float = 0) -> float:
+        if(not cooldown_time): cooldown_time = self.default_cooldown
+
+        try:
+            wait = float(await self.__cooldown(keys=[f"domain:{domain}"], args=[json.dumps(time.time()), json.dumps(cooldown_time)]))
+            return max(wait, 0.0)
+        except Exception as e:
+            print(e)
+            return 0.0
+
+    async def get_robots_txt(self, domain: str) -> str | None:
+        try:
+            text = await self.r.get(f"robots:{domain}")
+            return text.decode('utf-8') if text is not None else None
+        except Exception as e:
+            print(e)
+            return None
+
+    async def save_robots_txt(self, domain: str, text: str, ttl: float | None = None):
+        try:
+            await self.r.set(f"robots:{domain}", text, ex=int(ttl) if ttl else None)
+        except Exception as e:
+            print(e)
+
+    async def queue(self, urls: list[str]) -> tuple[int, int]:
+        urls = list(dict.fromkeys(CleanUrl(url) for url in urls))
+
+        checked_here = self.dedup.enqueue_arguments([]) is None
+        if checked_here: urls = [url for url, seen in zip(urls, self.dedup.contains_many(urls)) if not seen]
+
+        if not urls: return 0, 0
+
+        try:
+            with ENQUEUE_SECONDS['crawl'].time():
+                while not enqueued(self.dedup, result := await self.__enqueue(*enqueue_arguments(urls, self.dedup))): pass
+            high, low = result[0], result[1]
+            if checked_here: self.dedup.add_many(urls)
+            ENQUEUED['high'].inc(high)
+            ENQUEUED['low'].inc(low)
+            return high, low
+        except Exception as e:
+            print(e)
+            return 0, 0
+
+    async def queue_index(self, url: str, title: str, description: str, outgoing: list[tuple[str, str]], text: str):
+        with ENQUEUE_SECONDS['index'].time():
+            await self.r.xadd(INDEXING_STREAM, {'page': encode_page(url, title, description, outgoing, text, blobs=self.blobs, spill_bytes=self.spill_bytes)})
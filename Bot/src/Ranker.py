@@ -1,84 +1,250 @@
 import asyncio
-from pymongo import TEXT, AsyncMongoClient, UpdateOne
-import networkx as nx
+import json
+import os
+import time
+from array import array
+import numpy as np
+from pymongo import ASCENDING, AsyncMongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.LinkGraph import LinkGraph
+from src.Metrics import metrics
+from src.QueryCache import Generation
+from src.helpers.DomainExtractor import extract_domain
+from src.helpers.PageRank import build_matrix, pagerank, pagerank_local
+
+DEFAULT_RANK_PATH = os.environ.get(
+    'SEARCHENGINE_RANK_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'rank')
+)
+
+RANK_SECONDS = metrics.histogram('rank_seconds', "Time to compute the ranks of a run", sample=1)
+SAVE_SECONDS = metrics.histogram('rank_save_seconds', "Time to write the ranks of a run", sample=1)
+RANKED_PAGES = metrics.gauge('rank_pages', "Pages in the graph of the last run")
+RANKED_LINKS = metrics.gauge('rank_links', "Links in the graph of the last run")
+SAVED_RANKS = metrics.counter('rank_saved_total', "Page ranks written to Mongo")
+
+def rank_state_path(path: str, aggregation: str) -> str:
+    # Page ranks are the ones the query engine reads, every other aggregation keeps its state apart
+    return path if aggregation == 'page' else os.path.join(path, aggregation)
+
+
+class RankState:
+    """Edges, crawled pages and rank vector of the last run, keyed by link graph ids, so the next one can start from them."""
+
+    def __init__(self, sources: np.ndarray, targets: np.ndarray, ranks: np.ndarray, crawled: np.ndarray, sequence: int, unsaved: np.ndarray | None = None):
+        self.sources = sources
+        self.targets = targets
+        self.ranks = ranks
+        self.crawled = crawled
+        # Last link graph flush included in the ranks
+        self.sequence = sequence
+        # Pages whose rank could not be written to Mongo, the next run writes them
+        self.unsaved = unsaved if unsaved is not None else np.zeros(0, dtype=np.uint32)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, 'graph.npz.tmp'), 'wb') as file:
+            np.savez(file, sources=self.sources, targets=self.targets, ranks=self.ranks, crawled=self.crawled, unsaved=self.unsaved)
+        with open(os.path.join(path, 'meta.json.tmp'), 'w', encoding='utf-8') as file:
+            json.dump({"sequence": self.sequence, "pages": len(self.ranks)}, file)
+
+        # The metadata goes last, it is only valid once the graph is in place
+        for name in ('graph.npz', 'meta.json'):
+            os.replace(os.path.join(path, name + '.tmp'), os.path.join(path, name))
+
+    @staticmethod
+    def load(path: str) -> 'RankState | None':
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            graph = np.load(os.path.join(path, 'graph.npz'))
+        except FileNotFoundError:
+            return None
+
+        # Written by an older version, keyed by urls instead of the link graph
+        if "sequence" not in meta or 'crawled' not in graph: return None
+        return RankState(graph['sources'], graph['targets'], graph['ranks'], graph['crawled'], meta["sequence"], graph['unsaved'] if 'unsaved' in graph else None)
+
 
 class Ranker:
-    def __init__(self, db: AsyncMongoClient, iterations: int):
+    def __init__(self, db: AsyncMongoClient, iterations: int, link_graph: LinkGraph | None = None, aggregation: str = 'page', alpha: float = 0.85, tolerance: float = 1e-6, path: str = DEFAULT_RANK_PATH, write_threshold: float = 0.01, chunk_size: int = 5000, max_in_flight: int = 4, retries: int = 3, generation: Generation | None = None):
         self.db = db["searchengine"]
-        self.outgoing = self.db['outgoing_links']
         self.pages = self.db['pages']
+        self.link_graph = link_graph if link_graph is not None else LinkGraph()
+        # 'page' ranks the page graph, 'host' ranks the graph of hosts and gives every page the rank of its host
+        self.aggregation = aggregation
         self.iterations = iterations
+        self.alpha = alpha
+        self.tolerance = tolerance
+        self.path = rank_state_path(os.path.abspath(path), aggregation)
+        # Incremental runs only write the ranks that moved by more than this fraction
+        self.write_threshold = write_threshold
+        self.chunk_size = chunk_size
+        # Bulk writes sent to Mongo at the same time
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        # Bumped after each run that changed ranks, so cached search results are recomputed
+        self.generation = generation
         pass
 
-    async def SaveRanks(self, operations: list):
-        try:
-            await self.pages.bulk_write(operations, ordered=False)
-            print(f"Saved {len(operations)}")
-        except Exception as e:
-            print(e)
-
-        return
-
-    async def PageRank(self):
-        outgoing = []
-        pages_dict = {}
-
-        async with self.outgoing.find() as cursor:
-            async for doc in cursor:
-                outgoing.append(doc)
-
-        async with self.pages.find() as cursor:
-            async for doc in cursor:
-                pages_dict[str(doc['url'])] = doc['_id']
-        
-        edges = []
-
-        for page in outgoing:
-            for url in page['outgoing']:
-                edges.append((page['url'], url))
+    async def SaveRanks(self, operations: list) -> list[int]:
+        # Unordered bulk write, on a partial failure only the failed operations are sent again.
+        # Returns the positions of the operations it gave up on
+        pending = list(range(len(operations)))
+        for attempt in range(self.retries + 1):
+            try:
+                await self.pages.bulk_write(operations, ordered=False)
+                return []
+            except BulkWriteError as e:
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                if not failed: return []
+                operations = [operation for index, operation in enumerate(operations) if index in failed]
+                pending = [position for index, position in enumerate(pending) if index in failed]
+                print(f"{len(operations)} rank updates failed, attempt {attempt + 1}")
+            except Exception as e:
+                print(e)
+
+            # No point waiting after the last attempt
+            if attempt < self.retries: await asyncio.sleep(0.5 * 2 ** attempt)
+
+        print(f"Gave up on {len(operations)} rank updates")
+        return pending
+
+    async def PageRank(self, incremental: bool = False):
+        state = RankState.load(self.path) if incremental else None
+
+        if incremental and state is None: print("No previous ranks, ranking from scratch")
+
+        # A full run reads every page, an incremental one the pages whose links changed since the last run
+        records, sequence = await asyncio.to_thread(self.link_graph.changed_since, state.sequence if state else 0, False)
+        urls = self.link_graph.docs.urls
+        pages = len(urls)
+
+        changed = np.fromiter(records.keys(), dtype=np.uint32, count=len(records))
+        targets = array('I')
+        for page_targets, _ in records.values():
+            targets += page_targets
+        targets = np.frombuffer(targets, dtype=np.uint32)
+        sources = np.repeat(changed, [len(page_targets) for page_targets, _ in records.values()]).astype(np.uint32)
+        del records
+
+        crawled = np.zeros(pages, dtype=bool)
+        if state: crawled[:len(state.crawled)] = state.crawled
+        crawled[changed] = True
+
+        previous = None
+        if state:
+            if len(changed) == 0 and pages == len(state.ranks) and len(state.unsaved) == 0:
+                print("No pages changed since the last run")
+                return
+
+            # Replace the links of the changed pages
+            kept = ~np.isin(state.sources, changed)
+            seeds = np.concatenate([state.targets[~kept], targets, np.arange(len(state.ranks), pages, dtype=np.uint32)])
+            sources = np.concatenate([state.sources[kept], sources])
+            targets = np.concatenate([state.targets[kept], targets])
+
+            # New pages start from the average rank
+            previous = np.concatenate([state.ranks, np.full(pages - len(state.ranks), 1.0 / pages)])
+
+        start = time.perf_counter()
+
+        if self.aggregation == 'host':
+            ranks, iterations, links = self.__host_rank(urls[:pages], sources, targets)
+        else:
+            matrix, out_degree = build_matrix(sources, targets, pages)
+            links = matrix.nnz
+
+            if previous is None: ranks, iterations = pagerank(matrix, out_degree, alpha=self.alpha, max_iter=self.iterations, tol=self.tolerance)
+            else: ranks, iterations = pagerank_local(matrix, out_degree, previous / previous.sum(), seeds, alpha=self.alpha, max_iter=self.iterations, tol=self.tolerance)
+
+        elapsed = time.perf_counter() - start
+        RANK_SECONDS.observe(elapsed)
+        RANKED_PAGES.set(pages)
+        RANKED_LINKS.set(links)
+        print(f"Ranked {pages} pages and {links} links in {elapsed}s ({iterations} iterations, {len(changed)} changed pages)")
+
+        # Only crawled pages have a document to write to, the others are just link targets
+        if previous is None: to_write = np.flatnonzero(crawled)
+        else:
+            moved = np.abs(ranks - previous) > self.write_threshold * previous
+            moved[len(state.ranks):] = True
+            to_write = np.flatnonzero(moved & crawled)
+            # Ranks the last run failed to write are sent again
+            to_write = np.union1d(to_write, state.unsaved).astype(np.int64)
+
+        await self.__ensure_indexes()
+        with SAVE_SECONDS.time():
+            unsaved = await self.__write_ranks(urls, ranks, to_write)
+
+        RankState(sources, targets, ranks, crawled, sequence, unsaved).save(self.path)
+
+        if self.generation is not None and len(to_write): self.generation.bump()
 
-        G = nx.DiGraph()
+        print("Done!")
 
-        G.add_edges_from(edges)
+        return
 
-        pagerank_scores = nx.pagerank(G, alpha=0.85)
+    def __host_rank(self, urls: list[str], sources: np.ndarray, targets: np.ndarray) -> tuple[np.ndarray, int, int]:
+        hosts: dict[str, int] = {}
+        host_of = np.fromiter((hosts.setdefault(extract_domain(url), len(hosts)) for url in urls), dtype=np.uint32, count=len(urls))
 
-        operations = []
+        # Links inside a host don't vote for it
+        source_hosts = host_of[sources]
+        target_hosts = host_of[targets]
+        external = source_hosts != target_hosts
 
-        for url, rank in pagerank_scores.items():
-            try:
-                operations.append(UpdateOne({
-                    '_id': pages_dict[url]
-                }, {
-                    "$set": {
-                        "rank": rank
-                    }
-                }))
-            except Exception:
-                continue
-        
-        print(f"Saving {len(operations)} page ranks...")
+        matrix, out_degree = build_matrix(source_hosts[external], target_hosts[external], len(hosts))
+        host_ranks, iterations = pagerank(matrix, out_degree, alpha=self.alpha, max_iter=self.iterations, tol=self.tolerance)
+        return host_ranks[host_of], iterations, matrix.nnz
 
-        chunks = []
+    async def __ensure_indexes(self):
+        # Ranks are written by url
+        try:
+            await self.pages.create_index([("url", ASCENDING)])
+        except Exception as e:
+            print(e)
 
-        chunk_size = 5000
+    async def __write_ranks(self, urls: list[str], ranks: np.ndarray, to_write: np.ndarray) -> np.ndarray:
+        print(f"Saving {len(to_write)} page ranks...")
 
-        while len(operations) > 0:
-            chunk = []
+        # Operations are built one chunk at a time, at most `max_in_flight` chunks are waiting on Mongo
+        in_flight: dict[asyncio.Task, np.ndarray] = {}
+        unsaved: list[np.ndarray] = []
 
-            for _ in range(chunk_size):
-                if(len(operations) == 0): break
-                chunk.append(operations.pop())
+        for start in range(0, len(to_write), self.chunk_size):
+            chunk = to_write[start:start + self.chunk_size]
+            operations = [
+                UpdateOne({"url": urls[page_id]}, {"$set": {"rank": rank}})
+                for page_id, rank in zip(chunk.tolist(), ranks[chunk].tolist())
+            ]
 
-            chunks.append(chunk)
+            if len(in_flight) >= self.max_in_flight:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                unsaved += [in_flight.pop(task)[task.result()] for task in done]
 
-        tasks = []
+            in_flight[asyncio.create_task(self.SaveRanks(operations))] = chunk
 
-        for chunk in chunks:
-            tasks.append(self.SaveRanks(chunk))
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            unsaved += [in_flight[task][task.result()] for task in done]
 
-        await asyncio.gather(*tasks, return_exceptions=True)
+        unsaved = np.concatenate(unsaved).astype(np.uint32) if unsaved else np.zeros(0, dtype=np.uint32)
+        saved = len(to_write) - len(unsaved)
+        SAVED_RANKS.inc(saved)
+        print(f"Saved {saved}" + (f", {len(unsaved)} left for the next run" if len(unsaved) else ""))
+        return unsaved
 
-        print("Done!")
+    async def run_periodically(self, manager, interval: float):
+        # Keeps the ranks fresh next to the crawl, each run only goes through what changed
+        while not manager.interrupted:
+            try:
+                await self.PageRank(incremental=True)
+            except Exception as e:
+                print(e)
 
-        return
\ No newline at end of file
+            next_run = time.time() + interval
+            while not manager.interrupted and time.time() < next_run:
+                await asyncio.sleep(1)
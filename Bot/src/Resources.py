@@ -0,0 +1,94 @@
+import threading
+import time
+from typing import Any, Callable
+
+# NLTK packages used by the tokenizer and where nltk.data keeps them
+NLTK_DATA = {
+    'stopwords': 'corpora/stopwords',
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'averaged_perceptron_tagger_eng': 'taggers/averaged_perceptron_tagger_eng',
+    'wordnet': 'corpora/wordnet',
+}
+
+
+def missing_nltk_data() -> list[str]:
+    """NLTK packages not found in the local data directories, nothing is downloaded."""
+    import nltk
+
+    missing = []
+    for package, path in NLTK_DATA.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(package)
+    return missing
+
+def download_nltk_data() -> list[str]:
+    import nltk
+
+    missing = missing_nltk_data()
+    for package in missing:
+        nltk.download(package, quiet=True)
+    return missing
+
+
+class ResourceRegistry:
+    """
+    Expensive resources (NLTK data, models) by name, loaded on first use or preloaded in the
+    background. Each is loaded once per process and shared by every thread that asks for it.
+    """
+
+    def __init__(self):
+        self.__loaders: dict[str, Callable[[], Any]] = {}
+        self.__loaded: dict[str, Any] = {}
+        self.__locks: dict[str, threading.Lock] = {}
+        self.load_seconds: dict[str, float] = {}
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        self.__loaders[name] = loader
+        self.__locks[name] = threading.Lock()
+
+    def loaded(self, name: str) -> bool:
+        return name in self.__loaded
+
+    def get(self, name: str) -> Any:
+        resource = self.__loaded.get(name)
+        if resource is not None: return resource
+
+        # Concurrent callers wait for a single load instead of loading their own copy
+        with self.__locks[name]:
+            if name not in self.__loaded:
+                start = time.perf_counter()
+                self.__loaded[name] = self.__loaders[name]()
+                self.load_seconds[name] = time.perf_counter() - start
+            return self.__loaded[name]
+
+    def preload(self, *names: str) -> threading.Thread:
+        def load():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"Could not preload {name}: {e}")
+
+        thread = threading.Thread(target=load, name="preload", daemon=True)
+        thread.start()
+        return thread
+
+
+def load_tokenizer():
+    missing = missing_nltk_data()
+    if missing: raise LookupError(f"Missing NLTK data {missing}, load it from the bot menu first")
+
+    # Imported here, importing nltk alone takes a good part of a second
+    from src.Tokenizer import get_tokenizer
+    return get_tokenizer()
+
+def load_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('all-MiniLM-L6-v2')
+
+
+resources = ResourceRegistry()
+resources.register('tokenizer', load_tokenizer)
+resources.register('embedding_model', load_embedding_model)
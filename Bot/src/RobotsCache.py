@@ -0,0 +1,120 @@
+import asyncio
+import time
+import aiohttp
+from protego import Protego
+
+from src.Metrics import metrics
+from src.Queue import AsyncQueueManager
+from src.helpers.DomainExtractor import extract_domain, find_robots_txt
+
+FETCH_SECONDS = metrics.histogram('robots_fetch_seconds', "Time to download a robots.txt file", sample=1)
+LOOKUPS = {result: metrics.counter('robots_lookups_total', "Robots rules lookups by cache result", result=result) for result in ('hit', 'stale', 'miss')}
+
+class RobotsEntry:
+
+    def __init__(self, parser: Protego, crawl_delay: float | None, expires: float, negative: bool):
+        self.parser = parser
+        self.crawl_delay = crawl_delay
+        self.expires = expires
+        # No robots.txt for the domain, everything is allowed
+        self.negative = negative
+
+
+class RobotsCache:
+    """
+    In-process cache of parsed robots.txt files keyed by domain. Expired entries keep being
+    served while a refresh runs in the background. Shared by the crawlers of a process, the raw
+    files are also kept in Redis so other processes don't fetch them again.
+    """
+
+    allow_all = Protego.parse('')
+
+    def __init__(self, ttl: float = 3600, negative_ttl: float = 600, max_size: int = 100_000, user_agent: str = '*', headers: dict[str, str] | None = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.user_agent = user_agent
+        self.headers = headers or {}
+        self.__entries: dict[str, RobotsEntry] = {}
+        self.__pending: dict[str, asyncio.Task] = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def __parse(self, text: str | None) -> RobotsEntry:
+        if not text:
+            return RobotsEntry(self.allow_all, None, time.time() + self.negative_ttl, True)
+
+        parser = Protego.parse(text)
+        return RobotsEntry(parser, parser.crawl_delay(self.user_agent), time.time() + self.ttl, False)
+
+    async def __fetch(self, session: aiohttp.ClientSession, url: str, domain: str, queue: AsyncQueueManager, refresh: bool) -> RobotsEntry:
+        try:
+            # Another process may have fetched it already
+            text = None if refresh else await queue.get_robots_txt(domain)
+
+            if text is None:
+                self.fetches += 1
+                text = ''
+                try:
+                    with FETCH_SECONDS.time():
+                        async with session.get(find_robots_txt(url), timeout=aiohttp.ClientTimeout(total=5), headers=self.headers) as response:
+                            if response.status == 200: text = await response.text()
+                except Exception:
+                    pass
+                await queue.save_robots_txt(domain, text, self.ttl if text else self.negative_ttl)
+
+            entry = self.__parse(text)
+        except Exception as e:
+            print(e)
+            entry = self.__parse(None)
+
+        if len(self.__entries) >= self.max_size and domain not in self.__entries:
+            # Evict the oldest entry
+            try:
+                self.__entries.pop(next(iter(self.__entries)), None)
+            except (StopIteration, RuntimeError):
+                pass
+        self.__entries[domain] = entry
+        return entry
+
+    def __start(self, session: aiohttp.ClientSession, url: str, domain: str, queue: AsyncQueueManager, refresh: bool) -> asyncio.Task:
+        task = self.__pending.get(domain)
+        # Tasks belong to the event loop of the crawler that started them
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(self.__fetch(session, url, domain, queue, refresh))
+            task.add_done_callback(lambda _: self.__pending.pop(domain, None) if self.__pending.get(domain) is task else None)
+            self.__pending[domain] = task
+        return task
+
+    async def get(self, session: aiohttp.ClientSession, url: str, queue: AsyncQueueManager) -> RobotsEntry:
+        domain = extract_domain(url)
+        entry = self.__entries.get(domain)
+
+        if entry is not None:
+            if entry.expires > time.time():
+                self.hits += 1
+                LOOKUPS['hit'].inc()
+            else:
+                self.stale_hits += 1
+                LOOKUPS['stale'].inc()
+                self.__start(session, url, domain, queue, True)
+            return entry
+
+        self.misses += 1
+        LOOKUPS['miss'].inc()
+        # Shielded, the fetch is shared with the other coroutines waiting on the same domain
+        return await asyncio.shield(self.__start(session, url, domain, queue, False))
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self.__entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0
+        }
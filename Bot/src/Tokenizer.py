@@ -0,0 +1,64 @@
+import signal
+import string
+from collections import Counter
+from nltk.tag.perceptron import PerceptronTagger
+from nltk.tokenize import word_tokenize
+from nltk.corpus import stopwords, wordnet
+from nltk.stem import WordNetLemmatizer
+
+from src.helpers.LemmaCache import LemmaCache
+
+class Tokenizer:
+
+    punctuation = str.maketrans('', '', string.punctuation + '’')
+
+    def __init__(self, cache_size: int = 200_000):
+        self.lemmatizer = WordNetLemmatizer()
+        self.cache = LemmaCache(self.lemmatizer, max_size=cache_size)
+        self.stop_words = set(stopwords.words())
+        # nltk.pos_tag loads the tagger model again on every call, keep one around instead
+        self.tagger = PerceptronTagger()
+        _ = wordnet.synsets('test') # Accessing it once to force loading
+
+    def clean_and_tokenize(self, text: str) -> list[str]:
+        text = " ".join(text.split())
+
+        text = text.translate(self.punctuation).lower()
+
+        tokens = word_tokenize(text)
+
+        filtered_tokens = [word for word in tokens if word not in self.stop_words]
+
+        filtered_tokens = [word for word in filtered_tokens if not len(word) > 30]
+
+        # The tagger needs the neighbours of a word to tell a verb from a noun, the whole sequence is tagged
+        return [self.cache.lemmatize(word, 'v' if tag.startswith('V') else 'n') for word, tag in self.tagger.tag(filtered_tokens)]
+
+    def count_tokens(self, text: str) -> dict[str, int]:
+        return dict(Counter(self.clean_and_tokenize(text)))
+
+    def saved_seconds(self) -> float:
+        # Estimated lemmatizer time the cache saved so far
+        return self.cache.stats()["saved_seconds"]
+
+    def count_tokens_batch(self, texts: list[str]) -> tuple[list[dict[str, int]], float]:
+        saved = self.saved_seconds()
+        token_counts = [self.count_tokens(text) for text in texts]
+        return token_counts, self.saved_seconds() - saved
+
+
+# One tokenizer per process, shared by the indexer threads or created by the pool initializer
+tokenizer: Tokenizer | None = None
+
+def get_tokenizer() -> Tokenizer:
+    global tokenizer
+    if tokenizer is None: tokenizer = Tokenizer()
+    return tokenizer
+
+def init_worker():
+    # Ctrl+C is handled by the parent, which shuts the pool down after the indexers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_tokenizer()
+
+def count_tokens_chunk(texts: list[str]) -> tuple[list[dict[str, int]], float]:
+    return get_tokenizer().count_tokens_batch(texts)
@@ -1,51 +1,165 @@
 import asyncio
 import csv
+import multiprocessing
+import signal
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pymongo import AsyncMongoClient, MongoClient
 from src.Crawler import Crawler
-from src.Queue import QueueManager
+from src.EmbeddingIndex import EmbeddingIndex
+from src.Frontier import PriorityPolicy
+from src.InvertedIndex import MongoIndexBackend, SegmentIndexBackend
+from src.LinkGraph import LinkGraph
+from src.Metrics import metrics, serve_metrics
+from src.Queue import HIGH_PRIORITY_STREAM, INDEXING_STREAM, LOW_PRIORITY_STREAM, AsyncQueueManager, QueueManager
+from src.QueryCache import Generation
+from src.Ranker import Ranker
+from src.RobotsCache import RobotsCache
 from src.Indexer import Indexer
+from src.Tokenizer import get_tokenizer, init_worker
+
+async def run_on_queue(manager: QueueManager, target, max_connections: int = 32):
+    # The event loop of the thread gets its own connection pool, connections can't move between loops
+    async with AsyncQueueManager(manager, max_connections=max_connections) as queue:
+        await target(queue)
+
+def run_crawler_process(high_share: float, max_concurrent: int, spill_bytes: int = 0, metrics_port: int | None = None):
+    # Each process has its own metrics, served on a port of its own
+    if metrics_port:
+        try:
+            serve_metrics(metrics_port)
+        except OSError as e:
+            print(f"Could not serve metrics on port {metrics_port}: {e}")
+
+    # The seen urls are in the Redis bloom filter, shared by every process and crawler mode
+    manager = QueueManager(spill_bytes=spill_bytes)
+    signal.signal(signal.SIGINT, lambda *_: setattr(manager, 'interrupted', True))
+
+    crawler = Crawler(high_priority=high_share >= 0.5, max_concurrent=max_concurrent, policy=PriorityPolicy(high_share))
+    asyncio.run(run_on_queue(manager, crawler.crawl))
 
 class Workers:
-    def __init__(self):
-        self.__manager = QueueManager()
+    def __init__(self, index_backend: str = 'segments', spill_bytes: int = 0):
+        # Texts over `spill_bytes` are queued for indexing on disk instead of in Redis
+        self.__manager = QueueManager(spill_bytes=spill_bytes)
+        self.spill_bytes = spill_bytes
+        self.__generation = Generation(self.__manager.r)
+        self.index_backend = index_backend
+
+        # Segments are written by a single instance shared between the indexer threads
+        if index_backend == 'segments': self.__segment_index = SegmentIndexBackend()
+
+        # Same for the link graph, the ranker thread reads from it too
+        self.__link_graph = LinkGraph()
+
+        # Parsed robots.txt files are shared by all the crawler threads
+        self.__robots = RobotsCache(user_agent=Crawler.user_agent, headers=Crawler.headers)
 
-    def new_crawler(self, high_priority: bool, max_concurrent: int):
-        crawler = Crawler(high_priority=high_priority, max_concurrent=max_concurrent)
+        self.__embeddings: EmbeddingIndex | None = None
+        self.__tokenizer_pool: ProcessPoolExecutor | None = None
+        self.__tokenizer_chunk_size = 8
 
-        asyncio.run(crawler.crawl(self.__manager))
+        # Read from Redis when the metrics are scraped
+        for key in (HIGH_PRIORITY_STREAM, LOW_PRIORITY_STREAM, INDEXING_STREAM):
+            metrics.gauge('queue_depth', "Entries waiting or in flight in a Redis queue", callback=lambda key=key: self.__manager.r.xlen(key), queue=key)
+
+    def new_crawler(self, high_priority: bool, max_concurrent: int, high_share: float | None = None):
+        policy = PriorityPolicy(high_share) if high_share is not None else None
+        crawler = Crawler(high_priority=high_priority, max_concurrent=max_concurrent, robots=self.__robots, policy=policy)
+
+        asyncio.run(run_on_queue(self.__manager, crawler.crawl))
     
     def new_indexer(self, max_concurrent: int):
-        indexer = Indexer(db= AsyncMongoClient("mongodb://localhost:27017/"), max_concurrent = max_concurrent)
-        asyncio.run(indexer.index(self.__manager))
+        db = AsyncMongoClient("mongodb://localhost:27017/")
+
+        if self.index_backend == 'mongo': index_backend = MongoIndexBackend(db["searchengine"]['indexes'])
+        else: index_backend = self.__segment_index
+
+        indexer = Indexer(db=db, index_backend=index_backend, link_graph=self.__link_graph, max_concurrent = max_concurrent, executor=self.__tokenizer_pool, chunk_size=self.__tokenizer_chunk_size, generation=self.__generation, embeddings=self.__embeddings)
+        asyncio.run(run_on_queue(self.__manager, indexer.index))
+
+    def new_ranker(self, interval: float, iterations: int, aggregation: str):
+        ranker = Ranker(db=AsyncMongoClient("mongodb://localhost:27017/"), iterations=iterations, link_graph=self.__link_graph, aggregation=aggregation, generation=self.__generation)
+        asyncio.run(ranker.run_periodically(self.__manager, interval))
+
+    def start(self, low_priority_crawlers: int, high_priority_crawlers: int, max_indexers: int, max_concurrent_crawler: int, max_concurrent_indexer: int, tokenizer_processes: int = 0, tokenizer_chunk_size: int = 8, crawler_mode: str = 'threads', crawler_processes: int = 1, rank_interval: float | None = None, rank_iterations: int = 100, rank_aggregation: str = 'page', embeddings: bool = False, metrics_port: int | None = None):
+
+        metrics_server = None
 
-    def start(self, low_priority_crawlers: int, high_priority_crawlers: int, max_indexers: int, max_concurrent_crawler: int, max_concurrent_indexer: int):
+        # Page embeddings for the semantic rerank, written by the indexers next to the lexical index
+        if embeddings: self.__embeddings = EmbeddingIndex()
+
+        # Tokenize in a pool of processes so the indexers aren't bound by the GIL, 0 tokenizes in the indexer threads
+        if tokenizer_processes > 0: self.__tokenizer_pool = ProcessPoolExecutor(max_workers=tokenizer_processes, initializer=init_worker)
+        else: get_tokenizer() # Load the models once before the indexer threads share them
+        self.__tokenizer_chunk_size = tokenizer_chunk_size
+
+        # Threads for each link
+        threads: list[threading.Thread] = []
+        processes: list[multiprocessing.Process] = []
 
         try:
-            # Start threads for each link
-            threads: list[threading.Thread] = []
+            if crawler_mode == 'async':
+                # One event loop, session and connector per process instead of one per crawler thread.
+                # The crawl slots of all the crawlers are pooled and split between the processes
+                crawlers = low_priority_crawlers + high_priority_crawlers
+                high_share = high_priority_crawlers / crawlers
+                max_concurrent = max(crawlers * max_concurrent_crawler // crawler_processes, 1)
 
-            for i in range(low_priority_crawlers):
-                # Using `args` to pass positional arguments and `kwargs` for keyword arguments
-                t = threading.Thread(target=self.new_crawler, args=[False, max_concurrent_crawler], daemon=False)
-                threads.append(t)
-            
-            for i in range(high_priority_crawlers):
-                # Using `args` to pass positional arguments and `kwargs` for keyword arguments
-                t = threading.Thread(target=self.new_crawler, args=[True, max_concurrent_crawler], daemon=False)
-                threads.append(t)
+                if crawler_processes > 1:
+                    for i in range(crawler_processes):
+                        processes.append(multiprocessing.Process(target=run_crawler_process, args=[high_share, max_concurrent, self.spill_bytes, metrics_port + 1 + i if metrics_port else None], daemon=False))
+                else:
+                    threads.append(threading.Thread(target=self.new_crawler, args=[False, max_concurrent, high_share], daemon=False))
+            else:
+                for i in range(low_priority_crawlers):
+                    # Using `args` to pass positional arguments and `kwargs` for keyword arguments
+                    t = threading.Thread(target=self.new_crawler, args=[False, max_concurrent_crawler], daemon=False)
+                    threads.append(t)
+                
+                for i in range(high_priority_crawlers):
+                    # Using `args` to pass positional arguments and `kwargs` for keyword arguments
+                    t = threading.Thread(target=self.new_crawler, args=[True, max_concurrent_crawler], daemon=False)
+                    threads.append(t)
 
             for i in range(max_indexers):
                 # Using `args` to pass positional arguments and `kwargs` for keyword arguments
                 t = threading.Thread(target=self.new_indexer, args=[max_concurrent_indexer], daemon=False)
                 threads.append(t)
             
-            # Start each thread
+            if rank_interval:
+                # Incremental page rank every `rank_interval` seconds while crawling
+                threads.append(threading.Thread(target=self.new_ranker, args=[rank_interval, rank_iterations, rank_aggregation], daemon=False))
+
+            # Start each process before any thread, so they are forked from a single threaded parent
+            for p in processes:
+                p.start()
+
+            # Prometheus text format on http://127.0.0.1:<metrics_port>/metrics, crawler processes take the next ports.
+            # Started after the forks, a child would inherit the listening socket and the server thread's state
+            if metrics_port:
+                try:
+                    metrics_server = serve_metrics(metrics_port)
+                except OSError as e:
+                    print(f"Could not serve metrics on port {metrics_port}: {e}")
+
             for t in threads:
                 t.start()
 
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
-            self.__manager.interrupted = True
\ No newline at end of file
+            self.__manager.interrupted = True
+
+            for t in threads:
+                t.join()
+
+            for p in processes:
+                p.join()
+
+            if self.__tokenizer_pool: self.__tokenizer_pool.shutdown()
+            if metrics_server: metrics_server.shutdown()
+
+            self.__manager.dedup.close()
+            print(f"Robots cache: {self.__robots.stats()}")
\ No newline at end of file
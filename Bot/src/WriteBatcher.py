@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+from pymongo import DeleteOne, UpdateOne
+
+from src.InvertedIndex import IndexBackend
+from src.LinkGraph import LinkGraph
+from src.Metrics import metrics
+from src.QueryCache import Generation
+
+FLUSH_SECONDS = metrics.histogram('indexer_flush_seconds', "Time to write a batch of pages, postings and links", sample=1)
+FLUSHED_PAGES = metrics.counter('indexer_flushed_pages_total', "Pages written by the write batchers")
+FLUSH_ERRORS = metrics.counter('indexer_flush_errors_total', "Batches that failed to be written")
+
+class WriteBatcher:
+    """
+    Collects the writes of many indexed pages and flushes them as one bulk write per
+    collection, either when `max_batch` pages are buffered or every `flush_interval` seconds.
+    At most one flush is in flight, pages keep buffering while it runs. Links go to the link
+    graph, which writes a segment once it has buffered enough of them.
+
+    Pages skipped as near duplicates are written to `duplicates` with their canonical url, their
+    `pages` document and postings are removed in case they were indexed before.
+
+    Queue entries of the pages are handed back by `durable` once the index backend has them on
+    disk. A backend holding documents in memory is flushed when entries waited `sync_interval` seconds.
+    """
+
+    def __init__(self, pages, link_graph: LinkGraph, index_backend: IndexBackend, max_batch: int = 500, flush_interval: float = 1.0, max_pending: int = 2000, generation: Generation | None = None, sync_interval: float = 30, duplicates=None):
+        self.pages = pages
+        self.duplicates = duplicates
+        self.link_graph = link_graph
+        self.index_backend = index_backend
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Bumped when a flush changes the search results, so cached ones are recomputed
+        self.generation = generation
+        self.__index_generation = index_backend.generation
+        self.sync_interval = sync_interval
+
+        # Keyed by url so a page indexed twice in a batch is only written once
+        self.__pages: dict[str, UpdateOne | DeleteOne] = {}
+        self.__documents: dict[str, Counter] = {}
+        self.__duplicates: dict[str, UpdateOne] = {}
+        self.__removed: set[str] = set()
+        self.__entries: list = []
+        # (buffer of the index backend, flush time, entries) of flushed pages not on disk yet
+        self.__unsynced: deque[tuple[int | None, float, list]] = deque()
+        self.__in_flight = 0
+        self.__flush_lock = asyncio.Lock()
+        self.__flushed = asyncio.Event()
+        self.__last_flush = time.perf_counter()
+
+        self.flushes = 0
+        self.flushed_pages = 0
+        self.flushed_operations = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    @property
+    def pending(self) -> int:
+        return len(self.__documents) + self.__in_flight
+
+    def capacity(self) -> int:
+        return max(self.max_pending - self.pending, 0)
+
+    async def wait_for_capacity(self):
+        # Backpressure: stop taking pages off the indexing queue while the database is behind
+        while self.pending >= self.max_pending:
+            self.__flushed.clear()
+            await self.__flushed.wait()
+
+    async def add(self, url: str, title: str, description: str, outgoing_links: list[tuple[str, str]], token_count: Counter, entry=None):
+        self.__pages[url] = UpdateOne(
+            {"url": url},
+            {
+                "$set": {"url": url, "title": title, "description": description},
+                "$setOnInsert": {"rank": 0}
+            },
+            upsert=True
+        )
+
+        self.link_graph.add(url, outgoing_links)
+
+        self.__documents[url] = token_count
+        self.__removed.discard(url)
+        if entry is not None: self.__entries.append(entry)
+
+        if len(self.__documents) >= self.max_batch and not self.__flush_lock.locked():
+            await self.flush()
+
+    async def add_duplicate(self, url: str, canonical: str, entry=None):
+        # The links to a duplicate count for its canonical page
+        self.link_graph.add(url, [(canonical, '')])
+
+        if self.duplicates is not None:
+            self.__duplicates[url] = UpdateOne({"url": url}, {"$set": {"url": url, "canonical": canonical}}, upsert=True)
+
+        # A page indexed before it became a duplicate leaves the results
+        self.__pages[url] = DeleteOne({"url": url})
+        self.__documents.pop(url, None)
+        self.__removed.add(url)
+        if entry is not None: self.__entries.append(entry)
+
+    async def run(self, manager):
+        while not manager.interrupted:
+            await asyncio.sleep(min(self.flush_interval, 0.1))
+            if self.__unsynced and time.time() - self.__unsynced[0][1] >= self.sync_interval and self.index_backend.written_buffers is not None and self.index_backend.written_buffers <= self.__unsynced[0][0]:
+                await self.index_backend.flush()
+            if not (self.__documents or self.__duplicates or self.__removed or self.__entries) or self.__flush_lock.locked(): continue
+            if len(self.__documents) >= self.max_batch or time.perf_counter() - self.__last_flush >= self.flush_interval:
+                await self.flush()
+
+    async def flush(self):
+        async with self.__flush_lock:
+            if not (self.__documents or self.__duplicates or self.__removed or self.__entries): return
+
+            pages = list(self.__pages.values())
+            documents = list(self.__documents.items())
+            duplicates = list(self.__duplicates.values())
+            removed = list(self.__removed)
+            entries = self.__entries
+            self.__pages = {}
+            self.__documents = {}
+            self.__duplicates = {}
+            self.__removed = set()
+            self.__entries = []
+            self.__in_flight = len(documents)
+
+            start = time.perf_counter()
+
+            writes = []
+            if pages: writes.append(self.pages.bulk_write(pages, ordered=False))
+            if documents: writes.append(self.index_backend.add_documents(documents))
+            if removed: writes.append(self.index_backend.remove_documents(removed))
+            if duplicates: writes.append(self.duplicates.bulk_write(duplicates, ordered=False))
+            if self.link_graph.should_flush(): writes.append(asyncio.to_thread(self.link_graph.flush))
+
+            try:
+                await asyncio.gather(*writes)
+                # Failed pages are never acknowledged, the queue hands them out again later
+                if entries: self.__unsynced.append((self.index_backend.current_buffer(), time.time(), entries))
+                # A segment index only shows new documents once it wrote a segment
+                if (documents or removed) and self.generation is not None and (self.index_backend.generation is None or self.index_backend.generation != self.__index_generation):
+                    self.__index_generation = self.index_backend.generation
+                    self.generation.bump()
+            except Exception as e:
+                FLUSH_ERRORS.inc()
+                print(f"{threading.current_thread().name} flush error: {e}")
+            finally:
+                self.__in_flight = 0
+                self.__last_flush = time.perf_counter()
+                self.__flushed.set()
+
+            elapsed = self.__last_flush - start
+            self.flushes += 1
+            self.flushed_pages += len(documents)
+            self.flushed_operations += len(pages) + len(documents) + len(duplicates) + len(removed)
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            FLUSH_SECONDS.observe(elapsed)
+            FLUSHED_PAGES.inc(len(documents))
+
+    def durable(self) -> list:
+        """Takes the queue entries of the flushed pages whose postings are on disk."""
+        written = self.index_backend.written_buffers
+        entries = []
+        while self.__unsynced and (written is None or self.__unsynced[0][0] < written):
+            entries += self.__unsynced.popleft()[2]
+        return entries
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "flushes": self.flushes,
+            "flushed_pages": self.flushed_pages,
+            "flushed_operations": self.flushed_operations,
+            "pending": self.pending,
+            "avg_flush_size": self.flushed_pages / self.flushes if self.flushes else 0,
+            "avg_flush_seconds": self.flush_seconds / self.flushes if self.flushes else 0,
+            "max_flush_seconds": self.max_flush_seconds
+        }
@@ -0,0 +1,139 @@
+import hashlib
+import math
+import os
+import struct
+
+FILTER_MAGIC = b'BLM1'
+FILTER_HEADER = struct.Struct('<QQQdQ')
+
+
+def hash_pair(item: str) -> tuple[int, int]:
+    digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+    # Double hashing, the second hash is forced odd so it never collapses to a single bit
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+def filter_size(capacity: int, error_rate: float) -> tuple[int, int]:
+    """Bits and hash functions of a filter holding `capacity` items at `error_rate`."""
+    size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+    return size, max(int(round(size / capacity * math.log(2))), 1)
+
+def positions(hashes: tuple[int, int], size: int, count: int) -> list[int]:
+    h1, h2 = hashes
+    return [(h1 + i * h2) % size for i in range(count)]
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float, bits: bytearray | None = None, count: int = 0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hashes = filter_size(capacity, error_rate)
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def __positions(self, hashes: tuple[int, int]):
+        return positions(hashes, self.size, self.hashes)
+
+    def contains(self, hashes: tuple[int, int]) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(hashes))
+
+    def add(self, hashes: tuple[int, int]):
+        bits = self.bits
+        for position in self.__positions(hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def fill_ratio(self) -> float:
+        return int.from_bytes(self.bits, 'little').bit_count() / self.size
+
+    def false_positive_rate(self) -> float:
+        return self.fill_ratio() ** self.hashes
+
+
+class ScalableBloomFilter:
+    """
+    Chain of bloom filters, a new and bigger filter with a tighter error rate is added once
+    the current one is full so the compound false positive rate stays under `error_rate`.
+    """
+
+    def __init__(self, initial_capacity: int = 1_000_000, error_rate: float = 0.001, growth: int = 2, tightening: float = 0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters: list[BloomFilter] = []
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+    def filter_parameters(self, index: int) -> tuple[int, float]:
+        """Capacity and error rate of the filter at `index` in the chain."""
+        return self.initial_capacity * self.growth ** index, self.error_rate * (1 - self.tightening) * self.tightening ** index
+
+    def __current(self) -> BloomFilter:
+        if not self.filters or self.filters[-1].full:
+            self.filters.append(BloomFilter(*self.filter_parameters(len(self.filters))))
+        return self.filters[-1]
+
+    def contains(self, item: str) -> bool:
+        hashes = hash_pair(item)
+        return any(bloom.contains(hashes) for bloom in self.filters)
+
+    def copy(self) -> 'ScalableBloomFilter':
+        scalable = ScalableBloomFilter(self.initial_capacity, self.error_rate, self.growth, self.tightening)
+        scalable.filters = [BloomFilter(bloom.capacity, bloom.error_rate, bytearray(bloom.bits), bloom.count) for bloom in self.filters]
+        return scalable
+
+    def add_many(self, items: list[str]) -> list[bool]:
+        # Returns for every item whether it was new, the item is added if it was
+        added = []
+        for item in items:
+            hashes = hash_pair(item)
+            if any(bloom.contains(hashes) for bloom in self.filters):
+                added.append(False)
+                continue
+            self.__current().add(hashes)
+            added.append(True)
+        return added
+
+    def fill_ratio(self) -> float:
+        return self.filters[-1].fill_ratio() if self.filters else 0.0
+
+    def false_positive_rate(self) -> float:
+        not_false_positive = 1.0
+        for bloom in self.filters:
+            not_false_positive *= 1 - bloom.false_positive_rate()
+        return 1 - not_false_positive
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(FILTER_MAGIC)
+            file.write(struct.pack('<QdQdI', self.initial_capacity, self.error_rate, self.growth, self.tightening, len(self.filters)))
+            for bloom in self.filters:
+                file.write(FILTER_HEADER.pack(bloom.capacity, bloom.count, len(bloom.bits), bloom.error_rate, bloom.size))
+                file.write(bloom.bits)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'ScalableBloomFilter':
+        with open(path, 'rb') as file:
+            if file.read(len(FILTER_MAGIC)) != FILTER_MAGIC: raise ValueError(f"{path} is not a bloom filter snapshot")
+
+            header = struct.Struct('<QdQdI')
+            initial_capacity, error_rate, growth, tightening, filter_count = header.unpack(file.read(header.size))
+            scalable = ScalableBloomFilter(initial_capacity, error_rate, growth, tightening)
+
+            for _ in range(filter_count):
+                capacity, count, length, bloom_error_rate, size = FILTER_HEADER.unpack(file.read(FILTER_HEADER.size))
+                bloom = BloomFilter(capacity, bloom_error_rate, bytearray(file.read(length)), count)
+                if bloom.size != size: raise ValueError(f"{path} has a corrupted filter")
+                scalable.filters.append(bloom)
+
+        return scalable
@@ -1,5 +1,12 @@
 import urllib.parse
 
+# Query parameters only telling where a visitor came from, they never change the page
+TRACKING_PARAMETERS = {
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'twclid', 'ttclid', 'li_fat_id',
+    'mc_cid', 'mc_eid', '_hsenc', '_hsmi', 'mkt_tok', 'igshid', 'ref_src', '_ga', '_gl'
+}
+TRACKING_PREFIXES = ('utm_', 'pk_', 'mtm_', 'hsa_')
+
 
 def extract_domain(url: str):
     tokens = url.split('/')
@@ -17,5 +24,16 @@ def find_robots_txt(url: str):
     domain_and_dot = simplified_url.split('.')
     return tokens[0] + "//" + ".".join(domain_and_dot) + "/robots.txt"
 
+def is_tracking_parameter(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMETERS or name.startswith(TRACKING_PREFIXES)
+
 def CleanUrl(url: str):
-    return url.removesuffix('/')
\ No newline at end of file
+    # Most urls have no query, only the ones with one are parsed
+    if '?' in url:
+        url, sharp, fragment = url.partition('#')
+        base, _, query = url.partition('?')
+        parameters = [parameter for parameter in query.split('&') if parameter and not is_tracking_parameter(parameter.split('=', 1)[0])]
+        url = base + ('?' + '&'.join(parameters) if parameters else '') + sharp + fragment
+
+    return url.removesuffix('/')
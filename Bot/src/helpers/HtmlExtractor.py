@@ -0,0 +1,91 @@
+from lxml import etree
+
+
+class PageExtractor:
+    """
+    lxml parser target collecting the title, meta description, text and links of a page
+    in a single pass, while the body is fed to the parser chunk by chunk.
+    """
+
+    text_tags = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'a'}
+
+    def __init__(self):
+        self.description = ''
+        # href -> anchor text, dict keys keep the links unique and in document order
+        self.links: dict[str, str] = {}
+        self.__title: list[str] = []
+        self.__text: list[str] = []
+        self.__anchor: list[str] | None = None
+        self.__anchor_href = ''
+        self.__in_title = False
+        self.__text_depth = 0
+
+    def start(self, tag, attrib):
+        if tag in self.text_tags:
+            self.__text_depth += 1
+            if tag == 'a':
+                href = attrib.get('href')
+                if href:
+                    self.links.setdefault(href, '')
+                    self.__anchor_href = href
+                    self.__anchor = []
+        elif tag == 'title':
+            self.__in_title = True
+        elif tag == 'meta' and attrib.get('name', '').lower() == 'description':
+            self.description = attrib.get('content', '')
+
+    def end(self, tag):
+        if tag in self.text_tags:
+            self.__text_depth = max(self.__text_depth - 1, 0)
+            self.__text.append(' ')
+            if tag == 'a' and self.__anchor is not None:
+                # The first non empty anchor text of a link is kept
+                if not self.links[self.__anchor_href]: self.links[self.__anchor_href] = " ".join("".join(self.__anchor).split())
+                self.__anchor = None
+        elif tag == 'title':
+            self.__in_title = False
+
+    def data(self, data):
+        if self.__in_title: self.__title.append(data)
+        # Nested text elements are only collected once
+        if self.__text_depth: self.__text.append(data)
+        if self.__anchor is not None: self.__anchor.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return self
+
+    @property
+    def title(self) -> str:
+        return "".join(self.__title).strip()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.__text)
+
+
+class StreamingExtractor:
+    """Feeds chunks of a response to an incremental HTML parser, up to `max_bytes`."""
+
+    def __init__(self, max_bytes: int = 2 * 1024 * 1024, encoding: str | None = None):
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.page = PageExtractor()
+        self.__parser = etree.HTMLParser(target=self.page, encoding=encoding)
+
+    @property
+    def full(self) -> bool:
+        return self.received >= self.max_bytes
+
+    def feed(self, chunk: bytes):
+        chunk = chunk[:self.max_bytes - self.received]
+        self.received += len(chunk)
+        if chunk: self.__parser.feed(chunk)
+
+    def close(self) -> PageExtractor:
+        try:
+            return self.__parser.close()
+        except etree.XMLSyntaxError:
+            return self.page
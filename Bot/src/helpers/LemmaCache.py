@@ -0,0 +1,38 @@
+import time
+from functools import lru_cache
+from nltk.stem import WordNetLemmatizer
+
+class LemmaCache:
+    """Bounded LRU cache of (token, coarse POS) -> lemma."""
+
+    def __init__(self, lemmatizer: WordNetLemmatizer, max_size: int = 200_000):
+        self.lemmatizer = lemmatizer
+        self.miss_seconds = 0.0
+        # lru_cache is thread safe, keeps hit/miss counters and evicts the least recently used entries
+        self.lemmatize = lru_cache(maxsize=max_size)(self.__lemmatize)
+
+    def __lemmatize(self, word: str, pos: str) -> str:
+        start = time.perf_counter()
+        lemma = self.lemmatizer.lemmatize(word, pos=pos)
+        self.miss_seconds += time.perf_counter() - start
+        return lemma
+
+    def hit_rate(self) -> float:
+        info = self.lemmatize.cache_info()
+        total = info.hits + info.misses
+        return info.hits / total if total else 0.0
+
+    def avg_miss_seconds(self) -> float:
+        misses = self.lemmatize.cache_info().misses
+        return self.miss_seconds / misses if misses else 0.0
+
+    def stats(self) -> dict[str, float]:
+        lemmas = self.lemmatize.cache_info()
+        return {
+            "hits": lemmas.hits,
+            "misses": lemmas.misses,
+            "size": lemmas.currsize,
+            "hit_rate": self.hit_rate(),
+            # Every lookup stands for one lemmatizer call, a hit saves the average cost of one
+            "saved_seconds": lemmas.hits * self.avg_miss_seconds()
+        }
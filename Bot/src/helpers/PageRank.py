@@ -0,0 +1,65 @@
+import numpy as np
+from scipy import sparse
+
+
+def build_matrix(sources: np.ndarray, targets: np.ndarray, n: int) -> tuple[sparse.csr_matrix, np.ndarray]:
+    # Transposed adjacency in CSR: row t holds the pages linking to t, so a rank update is one mat-vec.
+    # Duplicated edges count once, like in a simple directed graph
+    matrix = sparse.csr_matrix((np.ones(len(sources), dtype=np.float32), (targets, sources)), shape=(n, n))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    out_degree = np.bincount(matrix.indices, minlength=n).astype(np.float64)
+    return matrix, out_degree
+
+
+def pagerank(matrix: sparse.csr_matrix, out_degree: np.ndarray, alpha: float = 0.85, max_iter: int = 100, tol: float = 1e-6, x0: np.ndarray | None = None) -> tuple[np.ndarray, int]:
+    n = matrix.shape[0]
+    if n == 0: return np.zeros(0), 0
+
+    dangling = out_degree == 0
+    inverse_out = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+
+    x = np.full(n, 1.0 / n) if x0 is None else x0 / x0.sum()
+
+    for iteration in range(1, max_iter + 1):
+        # Pages without outgoing links spread their rank evenly over every page
+        dangling_rank = x[dangling].sum()
+        next_x = alpha * (matrix @ (x * inverse_out)) + (alpha * dangling_rank + 1 - alpha) / n
+
+        error = np.abs(next_x - x).sum()
+        x = next_x
+        if error < n * tol: break
+
+    return x, iteration
+
+
+def pagerank_local(matrix: sparse.csr_matrix, out_degree: np.ndarray, x: np.ndarray, seeds: np.ndarray, alpha: float = 0.85, max_iter: int = 100, tol: float = 1e-6, max_region: float = 0.1) -> tuple[np.ndarray, int]:
+    """
+    Refines a previous rank vector after a small change to the graph. Only the `seeds` and the
+    pages reachable from the ones that keep changing are recomputed. Once nothing moves by more
+    than `tol`, or the change reached more than `max_region` of the graph, a full power
+    iteration takes over from the result.
+    """
+    n = matrix.shape[0]
+    x = x.copy()
+    dangling = out_degree == 0
+    inverse_out = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+    # Rows by source, to find the pages a changed page links to
+    forward = matrix.transpose().tocsr()
+
+    active = np.unique(seeds)
+    iterations = 0
+
+    while 0 < len(active) <= max_region * n and iterations < max_iter:
+        iterations += 1
+        base = (alpha * x[dangling].sum() + 1 - alpha) / n
+        values = alpha * (matrix[active] @ (x * inverse_out)) + base
+
+        changed = active[np.abs(values - x[active]) > tol]
+        x[active] = values
+        active = np.unique(np.concatenate([changed, forward[changed].indices])) if len(changed) else changed
+
+    # The local updates can't track the dangling and teleport mass exactly, finish globally
+    x, full_iterations = pagerank(matrix, out_degree, alpha=alpha, max_iter=max(max_iter - iterations, 1), tol=tol, x0=x)
+    return x, iterations + full_iterations
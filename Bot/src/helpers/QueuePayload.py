@@ -0,0 +1,86 @@
+import json
+import os
+import struct
+import uuid
+import zlib
+import msgpack
+
+DEFAULT_BLOB_PATH = os.environ.get(
+    'SEARCHENGINE_BLOB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'data', 'blobs')
+)
+
+PAYLOAD_VERSION = 1
+# version, flags
+PAYLOAD_HEADER = struct.Struct('<BB')
+COMPRESSED = 1
+# The text is in the blob store, the payload only has its name
+SPILLED = 2
+
+
+class BlobStore:
+    """Page bodies too large for Redis, one file each, removed once the indexed page was acknowledged."""
+
+    def __init__(self, path: str = DEFAULT_BLOB_PATH):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(self.path, name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        return name
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.path, name), 'rb') as file:
+            return file.read()
+
+    def remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+def encode_page(url: str, title: str, description: str, outgoing: list[tuple[str, str]], text: str, compress_bytes: int = 512, blobs: BlobStore | None = None, spill_bytes: int = 0) -> bytes:
+    """
+    Versioned msgpack payload of a crawled page, zlib compressed once it is over `compress_bytes`.
+    With a blob store, a text over `spill_bytes` is compressed to disk and only its name is queued.
+    """
+    flags = 0
+    body = text
+
+    if blobs is not None and spill_bytes and len(text) > spill_bytes:
+        body = blobs.put(zlib.compress(text.encode('utf-8')))
+        flags |= SPILLED
+
+    data = msgpack.packb([url, title, description, outgoing, body], use_bin_type=True)
+    if len(data) > compress_bytes:
+        data = zlib.compress(data)
+        flags |= COMPRESSED
+
+    return PAYLOAD_HEADER.pack(PAYLOAD_VERSION, flags) + data
+
+def decode_page(payload: bytes, blobs: BlobStore | None = None) -> dict:
+    # Pages queued as JSON before the binary format, every field but the links wrapped in a list
+    if payload[:1] == b'{':
+        page = json.loads(payload)
+        return {key: value if key == 'outgoing' else value[0] for key, value in page.items()}
+
+    version, flags = PAYLOAD_HEADER.unpack_from(payload)
+    if version != PAYLOAD_VERSION: raise ValueError(f"Unknown indexing payload version {version}")
+
+    data = payload[PAYLOAD_HEADER.size:]
+    if flags & COMPRESSED: data = zlib.decompress(data)
+    url, title, description, outgoing, body = msgpack.unpackb(data, raw=False)
+
+    page = {"url": url, "title": title, "description": description, "outgoing": outgoing, "text": body}
+    if flags & SPILLED:
+        if blobs is None: raise ValueError(f"{url} was spilled to disk but there is no blob store")
+        # The file stays until the page is acknowledged, a page handed out again reads it again
+        page["text"] = zlib.decompress(blobs.read(body)).decode('utf-8')
+        page["blob"] = body
+
+    return page
@@ -0,0 +1,51 @@
+import hashlib
+import re
+import numpy as np
+
+WORD_PATTERN = re.compile(r'\w+')
+FINGERPRINT_BITS = 64
+# Multipliers mixing the hashes of the words of a shingle, odd so they are invertible mod 2^64
+SHINGLE_MULTIPLIERS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+
+
+def word_hash(word: str) -> int:
+    # Stable between processes, unlike the builtin hash
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, so every bit of a shingle hash depends on all its words
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+def simhash(text: str, shingle_size: int = 3, min_shingles: int = 8) -> int | None:
+    """
+    64 bit SimHash of the distinct word shingles of a text, near identical texts differ in a
+    few bits. None for texts with fewer than `min_shingles` shingles, too short to compare.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < shingle_size + min_shingles - 1: return None
+
+    vocabulary = {word: word_hash(word) for word in set(words)}
+    hashes = np.fromiter((vocabulary[word] for word in words), dtype=np.uint64, count=len(words))
+
+    with np.errstate(over='ignore'):
+        shingles = hashes[:len(hashes) - shingle_size + 1].copy()
+        for offset in range(1, shingle_size):
+            multiplier = SHINGLE_MULTIPLIERS[(offset - 1) % len(SHINGLE_MULTIPLIERS)]
+            shingles = shingles * multiplier + hashes[offset:len(hashes) - shingle_size + 1 + offset]
+        shingles = mix(np.unique(shingles))
+
+    # Bit i of the fingerprint is set when most shingles have it set
+    bits = np.unpackbits(shingles.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority, bitorder='little').tobytes(), 'little')
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+def bands(fingerprint: int, count: int = 4) -> list[int]:
+    # Fingerprints within count - 1 bits of each other have at least one band in common
+    width = FINGERPRINT_BITS // count
+    mask = (1 << width) - 1
+    return [(fingerprint >> (i * width)) & mask for i in range(count)]
@@ -0,0 +1,60 @@
+from array import array
+
+
+def encode_varint(value: int, out: bytearray):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(buf, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80: return result, pos
+        shift += 7
+
+def encode_postings(doc_ids, freqs, base: int = 0) -> bytes:
+    # Doc ids must be ascending, they are stored as gaps followed by the term frequency.
+    # A block of a longer list starts from the last doc id of the block before it
+    out = bytearray()
+    previous = base
+    for doc_id, freq in zip(doc_ids, freqs):
+        encode_varint(doc_id - previous, out)
+        encode_varint(freq, out)
+        previous = doc_id
+    return bytes(out)
+
+def decode_postings(buf, count: int, base: int = 0) -> tuple[array, array]:
+    doc_ids = array('I')
+    freqs = array('I')
+    pos = 0
+    doc_id = base
+    for _ in range(count):
+        gap, pos = decode_varint(buf, pos)
+        freq, pos = decode_varint(buf, pos)
+        doc_id += gap
+        doc_ids.append(doc_id)
+        freqs.append(freq)
+    return doc_ids, freqs
+
+def encode_ids(ids) -> bytes:
+    out = bytearray()
+    previous = 0
+    for value in ids:
+        encode_varint(value - previous, out)
+        previous = value
+    return bytes(out)
+
+def decode_ids(buf, count: int) -> array:
+    ids = array('I')
+    pos = 0
+    value = 0
+    for _ in range(count):
+        gap, pos = decode_varint(buf, pos)
+        value += gap
+        ids.append(value)
+    return ids
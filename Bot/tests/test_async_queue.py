@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import fakeredis
+
+from src.Dedup import RedisSetDedup
+from src.Queue import CRAWLER_GROUP, HIGH_PRIORITY_STREAM, LOW_PRIORITY_STREAM, AsyncQueueManager, QueueManager
+
+
+def make_manager(server):
+    r = fakeredis.FakeRedis(server=server, decode_responses=True)
+    return QueueManager(dedup=RedisSetDedup(r), r=r, raw=fakeredis.FakeRedis(server=server), seed_urls=())
+
+
+def consumer(manager, server, **kwargs):
+    return AsyncQueueManager(manager, r=fakeredis.FakeAsyncRedis(server=server), reclaim_interval=0, **kwargs)
+
+
+def test_unacked_entries_are_reclaimed_once_idle():
+    server = fakeredis.FakeServer()
+    manager = make_manager(server)
+
+    async def main():
+        crashed = consumer(manager, server)
+        await crashed.queue(["https://a.com/1"])
+        [(key, entry_id, url)] = await crashed.get_high_priority_url()
+        assert (key, url) == (HIGH_PRIORITY_STREAM, "https://a.com/1")
+
+        # Not idle long enough to be taken over
+        assert await consumer(manager, server, reclaim_idle=60).get_high_priority_url() == []
+
+        await asyncio.sleep(0.05)
+        other = consumer(manager, server, reclaim_idle=0.01)
+        assert await other.get_high_priority_url() == [(key, entry_id, url)]
+        assert manager.r.xpending(HIGH_PRIORITY_STREAM, CRAWLER_GROUP)['pending'] == 1
+
+    asyncio.run(main())
+
+
+def test_acked_entries_are_deleted():
+    server = fakeredis.FakeServer()
+    manager = make_manager(server)
+
+    async def main():
+        queue = consumer(manager, server, reclaim_idle=0)
+        await queue.queue(["https://a.com/1", "https://b.com/1"])
+        entries = await queue.get_high_priority_url(count=2)
+        assert len(entries) == 2
+
+        await queue.ack([(key, entry_id) for key, entry_id, _ in entries])
+        assert manager.r.xlen(HIGH_PRIORITY_STREAM) == 0
+        assert manager.r.xpending(HIGH_PRIORITY_STREAM, CRAWLER_GROUP)['pending'] == 0
+        # Nothing left to reclaim either
+        time.sleep(0.01)
+        assert await queue.get_high_priority_url(count=2) == []
+
+    asyncio.run(main())
+
+
+def test_requeue_moves_entries_without_duplicating_them():
+    server = fakeredis.FakeServer()
+    manager = make_manager(server)
+
+    async def main():
+        queue = consumer(manager, server, reclaim_idle=0)
+        await queue.queue(["https://a.com/1", "https://a.com/2"])
+        entries = await queue.get_high_priority_url() + await queue.get_low_priority_url()
+        assert [url for _, _, url in entries] == ["https://a.com/1", "https://a.com/2"]
+
+        await queue.requeue(entries)
+        assert manager.r.xlen(HIGH_PRIORITY_STREAM) == 0
+        assert manager.r.xpending(LOW_PRIORITY_STREAM, CRAWLER_GROUP)['pending'] == 0
+        assert sorted(url for _, _, url in await queue.get_low_priority_url(count=10)) == ["https://a.com/1", "https://a.com/2"]
+
+        # Already seen, queueing them again adds nothing
+        assert await queue.queue(["https://a.com/1", "https://a.com/2"]) == (0, 0)
+        assert manager.r.xlen(LOW_PRIORITY_STREAM) == 2
+
+    asyncio.run(main())
@@ -0,0 +1,25 @@
+import fakeredis
+
+from src.Dedup import RedisBloomDedup, RedisSetDedup
+
+
+def test_redis_bloom_contains_what_was_added():
+    r = fakeredis.FakeRedis(decode_responses=True)
+    dedup = RedisBloomDedup(r, initial_capacity=50, error_rate=0.001, snapshot_path='/nonexistent')
+    urls = [f"https://example.com/{i}" for i in range(300)]
+
+    # Past the capacity of the first filter, so the chain grows
+    dedup.add_many(urls[:200])
+    assert dedup.filters > 1
+    assert all(dedup.contains_many(urls[:200]))
+    assert sum(dedup.contains_many(urls[200:])) <= 2
+    assert not any(dedup.add_many(urls[:200]))
+
+    # Another process opening the same filter sees the same urls
+    assert all(RedisBloomDedup(r).contains_many(urls[:200]))
+
+
+def test_redis_set_contains_what_was_added():
+    dedup = RedisSetDedup(fakeredis.FakeRedis(decode_responses=True))
+    assert dedup.add_many(["https://a.com", "https://b.com", "https://a.com"]) == [True, True, False]
+    assert dedup.contains_many(["https://a.com", "https://c.com"]) == [True, False]
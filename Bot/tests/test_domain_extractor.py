@@ -0,0 +1,12 @@
+from src.helpers.DomainExtractor import CleanUrl, extract_domain
+
+
+def test_clean_url_strips_tracking_parameters():
+    assert CleanUrl("https://example.com/page?utm_source=news&id=3&fbclid=abc&UTM_Medium=x") == "https://example.com/page?id=3"
+    assert CleanUrl("https://example.com/page?gclid=1&_ga=2#section") == "https://example.com/page#section"
+    assert CleanUrl("https://example.com/page?q=utm_source&&ref=home") == "https://example.com/page?q=utm_source&ref=home"
+    assert CleanUrl("https://example.com/page/") == "https://example.com/page"
+
+
+def test_extract_domain_drops_subdomains():
+    assert extract_domain("https://en.wikipedia.org/wiki/Search") == "wikipedia.org"
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import fakeredis
+
+from src.Dedup import RedisSetDedup
+from src.Frontier import Frontier, PriorityPolicy
+from src.Queue import HIGH_PRIORITY_STREAM, AsyncQueueManager, QueueManager
+from src.RobotsCache import RobotsCache
+
+
+def test_domains_are_handed_out_once_their_cooldown_passed():
+    server = fakeredis.FakeServer()
+    r = fakeredis.FakeRedis(server=server, decode_responses=True)
+    manager = QueueManager(dedup=RedisSetDedup(r), r=r, raw=fakeredis.FakeRedis(server=server), seed_urls=())
+
+    async def main():
+        queue = AsyncQueueManager(manager, r=fakeredis.FakeAsyncRedis(server=server), block=0.01)
+        queue.default_cooldown = 0.1
+        # Cached in Redis, so no robots.txt is downloaded
+        await queue.save_robots_txt("a.com", "User-agent: *\nCrawl-delay: 0.3")
+        await queue.save_robots_txt("b.com", "User-agent: *\nAllow: /")
+
+        frontier = Frontier(queue, RobotsCache(), None, PriorityPolicy(0.5))
+        await frontier.push([(HIGH_PRIORITY_STREAM, f"0-{i}", url) for i, url in enumerate(["https://a.com/1", "https://a.com/2", "https://b.com/1", "https://b.com/2"], 1)])
+
+        # One url of each domain right away, a domain is out of the heap while its url is being fetched
+        start = time.time()
+        assert [await frontier.get(), await frontier.get()] == ["https://a.com/1", "https://b.com/1"]
+        frontier.done("https://a.com/1")
+        frontier.done("https://b.com/1")
+
+        # b.com has the shorter delay, a.com waits for its crawl delay
+        assert await frontier.get() == "https://b.com/2"
+        assert 0.1 <= time.time() - start < 0.3
+        assert await frontier.get() == "https://a.com/2"
+        assert time.time() - start >= 0.3
+        assert len(frontier) == 0
+
+        # The slot is also reserved in Redis, another crawler of the domain waits for it as well
+        other = Frontier(queue, RobotsCache(), None, PriorityPolicy(0.5))
+        await other.push([(HIGH_PRIORITY_STREAM, "0-5", "https://a.com/3")])
+        start = time.time()
+        assert await other.get() == "https://a.com/3"
+        assert time.time() - start >= 0.2
+
+    asyncio.run(main())
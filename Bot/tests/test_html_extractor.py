@@ -0,0 +1,37 @@
+from src.helpers.HtmlExtractor import StreamingExtractor
+
+PAGE = b"""<html><head><title>Search engines</title>
+<meta name="Description" content="How pages are found"></head>
+<body><h1>Crawling</h1><p>Pages are fetched <a href="/queue">from the <i>queue</i></a> and parsed.</p>
+<p>Links: <a href="https://example.com">Example</a> <a href="/queue">again</a> <a href="/empty"></a></p>
+<script>var ignored = 1;</script><div>Not text either</div>
+<p>The end</p></body></html>"""
+
+
+def extract(page: bytes, chunk_size: int, **kwargs) -> tuple[StreamingExtractor, object]:
+    extractor = StreamingExtractor(**kwargs)
+    for i in range(0, len(page), chunk_size):
+        extractor.feed(page[i:i + chunk_size])
+    return extractor, extractor.close()
+
+
+def test_streamed_page_is_extracted_in_one_pass():
+    # Chunks cut through tags and words, as they come off the network
+    for chunk_size in (7, 64, len(PAGE)):
+        extractor, page = extract(PAGE, chunk_size)
+        assert not extractor.full
+        assert page.title == "Search engines"
+        assert page.description == "How pages are found"
+        # Unique links in document order, with their first non empty anchor text
+        assert page.links == {"/queue": "from the queue", "https://example.com": "Example", "/empty": ""}
+        assert page.text.split() == "Crawling Pages are fetched from the queue and parsed. Links: Example again The end".split()
+
+
+def test_body_is_cut_at_max_bytes():
+    cut = PAGE.index(b"<a href=\"https://example.com\">")
+    extractor, page = extract(PAGE, 16, max_bytes=cut)
+    assert extractor.full
+    assert extractor.received == cut
+    assert page.title == "Search engines"
+    assert list(page.links) == ["/queue"]
+    assert "Example" not in page.text
@@ -0,0 +1,208 @@
+import asyncio
+import math
+import random
+from array import array
+from collections import Counter
+
+from src.InvertedIndex import BLOCK_SIZE, DocTable, Segment, SegmentIndexBackend
+from src.QueryEngine import QueryEngine
+from src.helpers.Varint import decode_ids, decode_postings, decode_varint, encode_ids, encode_postings, encode_varint
+
+
+def test_varint_round_trip():
+    out = bytearray()
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2**32 - 1]
+    for value in values:
+        encode_varint(value, out)
+
+    pos = 0
+    for value in values:
+        decoded, pos = decode_varint(out, pos)
+        assert decoded == value
+    assert pos == len(out)
+
+
+def test_postings_round_trip():
+    doc_ids = array('I', [3, 4, 10, 1000, 70000])
+    freqs = array('I', [1, 2, 300, 1, 5])
+
+    assert decode_postings(encode_postings(doc_ids, freqs), len(doc_ids)) == (doc_ids, freqs)
+    # Blocks of a longer list start from the last doc id of the block before them
+    assert decode_postings(encode_postings(doc_ids[2:], freqs[2:], 4), 3, 4) == (doc_ids[2:], freqs[2:])
+    assert decode_ids(encode_ids(doc_ids), len(doc_ids)) == doc_ids
+
+
+def test_segment_round_trip(tmp_path):
+    random.seed(1)
+    lengths = array('I', [random.randint(1, 50) for _ in range(1000)])
+    postings = {}
+    for term in ('rare', 'common', 'every'):
+        count = {'rare': 3, 'common': 3 * BLOCK_SIZE + 7, 'every': 1000}[term]
+        ids = array('I', sorted(random.sample(range(1000), count)))
+        postings[term] = (ids, array('I', [random.randint(1, 9) for _ in ids]))
+
+    path = str(tmp_path / 'segment.seg')
+    Segment.write(path, ((term, *postings[term]) for term in sorted(postings)), list(range(1000)), lengths)
+    segment = Segment(path)
+
+    assert list(segment.doc_ids) == list(range(1000))
+    for term, (ids, freqs) in postings.items():
+        assert segment.postings(term) == (ids, freqs)
+        assert list(segment.iter_postings(term)) == list(zip(ids, freqs))
+        doc_freq, _, _, max_tf, min_length = segment.terms[term]
+        assert doc_freq == len(ids)
+        assert max_tf == max(freqs)
+        assert min_length == min(lengths[doc_id] for doc_id in ids)
+
+        # The block bounds hold for every posting of the block
+        for block in segment.blocks(term):
+            last, _, _, _, _, block_tf, block_length = block
+            block_ids, block_freqs = segment.decode_block(block)
+            assert block_ids[-1] == last
+            assert max(block_freqs) == block_tf
+            assert min(lengths[doc_id] for doc_id in block_ids) == block_length
+
+    assert segment.postings('missing') is None
+    segment.close()
+
+
+def test_doc_table_compaction(tmp_path):
+    path = str(tmp_path / 'docs.tsv')
+    docs = DocTable(path)
+    for length in range(1, 6):
+        for url in ('a', 'b'):
+            docs.assign(url, length)
+        # Same length, nothing to append
+        docs.assign('a', length)
+        docs.sync()
+
+    reader = DocTable(path)
+    reader.load()
+    assert reader.ids == {'a': 0, 'b': 1}
+
+    assert docs.compact()
+    with open(path, encoding='utf-8') as file:
+        assert file.read().splitlines() == ["0\t5\ta", "1\t5\tb"]
+
+    # The reader starts over from the compacted file
+    docs.assign('c', 7)
+    docs.sync()
+    reader.load()
+    assert reader.urls == ['a', 'b', 'c']
+    assert list(reader.lengths) == [5, 5, 7]
+
+
+def build_index(path, documents: dict[str, Counter], flush_documents: int, merge_factor: int = 3) -> SegmentIndexBackend:
+    index = SegmentIndexBackend(path, flush_documents=flush_documents, merge_factor=merge_factor)
+
+    async def add():
+        for url, token_count in documents.items():
+            await index.add_document(url, token_count)
+        await index.flush()
+
+    asyncio.run(add())
+    index.wait_for_merges()
+    return index
+
+
+def test_merges_keep_newest_postings(tmp_path):
+    random.seed(2)
+    index = SegmentIndexBackend(str(tmp_path / 'index'), flush_documents=10, merge_factor=3)
+    expected = {}
+
+    async def add():
+        for _ in range(100):
+            for _ in range(10):
+                url = f"https://example.com/{random.randrange(300)}"
+                expected[url] = Counter(random.choice('abcde') for _ in range(random.randint(1, 8)))
+                await index.add_document(url, expected[url])
+            await index.flush()
+
+    asyncio.run(add())
+    index.wait_for_merges()
+    assert len(index.segments) < 100
+
+    for term in 'abcde':
+        ids, freqs = index.postings(term)
+        assert {index.docs.urls[doc_id]: freq for doc_id, freq in zip(ids, freqs)} == {url: counts[term] for url, counts in expected.items() if counts[term]}
+    assert index.doc_count == len(expected)
+    assert index.total_length == sum(sum(counts.values()) for counts in expected.values())
+
+    reader = SegmentIndexBackend(str(tmp_path / 'index'))
+    assert reader.doc_count == index.doc_count
+    assert reader.total_length == index.total_length
+
+
+def test_removed_documents_leave_postings_and_counts(tmp_path):
+    random.seed(3)
+    index = SegmentIndexBackend(str(tmp_path / 'index'), flush_documents=10, merge_factor=3)
+    expected = {}
+
+    async def add():
+        for _ in range(30):
+            for _ in range(10):
+                url = f"https://example.com/{random.randrange(100)}"
+                if random.random() < 0.3:
+                    await index.remove_documents([url])
+                    expected.pop(url, None)
+                else:
+                    expected[url] = Counter(random.choice('abc') for _ in range(random.randint(1, 8)))
+                    await index.add_document(url, expected[url])
+            await index.flush()
+
+    asyncio.run(add())
+    index.wait_for_merges()
+
+    for term in 'abc':
+        ids, freqs = index.postings(term)
+        assert {index.docs.urls[doc_id]: freq for doc_id, freq in zip(ids, freqs)} == {url: counts[term] for url, counts in expected.items() if counts[term]}
+    assert index.doc_count == len(expected)
+    assert index.total_length == sum(sum(counts.values()) for counts in expected.values())
+
+    reader = SegmentIndexBackend(str(tmp_path / 'index'))
+    assert (reader.doc_count, reader.total_length) == (index.doc_count, index.total_length)
+
+
+def brute_force(index: SegmentIndexBackend, documents: dict[str, Counter], terms: list[str], conjunctive: bool, k1: float = 1.2, b: float = 0.75) -> dict[str, float]:
+    doc_count = len(documents)
+    avg_length = sum(sum(counts.values()) for counts in documents.values()) / doc_count
+    scores = {}
+    for url, counts in documents.items():
+        matched = [term for term in terms if counts[term]]
+        if not matched or (conjunctive and len(matched) < len(terms)): continue
+
+        length = sum(counts.values())
+        score = 0.0
+        for term in matched:
+            doc_freq = sum(1 for other in documents.values() if other[term])
+            idf = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+            tf = counts[term]
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+        scores[url] = score
+    return scores
+
+
+def test_query_engine_matches_brute_force(tmp_path):
+    random.seed(3)
+    vocabulary = [f"t{i}" for i in range(30)]
+    # Zipf-like, so some terms span several blocks and others only a few documents
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    documents = {
+        f"https://example.com/{i}": Counter(random.choices(vocabulary, weights, k=random.randint(5, 80)))
+        for i in range(1500)
+    }
+    index = build_index(str(tmp_path / 'index'), documents, flush_documents=200)
+    engine = QueryEngine(index, rank_path=str(tmp_path / 'ranks'), graph_path=str(tmp_path / 'graph'))
+
+    for _ in range(40):
+        terms = random.sample(vocabulary, random.randint(1, 3))
+        conjunctive = random.random() < 0.5
+        expected = brute_force(index, documents, terms, conjunctive)
+        best = sorted(expected.values(), reverse=True)
+
+        results, has_more = engine.search(terms, page=0, page_size=10, conjunctive=conjunctive)
+        assert len(results) == min(10, len(expected))
+        assert has_more == (len(expected) > 10)
+        for (url, score), expected_score in zip(results, best):
+            assert math.isclose(score, expected_score, rel_tol=1e-9)
+            assert math.isclose(expected[url], score, rel_tol=1e-9)
@@ -0,0 +1,23 @@
+from src.helpers.LemmaCache import LemmaCache
+
+
+class CountingLemmatizer:
+    def __init__(self):
+        self.calls = 0
+
+    def lemmatize(self, word: str, pos: str = 'n') -> str:
+        self.calls += 1
+        return word.rstrip('s')
+
+
+def test_saved_seconds_counts_one_lemmatizer_call_per_hit():
+    lemmatizer = CountingLemmatizer()
+    cache = LemmaCache(lemmatizer, max_size=10)
+    tokens = [('cats', 'n'), ('runs', 'v'), ('cats', 'n'), ('cats', 'v'), ('runs', 'v')]
+
+    assert [cache.lemmatize(word, pos) for word, pos in tokens] == ['cat', 'run', 'cat', 'cat', 'run']
+    stats = cache.stats()
+    # Without the cache each token is one lemmatizer call
+    assert lemmatizer.calls == stats["misses"] == 3
+    assert stats["hits"] == len(tokens) - lemmatizer.calls
+    assert stats["saved_seconds"] == stats["hits"] * cache.avg_miss_seconds()
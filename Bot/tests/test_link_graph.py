@@ -0,0 +1,33 @@
+import random
+
+from src.LinkGraph import LinkGraph
+
+
+def test_changed_since_stays_incremental_after_merges(tmp_path):
+    random.seed(4)
+    graph = LinkGraph(str(tmp_path / 'graph'), flush_pages=5, merge_factor=3)
+    # Newest links and flush sequence of each page
+    expected = {}
+
+    for _ in range(40):
+        for _ in range(5):
+            source = f"https://example.com/{random.randrange(60)}"
+            targets = sorted({f"https://example.com/{random.randrange(60)}" for _ in range(random.randint(0, 4))} - {source})
+            graph.add(source, [(target, f"to {target}") for target in targets])
+            expected[source] = (targets, graph.sequence + 1)
+        graph.flush()
+    graph.wait_for_merges()
+    assert len(graph.segments) < 40
+
+    urls = graph.docs.urls
+    for since in (0, 10, 25, 39):
+        records, sequence = graph.changed_since(since)
+        assert sequence == 40
+        assert {urls[source]: {urls[target] for target in targets} for source, (targets, _) in records.items()} == {url: set(targets) for url, (targets, flushed) in expected.items() if flushed > since}
+
+    records, _ = graph.changed_since(0)
+    source = graph.docs.ids[next(iter(expected))]
+    assert records[source][1] == [f"to {urls[target]}" for target in records[source][0]]
+
+    reader = LinkGraph(str(tmp_path / 'graph'))
+    assert reader.changed_since(25)[0].keys() == graph.changed_since(25)[0].keys()
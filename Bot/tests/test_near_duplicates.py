@@ -0,0 +1,52 @@
+import asyncio
+import random
+
+import fakeredis
+
+from src.NearDuplicates import NearDuplicateIndex
+from src.helpers.SimHash import bands, hamming_distance, simhash
+
+random.seed(1)
+WORDS = [f"w{i}" for i in range(500)]
+A = " ".join(random.choice(WORDS) for _ in range(300))
+B = " ".join(random.choice(WORDS) for _ in range(300))
+
+
+def test_simhash_of_near_identical_texts_differs_in_few_bits():
+    edited = A.split()
+    edited[150] = "changed"
+    assert simhash(A) == simhash(A.upper())
+    assert hamming_distance(simhash(A), simhash(" ".join(edited))) <= 3
+    assert hamming_distance(simhash(A), simhash(B)) > 16
+    # Too short to compare
+    assert simhash("only a few words") is None
+    assert sum(band << (16 * i) for i, band in enumerate(bands(simhash(A)))) == simhash(A)
+
+
+def test_duplicates_point_to_their_canonical_page_and_release_stale_bands():
+    r = fakeredis.FakeAsyncRedis()
+    index = NearDuplicateIndex(r)
+
+    async def main():
+        # The first page of a cluster is canonical, also within a batch
+        assert await index.canonical([{'url': 'a', 'text': A}, {'url': 'b', 'text': A}, {'url': 'short', 'text': 'too short'}]) == [None, 'a', None]
+        # A page crawled again matches itself
+        assert await index.canonical([{'url': 'a', 'text': A}]) == [None]
+
+        # a changed, its old bands are released so b becomes canonical for the old text
+        assert await index.canonical([{'url': 'a', 'text': B}]) == [None]
+        assert await index.canonical([{'url': 'b', 'text': A}]) == [None]
+        assert await index.canonical([{'url': 'c', 'text': B}]) == ['a']
+
+        # b became a duplicate of a, no page clusters around its old text anymore
+        assert await index.canonical([{'url': 'b', 'text': B}]) == ['a']
+        assert await index.canonical([{'url': 'd', 'text': A}]) == [None]
+
+        fingerprints = await r.hgetall('simhash:urls')
+        assert fingerprints == {b'a': f"{simhash(B):016x}".encode(), b'd': f"{simhash(A):016x}".encode()}
+        # Every band field left points to one of those urls
+        for key in [key async for key in r.scan_iter('simhash:*:*')]:
+            for field, url in (await r.hgetall(key)).items():
+                assert fingerprints[url] == field
+
+    asyncio.run(main())
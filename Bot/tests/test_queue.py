@@ -0,0 +1,34 @@
+import fakeredis
+import pytest
+
+from src.Dedup import BloomDedup, RedisBloomDedup, RedisSetDedup
+from src.Queue import HIGH_PRIORITY_STREAM, LOW_PRIORITY_STREAM, QueueManager
+
+
+def queued(r, key: str) -> list[str]:
+    return [fields['url'] for _, fields in r.xrange(key)]
+
+
+# One of each mode of the enqueue script: 'set', 'bloom', and 'none' for a dedup checked in Python
+@pytest.mark.parametrize('make_dedup', [
+    lambda r, tmp_path: RedisSetDedup(r),
+    lambda r, tmp_path: RedisBloomDedup(r, initial_capacity=2, snapshot_path=str(tmp_path / 'seen_urls.bloom')),
+    lambda r, tmp_path: BloomDedup(str(tmp_path / 'seen_urls.bloom'), initial_capacity=100),
+])
+def test_enqueue_routes_new_domains_high_and_skips_seen_urls(tmp_path, make_dedup):
+    r = fakeredis.FakeRedis(decode_responses=True)
+    manager = QueueManager(dedup=make_dedup(r, tmp_path), r=r, raw=fakeredis.FakeRedis(), seed_urls=())
+
+    # The first url of a domain goes to the high priority stream, the next ones of it to the low one.
+    # The duplicate and the url left with only tracking parameters are queued once
+    assert manager.queue(["https://a.com/1", "https://a.com/2", "https://b.com/1", "https://a.com/1", "https://a.com/2?utm_source=x"]) == (2, 1)
+    assert queued(r, HIGH_PRIORITY_STREAM) == ["https://a.com/1", "https://b.com/1"]
+    assert queued(r, LOW_PRIORITY_STREAM) == ["https://a.com/2"]
+
+    # Seen urls are not queued again, unseen ones of a known domain go to the low priority stream
+    assert manager.queue(["https://b.com/1", "https://a.com/1", "https://b.com/2", "https://c.com/1"]) == (1, 1)
+    assert queued(r, HIGH_PRIORITY_STREAM) == ["https://a.com/1", "https://b.com/1", "https://c.com/1"]
+    assert queued(r, LOW_PRIORITY_STREAM) == ["https://a.com/2", "https://b.com/2"]
+
+    assert manager.queue(["https://a.com/1", "https://b.com/2", "https://c.com/1"]) == (0, 0)
+    assert all(manager.dedup.contains_many(["https://a.com/1", "https://a.com/2", "https://b.com/1", "https://b.com/2", "https://c.com/1"]))
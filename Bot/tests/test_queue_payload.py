@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from src.helpers.QueuePayload import COMPRESSED, PAYLOAD_HEADER, SPILLED, BlobStore, decode_page, encode_page
+
+OUTGOING = [["https://example.com/a", "First link"], ["https://example.com/b", ""]]
+
+
+def flags(payload: bytes) -> int:
+    return PAYLOAD_HEADER.unpack_from(payload)[1]
+
+
+def test_small_and_large_pages_round_trip():
+    small = encode_page("https://example.com", "Title", "Description", OUTGOING, "Short text")
+    assert flags(small) == 0
+    assert decode_page(small) == {"url": "https://example.com", "title": "Title", "description": "Description", "outgoing": OUTGOING, "text": "Short text"}
+
+    text = "Pages over the threshold are compressed. " * 100
+    large = encode_page("https://example.com", "Title", "Description", OUTGOING, text)
+    assert flags(large) == COMPRESSED
+    assert len(large) < len(text)
+    assert decode_page(large)["text"] == text
+
+
+def test_large_text_spills_to_the_blob_store(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    text = "é spilled to disk " * 200
+    payload = encode_page("https://example.com", "Title", "", OUTGOING, text, blobs=blobs, spill_bytes=1000)
+    assert flags(payload) & SPILLED
+    assert len(payload) < 200
+
+    page = decode_page(payload, blobs)
+    assert page["text"] == text
+    assert os.listdir(tmp_path) == [page["blob"]]
+    # A page handed out again still finds its text until it is removed
+    assert decode_page(payload, blobs)["text"] == text
+    with pytest.raises(ValueError):
+        decode_page(payload)
+
+    blobs.remove(page["blob"])
+    assert os.listdir(tmp_path) == []
+
+    # Under the threshold the text stays in the payload
+    assert "blob" not in decode_page(encode_page("https://example.com", "Title", "", OUTGOING, "short", blobs=blobs, spill_bytes=1000), blobs)
+
+
+def test_json_payloads_queued_before_still_decode():
+    payload = json.dumps({"url": ["https://example.com"], "title": ["Title"], "description": [""], "outgoing": OUTGOING, "text": ["Text"]}).encode('utf-8')
+    assert decode_page(payload) == {"url": "https://example.com", "title": "Title", "description": "", "outgoing": OUTGOING, "text": "Text"}
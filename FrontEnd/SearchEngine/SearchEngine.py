@@ -1,125 +1,202 @@
-import string
-from pymongo import MongoClient
+import asyncio
+import os
+import sys
+from pymongo import AsyncMongoClient
+import redis
 import reflex as rx
-import nltk
-from nltk import pos_tag
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from sentence_transformers import SentenceTransformer
 
 from rxconfig import config
 
-mongodb = MongoClient("mongodb://localhost:27017/")
+# The index format lives with the bot, share its modules instead of duplicating them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Bot'))
+from src.EmbeddingIndex import EmbeddingIndex
+from src.Metrics import metrics, serve_metrics
+from src.InvertedIndex import MongoIndexBackend, SegmentIndexBackend
+from src.QueryCache import Generation, QueryCache
+from src.QueryEngine import QueryEngine
+from src.Resources import resources
+
+# Seconds a search may take before it is given up
+query_timeout = float(os.environ.get('SEARCHENGINE_QUERY_TIMEOUT', 5))
+
+# One pool shared by every search of the worker, the driver enforces the query timeout on each operation too
+mongodb = AsyncMongoClient(
+    "mongodb://localhost:27017/",
+    maxPoolSize=50,
+    minPoolSize=5,
+    maxIdleTimeMS=60_000,
+    waitQueueTimeoutMS=int(query_timeout * 1000),
+    timeoutMS=int(query_timeout * 1000)
+)
 db = mongodb["searchengine"]
-collection = db['indexes']
+pages = db['pages']
+
+# BM25 and PageRank with top-k retrieval over the segments, the mongo backend can only match and sort everything.
+# Opening the index reads its doc table and the rank prior, that waits for the first query
+segments = os.environ.get('SEARCHENGINE_INDEX_BACKEND', 'segments') != 'mongo'
+resources.register('index', lambda: SegmentIndexBackend() if segments else MongoIndexBackend(db['indexes']))
+resources.register('query_engine', lambda: QueryEngine(resources.get('index')))
+page_size = 10
+
+# Semantic rerank: the lexical top `rerank_depth` are rescored with the cosine similarity of their
+# precomputed embeddings, only the query is encoded. 0 turns it off
+rerank_depth = int(os.environ.get('SEARCHENGINE_RERANK_DEPTH', 0)) if segments else 0
+rerank_weight = float(os.environ.get('SEARCHENGINE_RERANK_WEIGHT', 0.5))
+resources.register('embeddings', EmbeddingIndex)
 
-nltk.download('punkt', quiet=True)
-nltk.download('punkt_tab', quiet=True)
-nltk.download('averaged_perceptron_tagger_eng', quiet=True)
-nltk.download('wordnet', quiet=True)
-nltk.download('stopwords', quiet=True)
+# Results of popular queries are served without touching the index or MongoDB. With
+# SEARCHENGINE_QUERY_CACHE_REDIS set the frontend workers also share them through Redis
+r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+generation = Generation(r)
+query_cache = QueryCache(r=r if os.environ.get('SEARCHENGINE_QUERY_CACHE_REDIS') else None)
 
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words())
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Search latencies and cache lookups on http://127.0.0.1:<port>/metrics, each worker needs a port of its own
+search_seconds = metrics.histogram('frontend_search_seconds', "Time to answer a search, cache and page lookups included")
+search_results = {result: metrics.counter('frontend_searches_total', "Searches by outcome", result=result) for result in ('ok', 'timeout', 'error')}
+for lookup in ('hits', 'shared_hits', 'misses'):
+    metrics.counter('query_cache_lookups_total', "Query cache lookups by result", callback=lambda lookup=lookup: query_cache.stats()[lookup], result=lookup)
+
+metrics_port = int(os.environ.get('SEARCHENGINE_METRICS_PORT', 0))
+if metrics_port:
+    try:
+        serve_metrics(metrics_port)
+    except OSError as e:
+        print(f"Could not serve metrics on port {metrics_port}: {e}")
+
+# The tokenizer (NLTK data, tagger, wordnet) loads in the background so the worker starts right away,
+# a query arriving before it is ready waits for that single load
+resources.preload('tokenizer', *(['embedding_model'] if rerank_depth else []))
 
 class State(rx.State):
     """The app state."""
 
+# Search running for each client, a new query cancels the previous one
+running: dict[str, asyncio.Task] = {}
+
 class FormInputState(rx.State):
     form_data: dict[str, str] = {}
     results: dict[str, dict[str, str]] = {}
+    page: int = 0
+    has_more: bool = False
+    searching: bool = False
+    error: str = ""
 
     @rx.event
     def handle_submit(self, form_data: dict):
-        text: str = form_data.get('input')
-
-        text = " ".join(text.split())
-
-        text = text.translate(str.maketrans('', '', string.punctuation + '’')).lower()
-
-        tokens = word_tokenize(text)
-
-        filtered_tokens = [word for word in tokens if word not in stop_words]
-
-        filtered_tokens = [word for word in filtered_tokens if not len(word) > 30]
-
-        tagged = pos_tag(filtered_tokens)
-
-        lemmatized_words = [lemmatizer.lemmatize(
-            word, pos='v' if tag.startswith('V') else 'n') for word, tag in tagged]
-
-        num_target_words = len(lemmatized_words)
-
-        pipeline = [
-            {
-                "$match": {
-                    "word": { "$in": lemmatized_words }
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$url",
-                    "matched_words": { "$addToSet": "$word" },
-                    "total_word_count": { "$sum": "$count" }
-                }
-            },
-            {
-                "$project": {
-                    "url": "$_id",
-                    "match_count": { "$size": "$matched_words" },
-                    "total_word_count": 1
-                }
-            },
-            {
-                "$match": {
-                    "match_count": num_target_words
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "pages",
-                    "localField": "url",
-                    "foreignField": "url",
-                    "as": "page_details"
-                }
-            },
-            {
-                "$unwind": "$page_details"
-            },
-            {
-                "$sort": {
-                    "page_details.rank": -1,
-                    "total_word_count": -1
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "url": 1,
-                    "match_count": 1,
-                    "total_word_count": 1,
-                    "title": "$page_details.title",
-                    "description": "$page_details.description",
-                    "rank": "$page_details.rank"
-                }
-            }
-        ]
-
-        # 3. Execute the aggregation
-        result_cursor = collection.aggregate(pipeline)
-
-        self.results.clear()
-
-        for doc in result_cursor:
-
-            self.results[doc["url"]] = {
-                "title": doc["title"],
-                "description": doc["description"]
-            }
-        
+        self.page = 0
         self.form_data = {"input": form_data.get('input')}
+        return FormInputState.search
+
+    @rx.event
+    def next_page(self):
+        if not self.has_more: return
+        self.page += 1
+        return FormInputState.search
+
+    @rx.event
+    def previous_page(self):
+        if self.page == 0: return
+        self.page -= 1
+        return FormInputState.search
+
+    @rx.event(background=True)
+    async def search(self):
+        token = self.router.session.client_token
+        previous = running.get(token)
+        if previous is not None and not previous.done(): previous.cancel()
+        task = running[token] = asyncio.current_task()
+
+        try:
+            with search_seconds.time():
+                await asyncio.wait_for(self._run_query(), query_timeout)
+            search_results['ok'].inc()
+        except asyncio.CancelledError:
+            # Replaced by a newer query, which now owns the results
+            return
+        except asyncio.TimeoutError:
+            search_results['timeout'].inc()
+            async with self:
+                self.error = "The search took too long, try again"
+        except Exception as e:
+            search_results['error'].inc()
+            print(e)
+            async with self:
+                self.error = "The search failed, try again"
+        finally:
+            if running.get(token) is task: running.pop(token)
+            async with self:
+                if running.get(token) is None: self.searching = False
+
+    async def _run_query(self):
+        async with self:
+            text = self.form_data.get('input', '')
+            page = self.page
+            self.results = {}
+            self.error = ""
+            self.searching = True
+
+        # Tokenizing and walking the index are CPU bound, keep them off the event loop
+        lemmatized_words = await asyncio.to_thread(lambda: resources.get('tokenizer').clean_and_tokenize(text))
+
+        # Loaded by the first query, the others wait for that single load
+        index_backend = await asyncio.to_thread(resources.get, 'index')
+        query_engine = await asyncio.to_thread(resources.get, 'query_engine') if segments else None
+        if query_engine is not None: await asyncio.to_thread(index_backend.refresh)
+        current = f"{await asyncio.to_thread(generation.current)}:{index_backend.generation}"
+        key = QueryCache.key(lemmatized_words, page, page_size=page_size, rerank=rerank_depth)
+
+        cached = await asyncio.to_thread(query_cache.get, key, current)
+        if cached is not None:
+            async with self:
+                self.results = dict(cached[0])
+                self.has_more = cached[1]
+            return
+
+        projection = {"_id": 0, "url": 1, "title": 1, "description": 1}
+
+        if rerank_depth:
+            found, _ = await asyncio.to_thread(query_engine.search, lemmatized_words, 0, rerank_depth)
+            query_vector = await asyncio.to_thread(lambda: resources.get('embedding_model').encode(text, convert_to_numpy=True, normalize_embeddings=True, device='cpu'))
+            found = (await asyncio.to_thread(resources.get, 'embeddings')).rerank(query_vector, found, rerank_weight)
+            has_more = len(found) > (page + 1) * page_size
+            urls = [url for url, _ in found[page * page_size:(page + 1) * page_size]]
+            cursor = pages.find({"url": {"$in": urls}}, projection, batch_size=page_size)
+        elif query_engine is not None:
+            found, has_more = await asyncio.to_thread(query_engine.search, lemmatized_words, page, page_size)
+            urls = [url for url, _ in found]
+            cursor = pages.find({"url": {"$in": urls}}, projection, batch_size=page_size)
+        else:
+            # Only one page of the matches, ordered by page rank. The extra row sets has_more below
+            cursor = await index_backend.match_page_async(lemmatized_words, page, page_size)
+            has_more = False
+
+        results: dict[str, dict[str, str]] = {}
+        batch: dict[str, dict[str, str]] = {}
+
+        async with cursor:
+            async for doc in cursor:
+                if len(results) + len(batch) == page_size:
+                    has_more = True
+                    break
+
+                batch[doc["url"]] = {"title": doc["title"], "description": doc["description"]}
+
+                # Show the results as their batches arrive
+                if len(batch) >= 5:
+                    results.update(batch)
+                    async with self:
+                        self.results.update(batch)
+                    batch = {}
+
+        results.update(batch)
+        # The query engine ranked the page, MongoDB returns the documents in any order
+        if query_engine is not None: results = {url: results[url] for url in urls if url in results}
+
+        async with self:
+            self.results = results
+            self.has_more = has_more
+
+        await asyncio.to_thread(query_cache.put, key, current, [results, has_more])
 
 
 def render_item(info: list):
@@ -152,8 +229,15 @@ def form_search():
             rx.vstack(
                 rx.heading("Results:"),
                 rx.badge(FormInputState.form_data.get('input')),
+                rx.cond(FormInputState.searching, rx.spinner()),
+                rx.cond(FormInputState.error != "", rx.text(FormInputState.error, color_scheme="red")),
                 rx.box(
                     rx.foreach(FormInputState.results, render_item)
+                ),
+                rx.hstack(
+                    rx.button("Previous", on_click=FormInputState.previous_page, disabled=FormInputState.page == 0),
+                    rx.text(FormInputState.page + 1),
+                    rx.button("Next", on_click=FormInputState.next_page, disabled=~FormInputState.has_more),
                 )
             ),
             align_items="left",